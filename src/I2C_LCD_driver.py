@@ -21,28 +21,39 @@ I2CBUS = 1
 # LCD Address
 ADDRESS = 0x27
 
-import smbus
+# Max number of bytes of one i2c block write, after the first byte sent as 'cmd'
+I2C_BLOCK_MAX = 32
+
+import hardware as hw
 from time import sleep
 
 class i2c_device:
    def __init__(self, addr, port=I2CBUS):
       self.addr = addr
-      self.bus = smbus.SMBus(port)
+      self.bus = hw.SMBus(port)
 
 # Write a single command
    def write_cmd(self, cmd):
       self.bus.write_byte(self.addr, cmd)
-      sleep(0.0001)
 
 # Write a command and argument
    def write_cmd_arg(self, cmd, data):
       self.bus.write_byte_data(self.addr, cmd, data)
-      sleep(0.0001)
 
 # Write a block of data
    def write_block_data(self, cmd, data):
       self.bus.write_block_data(self.addr, cmd, data)
-      sleep(0.0001)
+
+# Write a sequence of bytes, in as few transactions as possible.
+# The PCF8574 has no register: the 'cmd' byte of a block write is latched on its outputs like the others,
+# so up to 33 bytes are sent per transaction.
+   def write_bytes(self, data):
+      for start in range(0, len(data), I2C_BLOCK_MAX + 1):
+         chunk = data[start:start + I2C_BLOCK_MAX + 1]
+         if len(chunk) == 1:
+            self.bus.write_byte(self.addr, chunk[0])
+         else:
+            self.bus.write_i2c_block_data(self.addr, chunk[0], chunk[1:])
 
 # Read a single byte
    def read(self):
@@ -103,14 +114,21 @@ En = 0b00000100 # Enable bit
 Rw = 0b00000010 # Read/Write bit
 Rs = 0b00000001 # Register select bit
 
+# execution times of the HD44780 (datasheet), the other instructions take less than one i2c byte (~90us at 100kHz)
+CLEAR_HOME_DELAY = 0.00152
+INIT_DELAY = 0.0041
+
 class lcd:
    #initializes objects and lcd
    def __init__(self):
       self.lcd_device = i2c_device(ADDRESS)
 
       self.lcd_write(0x03)
+      sleep(INIT_DELAY)
       self.lcd_write(0x03)
+      sleep(INIT_DELAY)
       self.lcd_write(0x03)
+      sleep(INIT_DELAY)
       self.lcd_write(0x02)
 
       self.lcd_write(LCD_FUNCTIONSET | LCD_2LINE | LCD_5x8DOTS | LCD_4BITMODE)
@@ -120,27 +138,35 @@ class lcd:
       sleep(0.2)
 
 
+   # bytes clocking one nibble into the lcd: data set up, EN high, EN low (each byte lasts longer than the EN pulse width)
+   def nibble_bytes(self, data):
+      return [data | LCD_BACKLIGHT, data | En | LCD_BACKLIGHT, (data & ~En) | LCD_BACKLIGHT]
+
+   # bytes of a whole command (mode=0) or character (mode=Rs), high nibble first
+   def command_bytes(self, cmd, mode=0):
+      return self.nibble_bytes(mode | (cmd & 0xF0)) + self.nibble_bytes(mode | ((cmd << 4) & 0xF0))
+
+   # sends a sequence built with command_bytes
+   def lcd_write_bytes(self, data):
+      self.lcd_device.write_bytes(data)
+
    # clocks EN to latch command
    def lcd_strobe(self, data):
-      self.lcd_device.write_cmd(data | En | LCD_BACKLIGHT)
-      sleep(.0005)
-      self.lcd_device.write_cmd(((data & ~En) | LCD_BACKLIGHT))
-      sleep(.0001)
+      self.lcd_write_bytes(self.nibble_bytes(data)[1:])
 
    def lcd_write_four_bits(self, data):
-      self.lcd_device.write_cmd(data | LCD_BACKLIGHT)
-      self.lcd_strobe(data)
+      self.lcd_write_bytes(self.nibble_bytes(data))
 
    # write a command to lcd
    def lcd_write(self, cmd, mode=0):
-      self.lcd_write_four_bits(mode | (cmd & 0xF0))
-      self.lcd_write_four_bits(mode | ((cmd << 4) & 0xF0))
+      self.lcd_write_bytes(self.command_bytes(cmd, mode))
+      if mode == 0 and cmd in (LCD_CLEARDISPLAY, LCD_RETURNHOME):
+         sleep(CLEAR_HOME_DELAY)
 
    # write a character to lcd (or character rom) 0x09: backlight | RS=DR<
    # works!
    def lcd_write_char(self, charvalue, mode=1):
-      self.lcd_write_four_bits(mode | (charvalue & 0xF0))
-      self.lcd_write_four_bits(mode | ((charvalue << 4) & 0xF0))
+      self.lcd_write_bytes(self.command_bytes(charvalue, mode))
   
    # put string function with optional char positioning
    def lcd_display_string(self, string, line=1, pos=0):
@@ -153,10 +179,10 @@ class lcd:
     elif line == 4:
       pos_new = 0x54 + pos
 
-    self.lcd_write(0x80 + pos_new)
-
+    data = self.command_bytes(LCD_SETDDRAMADDR + pos_new)
     for char in string:
-      self.lcd_write(ord(char), Rs)
+      data += self.command_bytes(ord(char), Rs)
+    self.lcd_write_bytes(data)
 
    # clear lcd and set to home
    def lcd_clear(self):
@@ -172,7 +198,8 @@ class lcd:
 
    # add custom characters (0 - 7)
    def lcd_load_custom_chars(self, fontdata):
-      self.lcd_write(0x40);
+      data = self.command_bytes(LCD_SETCGRAMADDR)
       for char in fontdata:
          for line in char:
-            self.lcd_write_char(line)
+            data += self.command_bytes(line, Rs)
+      self.lcd_write_bytes(data)
@@ -0,0 +1,232 @@
+import asyncio
+import heapq
+import itertools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+"""
+Optional asyncio runtime (python3 main.py --asyncio).
+
+One event loop owns the timing of everything: the button inputs, the tab scheduler, the metronome ticks
+and the string routines. The loop itself never touches the hardware, the blocking I/O is pushed to
+executors, each with a single worker so that the order of the operations is kept:
+    - ui:     the menu actions (button presses, end of tab, metronome beats). They are run one after
+              the other, so the handlers never race on 'current_node'. They only draw the frames, which
+              are sent to the LCD by its render thread (see lcd_framebuffer.py).
+    - io:     the events of the scheduler (servo commands..), and the reading of the tab being played
+    - buzzer: the metronome beeps, so that a beep never delays a servo command
+"""
+
+
+class AsyncScheduler:
+    """
+    Same interface as scheduler.Scheduler, but the deadlines are awaited by a task of the event loop,
+    instead of a dedicated thread. Its methods can be called from any thread.
+    """
+
+    def __init__(self, loop, executor, lookahead = 0.5):
+        self.loop = loop
+        self.executor = executor                    # Where the callbacks of the events are run
+        self.events = []                            # Heap of (deadline_ns, sequence, func, args)
+        self.sequence = itertools.count()
+        self.start_time_ns = 0
+        self.lookahead_ns = int(lookahead * 1e9)
+
+        self.source = None
+        self.source_next = None
+        self.source_error = None                    # Called (without argument) if the source raises
+        self.generation = 0                         # Incremented when the source changes, so that a source being pulled is dropped
+        self.wakeup = asyncio.Event()               # Set whenever the events change, to recompute the next deadline
+
+
+    def now_ns(self):
+        return time.monotonic_ns()
+
+
+    # All the changes of the state are done in the loop
+    def call_in_loop(self, func, *args):
+        self.loop.call_soon_threadsafe(func, *args)
+
+
+    def start(self, events):
+        start_time_ns = self.now_ns()
+        self.call_in_loop(self.push_events, start_time_ns, list(events))
+
+
+    def push_events(self, start_time_ns, events):
+        self.start_time_ns = start_time_ns
+        for time_s, func, args in events:
+            heapq.heappush(self.events, (start_time_ns + int(time_s * 1e9), next(self.sequence), func, args))
+        self.wakeup.set()
+
+
+    def play(self, source, on_error = None):
+        self.start_time_ns = self.now_ns()
+        self.call_in_loop(self.set_source, self.start_time_ns, iter(source), on_error)
+
+
+    def set_source(self, start_time_ns, source, on_error = None):
+        self.start_time_ns = start_time_ns
+        self.source = source
+        self.source_next = None
+        self.source_error = on_error
+        self.generation += 1
+        self.wakeup.set()
+
+
+    def schedule(self, delay, func, args = None):
+        self.schedule_at(self.now_ns() + int(delay * 1e9), func, args)
+
+
+    def schedule_at(self, deadline_ns, func, args = None):
+        self.call_in_loop(self.push_event, deadline_ns, func, args or [])
+
+
+    def push_event(self, deadline_ns, func, args):
+        heapq.heappush(self.events, (deadline_ns, next(self.sequence), func, args))
+        self.wakeup.set()
+
+
+    def clear(self):
+        self.call_in_loop(self.clear_in_loop)
+
+
+    def clear_in_loop(self):
+        self.events.clear()
+        self.source = None
+        self.source_next = None
+        self.source_error = None
+        self.generation += 1
+        self.wakeup.set()
+
+
+    def pending_events(self):
+        return len(self.events)
+
+
+    # Moves the events of the source which are due within the lookahead into the heap. The source is iterated in
+    # the executor, as producing the events reads and parses the tab, which must not block the loop.
+    async def pull_source(self):
+        horizon_ns = self.now_ns() + self.lookahead_ns
+        if self.source is None:
+            return
+        if self.source_next is not None and self.start_time_ns + int(self.source_next[0] * 1e9) > horizon_ns:
+            return
+
+        generation = self.generation
+        pulled, pending, failed = await self.loop.run_in_executor(self.executor, self.read_source, self.source,
+                                                                  self.source_next, self.start_time_ns, horizon_ns)
+        if generation != self.generation:      # Cleared or replaced in the meantime
+            return
+        for deadline_ns, func, args in pulled:
+            heapq.heappush(self.events, (deadline_ns, next(self.sequence), func, args))
+        self.source_next = pending
+        if failed and self.source_error != None:     # e.g. the end of tab callback, which clears the scheduler
+            self.loop.run_in_executor(self.executor, self.run_event, self.source_error, [])
+        if pending is None:
+            self.source = None
+            self.source_error = None
+
+
+    # Runs in the executor: returns the (deadline_ns, func, args) events of the source up to 'horizon_ns', the first
+    # event after it (or None if the source is over), and whether the source raised
+    def read_source(self, source, pending, start_time_ns, horizon_ns):
+        pulled = []
+        while True:
+            if pending is None:
+                try:
+                    pending = next(source, None)
+                except Exception as e:
+                    print("Scheduler: source {} raised {!r}".format(source, e))
+                    return pulled, None, True
+                if pending is None:
+                    return pulled, None, False
+            deadline_ns = start_time_ns + int(pending[0] * 1e9)
+            if deadline_ns > horizon_ns:
+                return pulled, pending, False
+            pulled.append((deadline_ns, pending[1], pending[2]))
+            pending = None
+
+
+    async def run(self):
+        while True:
+            await self.pull_source()
+
+            now_ns = self.now_ns()
+            while self.events and self.events[0][0] <= now_ns:
+                deadline_ns, _, func, args = heapq.heappop(self.events)
+                self.loop.run_in_executor(self.executor, self.run_event, func, args)
+
+            wait_ns = None
+            if self.events:
+                wait_ns = self.events[0][0] - now_ns
+            if self.source_next is not None:
+                pull_in_ns = self.start_time_ns + int(self.source_next[0] * 1e9) - self.lookahead_ns - now_ns
+                wait_ns = pull_in_ns if wait_ns is None else min(wait_ns, pull_in_ns)
+
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), None if wait_ns is None else max(0, wait_ns) / 1e9)
+            except asyncio.TimeoutError:
+                pass
+
+
+    def run_event(self, func, args):
+        try:
+            func(*args)
+        except Exception as e:
+            print("Scheduler: event {} raised {!r}".format(func, e))
+
+
+class AsyncRuntime:
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)       # So that the queue and events below belong to this loop
+        self.ui_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ui")
+        self.io_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="io")
+        self.buzzer_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="buzzer")
+        self.scheduler = AsyncScheduler(self.loop, self.io_executor)
+        self.metronome_scheduler = AsyncScheduler(self.loop, self.buzzer_executor)     # Not cleared with the tab
+        self.ui_queue = asyncio.Queue()         # (func, args) of the actions to run in the ui executor
+
+
+    # Can be called from any thread (button callbacks, scheduler events..): the action is queued,
+    # and run in the ui executor once the previous ones are over.
+    def dispatch(self, func, *args):
+        self.loop.call_soon_threadsafe(self.ui_queue.put_nowait, (func, args))
+
+
+    def beep(self, func):
+        self.loop.call_soon_threadsafe(self.loop.run_in_executor, self.buzzer_executor, func)
+
+
+    async def process_ui_queue(self):
+        while True:
+            func, args = await self.ui_queue.get()
+            try:
+                await self.loop.run_in_executor(self.ui_executor, func, *args)
+            except Exception as e:
+                print("UI action {} raised {!r}".format(func, e))
+
+
+    # Wires the managers to the loop, and runs it forever
+    def run(self, metronome, servo_manager, tab_manager, menu_manager):
+        metronome.scheduler = self.metronome_scheduler
+        metronome.dispatch = self.dispatch
+        metronome.beep_dispatch = self.beep
+        servo_manager.scheduler = self.scheduler
+        tab_manager.dispatch = self.dispatch
+        menu_manager.dispatch = self.dispatch
+
+        async def main():
+            await asyncio.gather(self.scheduler.run(), self.metronome_scheduler.run(), self.process_ui_queue())
+
+        try:
+            self.loop.run_until_complete(main())
+        finally:
+            self.ui_executor.shutdown(wait=False)
+            self.io_executor.shutdown(wait=False)
+            self.buzzer_executor.shutdown(wait=False)
+            self.loop.close()
@@ -0,0 +1,172 @@
+import argparse
+import json
+import platform
+import time
+
+import hardware as hw
+
+
+"""
+Throughput benchmark of the LCD driver.
+
+The same screens are drawn with the legacy driver (one i2c transaction per nibble edge, with sleeps after each
+of them), with the bulk driver (whole strings sent as i2c block writes), and with the framebuffer on top of it.
+The bytes and transactions sent to the PCF8574 backpack are counted, and the report gives the bytes/sec and
+the time needed to draw one screen:
+    python3 bench_lcd.py            # On the raspberry, with the LCD plugged in
+    python3 bench_lcd.py --sim      # Against the simulated bus, only the sleeps and the python overhead are measured
+"""
+
+
+class CountingBus:  # Wraps the SMBus of the LCD, to count what is sent
+
+    def __init__(self, bus):
+        self.bus = bus
+        self.nb_of_bytes = 0
+        self.nb_of_transactions = 0
+
+
+    def write_byte(self, addr, value):
+        self.count(1)
+        self.bus.write_byte(addr, value)
+
+
+    def write_byte_data(self, addr, cmd, value):
+        self.count(2)
+        self.bus.write_byte_data(addr, cmd, value)
+
+
+    def write_block_data(self, addr, cmd, data):
+        self.count(2 + len(data))       # cmd, length, data
+        self.bus.write_block_data(addr, cmd, data)
+
+
+    def write_i2c_block_data(self, addr, cmd, data):
+        self.count(1 + len(data))
+        self.bus.write_i2c_block_data(addr, cmd, data)
+
+
+    def count(self, nb_of_bytes):
+        self.nb_of_bytes += nb_of_bytes
+        self.nb_of_transactions += 1
+
+
+    def reset(self):
+        self.nb_of_bytes = 0
+        self.nb_of_transactions = 0
+
+
+def legacy_lcd_class(I2C_LCD_driver):
+
+    class LegacyLcd(I2C_LCD_driver.lcd):   # The driver as it was: one write_byte per nibble edge, with sleeps
+                                            # (write_cmd used to sleep 0.1ms after each byte)
+
+        def lcd_strobe(self, data):
+            self.lcd_device.write_cmd(data | I2C_LCD_driver.En | I2C_LCD_driver.LCD_BACKLIGHT)
+            time.sleep(.0001)
+            time.sleep(.0005)
+            self.lcd_device.write_cmd((data & ~I2C_LCD_driver.En) | I2C_LCD_driver.LCD_BACKLIGHT)
+            time.sleep(.0001)
+            time.sleep(.0001)
+
+
+        def lcd_write_four_bits(self, data):
+            self.lcd_device.write_cmd(data | I2C_LCD_driver.LCD_BACKLIGHT)
+            time.sleep(.0001)
+            self.lcd_strobe(data)
+
+
+        def lcd_write(self, cmd, mode=0):
+            self.lcd_write_four_bits(mode | (cmd & 0xF0))
+            self.lcd_write_four_bits(mode | ((cmd << 4) & 0xF0))
+
+
+        def lcd_display_string(self, string, line=1, pos=0):
+            self.lcd_write(I2C_LCD_driver.LCD_SETDDRAMADDR + [0x00, 0x40, 0x14, 0x54][line - 1] + pos)
+            for char in string:
+                self.lcd_write(ord(char), I2C_LCD_driver.Rs)
+
+    return LegacyLcd
+
+
+# The menu screens: browsing the root menu, then the beat counter of the recorder
+def screens(nb_of_beats):
+    for _ in range(nb_of_beats // 8 + 1):
+        for index, name in enumerate(["Play Tab", "Practice", "String Routine", "Servo Position", "Change PWM value"]):
+            yield name, str(index + 1) + " / 5"
+    for beat in range(nb_of_beats):
+        yield "Recording " + str(beat % 4 + 1), ""
+
+
+def draw(display, line_1, line_2):
+    display.lcd_clear()
+    display.lcd_display_string(line_1, 1)
+    display.lcd_display_string(line_2, 2)
+
+
+def run_case(name, display, bus, nb_of_beats, frame = None):
+    bus.reset()
+    nb_of_screens = 0
+    start = time.perf_counter()
+    for line_1, line_2 in screens(nb_of_beats):
+        if frame != None:
+            with frame():
+                draw(display, line_1, line_2)
+        else:
+            draw(display, line_1, line_2)
+        nb_of_screens += 1
+    elapsed = time.perf_counter() - start
+
+    return {
+        "driver": name,
+        "screens": nb_of_screens,
+        "bytes": bus.nb_of_bytes,
+        "transactions": bus.nb_of_transactions,
+        "elapsed_s": elapsed,
+        "bytes_per_s": bus.nb_of_bytes / elapsed if elapsed else None,
+        "ms_per_screen": elapsed * 1000 / nb_of_screens,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sim", action="store_true", help="Use the simulated i2c bus")
+    parser.add_argument("--beats", type=int, default=64, help="Number of beat counter updates")
+    parser.add_argument("--output", "-o", help="JSON report file, printed if not given")
+    args = parser.parse_args()
+
+    if args.sim:
+        hw.set_backend(hw.SIM_BACKEND)
+    import I2C_LCD_driver
+    import lcd_framebuffer
+
+    results = []
+
+    legacy = legacy_lcd_class(I2C_LCD_driver)()
+    bus = legacy.lcd_device.bus = CountingBus(legacy.lcd_device.bus)
+    results.append(run_case("legacy", legacy, bus, args.beats))
+
+    bulk = I2C_LCD_driver.lcd()
+    bus = bulk.lcd_device.bus = CountingBus(bulk.lcd_device.bus)
+    results.append(run_case("bulk", bulk, bus, args.beats))
+
+    framebuffer = lcd_framebuffer.FramebufferLcd(bulk)
+    bulk.lcd_clear()
+    results.append(run_case("bulk + framebuffer", framebuffer, bus, args.beats, framebuffer.frame))
+
+    report = {
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "platform": platform.platform(),
+        "backend": hw.backend,
+        "cases": results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import hardware as hw
+hw.set_backend(hw.SIM_BACKEND)     # The benchmark always runs against the recording backend
+
+import metronome as metro
+import scheduler as sch
+import servo_manager as sm
+import tab_manager as tm
+
+
+"""
+Timing-accuracy benchmark of the tab playback.
+
+Each tab is played through TabManager, against the simulated hardware backend. The time at which every
+servo command is written on the (simulated) PCA9685 is compared with the time it was scheduled for,
+which gives how late each string is plucked. The report is a JSON file, which can be diffed between releases:
+    python3 bench_playback.py -o bench_report.json
+The tabs are copied into a temporary directory first, so that the timeline caches and the library index written
+while playing them never end up in the tabs directory.
+"""
+
+
+DEFAULT_TABS_PATH = '../tabs'
+DEFAULT_PWM_FILE_PATH = '../pwm_value.txt'
+
+
+class RecordingScheduler(sch.Scheduler):    # Keeps track of the deadline of every servo event
+
+    def __init__(self):
+        super().__init__()
+        self.expected = []          # List of (deadline_ns, [strings])
+        self.schedule_time_ns = 0
+
+
+    def play(self, source, on_error = None):
+        start_ns = time.monotonic_ns()
+        super().play(self.record_source(source), on_error)
+        self.schedule_time_ns = time.monotonic_ns() - start_ns
+
+
+    # The events are recorded as the scheduler pulls them
+    def record_source(self, source):
+        for time_s, func, args in source:
+            if getattr(func, '__name__', None) == "trigger_servos":
+                self.expected.append((self.start_time_ns + int(time_s * 1e9), list(args[0])))
+            yield time_s, func, args
+
+
+class ResourceSampler:  # Samples the number of threads while the tab is playing
+
+    def __init__(self, period = 0.01):
+        self.period = period
+        self.peak_threads = threading.active_count()
+        self.running = False
+
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+
+    def run(self):
+        while self.running:
+            self.peak_threads = max(self.peak_threads, threading.active_count() - 1)   # Without the sampler itself
+            time.sleep(self.period)
+
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+
+
+def percentile(sorted_values, ratio):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(ratio * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+# Returns, for each channel, the times at which its 'off' value actually changed.
+# A block write also rewrites the channels in between, so only the changes are servo commands.
+def servo_commands(events, after_ns):
+    last_values = {}
+    commands = {}
+    for timestamp_ns, device, action, (channel, on, off) in events:
+        if last_values.get(channel) != off and timestamp_ns >= after_ns:
+            commands.setdefault(channel, []).append(timestamp_ns)
+        last_values[channel] = off
+    return commands
+
+
+def linear_slope(xs, ys):
+    if len(xs) < 2:
+        return 0
+    mean_x = sum(xs) / len(xs)
+    mean_y = sum(ys) / len(ys)
+    variance = sum((x - mean_x) ** 2 for x in xs)
+    if variance == 0:
+        return 0
+    return sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / variance
+
+
+def compute_lateness(expected, commands, stop_ns):
+    expected_by_channel = {}
+    for deadline_ns, strings in expected:
+        if deadline_ns <= stop_ns:
+            for string in strings:
+                expected_by_channel.setdefault(string, []).append(deadline_ns)
+
+    lateness = []       # List of (deadline_ns, lateness_ns)
+    missed = 0
+    for channel, deadlines in expected_by_channel.items():
+        actual = commands.get(channel, [])
+        missed += max(0, len(deadlines) - len(actual))
+        lateness += [(deadline, fired - deadline) for deadline, fired in zip(sorted(deadlines), actual)]
+
+    return sorted(lateness), missed
+
+
+def report_lateness(lateness, missed):
+    values_ms = sorted(late / 1e6 for _, late in lateness)
+    report = {
+        "notes": len(values_ms),
+        "missed": missed,
+        "p50_ms": percentile(values_ms, 0.5),
+        "p99_ms": percentile(values_ms, 0.99),
+        "max_ms": values_ms[-1] if values_ms else None,
+        "mean_ms": sum(values_ms) / len(values_ms) if values_ms else None,
+    }
+
+    # Drift: how the lateness evolves over the song, in ms per minute of playback
+    if lateness:
+        first_deadline = lateness[0][0]
+        xs = [(deadline - first_deadline) / 60e9 for deadline, _ in lateness]
+        ys = [late / 1e6 for _, late in lateness]
+        report["drift_ms_per_min"] = linear_slope(xs, ys)
+        tenth = max(1, len(ys) // 10)
+        report["drift_first_to_last_tenth_ms"] = sum(ys[-tenth:]) / tenth - sum(ys[:tenth]) / tenth
+    return report
+
+
+def run_case(scheduler, metronome, name, absolute_tab_path, is_agu_file, tabs_path, pwm_file_path, max_duration):
+    hw.recorder.clear()
+    scheduler.expected = []
+    servo_manager = sm.ServoManager(pwm_file_path)
+    tab_manager = tm.TabManager(servo_manager, metronome, scheduler, tabs_path)
+    if is_agu_file:
+        tab_manager.load_tab_info(absolute_tab_path)
+
+    tab_over = threading.Event()
+    tab_manager.set_callback(tab_over.set)
+
+    sampler = ResourceSampler()
+    sampler.start()
+    tracemalloc.start()
+    cpu_start = time.process_time()
+    call_start_ns = time.monotonic_ns()
+    tab_manager.play_tab(absolute_tab_path, is_agu_file)
+    play_tab_call_ns = time.monotonic_ns() - call_start_ns
+
+    finished = tab_over.wait(max_duration)
+    stop_ns = time.monotonic_ns()
+    if not finished:
+        tab_manager.clear_events()
+    metronome.stop_metronome()
+
+    cpu_time = time.process_time() - cpu_start
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    sampler.stop()
+
+    commands = servo_commands(hw.recorder.get_events("pca9685", "set_pwm"), scheduler.start_time_ns)
+    lateness, missed = compute_lateness(scheduler.expected, commands, stop_ns)
+
+    report = {
+        "tab": name,
+        "completed": finished,
+        "played_s": (stop_ns - scheduler.start_time_ns) / 1e9,
+        "play_tab_call_ms": play_tab_call_ns / 1e6,
+        "schedule_ms": scheduler.schedule_time_ns / 1e6,
+        "cpu_time_s": cpu_time,
+        "peak_threads": sampler.peak_threads,
+        "peak_python_memory_kb": peak_memory / 1024,
+    }
+    report["lateness"] = report_lateness(lateness, missed)
+    return report
+
+
+# Copies the tabs of the benchmark into 'work_dir', and returns the copied tabs directory
+def copy_tabs(tabs_path, work_dir, tab_names):
+    copy_path = os.path.join(work_dir, "tabs")
+    os.mkdir(copy_path)
+    for tab_name in tab_names:
+        source = os.path.join(tabs_path, tab_name)
+        if os.path.isdir(source):
+            shutil.copytree(source, os.path.join(copy_path, tab_name))
+        elif os.path.isfile(source):
+            shutil.copy2(source, copy_path)
+    return copy_path
+
+
+# Writes a .agu tab with notes on a regular grid, e.g. 16th notes at 200 BPM
+def write_synthetic_tab(tab_dir, tempo, beats, notes_per_beat, nb_of_bars, chords):
+    os.mkdir(tab_dir)
+    with open(os.path.join(tab_dir, "Meta.agu"), 'w') as meta_file:
+        meta_file.write("tempo,{}\nbeats,{}\n".format(tempo, beats))
+        for bar in range(1, nb_of_bars + 1):
+            meta_file.write("Loop_{}\n".format(bar))
+
+    notes_per_bar = beats * notes_per_beat
+    for bar in range(1, nb_of_bars + 1):
+        with open(os.path.join(tab_dir, "Loop_{}".format(bar)), 'w') as loop_file:
+            for i in range(notes_per_bar):
+                strings = range(6) if chords else [i % 6]
+                for string in strings:
+                    loop_file.write("{},{}\n".format(string, i / notes_per_bar))
+
+    return os.path.join(tab_dir, "Meta.agu")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tabs", "-t", default=DEFAULT_TABS_PATH)
+    parser.add_argument("--pwm", default=DEFAULT_PWM_FILE_PATH)
+    parser.add_argument("--output", "-o", help="JSON report file, printed if not given")
+    parser.add_argument("--max-duration", type=float, default=30, help="Stops each tab after this many seconds")
+    parser.add_argument("--synthetic-bars", type=int, default=16)
+    parser.add_argument("--synthetic-tempo", type=int, default=200)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="aguitare_bench_")
+    tabs_path = copy_tabs(args.tabs, work_dir, ["FirstSong.gp3", "FirstSong"])
+    cases = [
+        ("FirstSong.gp3", os.path.join(tabs_path, "FirstSong.gp3"), False),
+        ("FirstSong (.agu)", os.path.join(tabs_path, "FirstSong", "Meta.agu"), True),
+        ("16th chords, all strings", write_synthetic_tab(os.path.join(work_dir, "chords"), args.synthetic_tempo, 4, 4,
+                                                          args.synthetic_bars, True), True),
+        ("16th notes, string by string", write_synthetic_tab(os.path.join(work_dir, "single"), args.synthetic_tempo, 4, 4,
+                                                              args.synthetic_bars, False), True),
+    ]
+
+    scheduler = RecordingScheduler()       # Shared by all the cases, so that the thread count is not biased
+    metronome = metro.Metronome()          # Same for the metronome, which has its own scheduler thread
+    results = []
+    try:
+        for name, absolute_tab_path, is_agu_file in cases:
+            print("Playing {} ...".format(name))
+            try:
+                results.append(run_case(scheduler, metronome, name, absolute_tab_path, is_agu_file, tabs_path, args.pwm, args.max_duration))
+            except Exception as e:     # e.g. guitarpro not installed, the other cases still run
+                results.append({"tab": name, "error": repr(e)})
+    finally:
+        shutil.rmtree(work_dir)
+
+    report = {
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "cases": results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+import itertools
+import time
+from array import array
+
+
+"""
+Capture of the string buttons presses, for the recorder.
+
+A press is timestamped with time.perf_counter_ns() as soon as its button callback runs, before the servo is
+moved, and written into a ring buffer preallocated once. The gpiozero callbacks of the six buttons run in
+different threads, but they never wait for each other: each press takes the next slot from an
+itertools.count (atomic under the GIL), and publishes it by writing its sequence number last.
+The recorder drains the ring from its own thread. As each press carries its own timestamp, draining late
+never changes the recorded times:
+    ring.push(string)                   # From the button callback
+    for time_ns, string in ring.drain():
+        ...
+"""
+
+
+RING_SIZE = 1024
+
+
+class CaptureRing:
+
+    def __init__(self, size = RING_SIZE):
+        self.size = size
+        self.times = array('q', [0]) * size         # perf_counter_ns() of the press written in each slot
+        self.strings = array('b', [0]) * size
+        self.sequences = array('q', [-1]) * size    # Number of the press written in each slot, -1 if none yet
+        self.counter = itertools.count()            # Number of the next press
+        self.read_index = 0                         # Number of the next press to be drained
+        self.nb_of_lost = 0                         # Presses overwritten before being drained
+
+
+    def push(self, string, time_ns = None):
+        if time_ns == None:
+            time_ns = time.perf_counter_ns()
+        index = next(self.counter)
+        slot = index % self.size
+        self.times[slot] = time_ns
+        self.strings[slot] = string
+        self.sequences[slot] = index        # Written last: from now on, the press can be drained
+
+
+    # Returns the (time_ns, string) presses pushed since the last drain. Only one thread may drain the ring.
+    def drain(self):
+        presses = []
+        while True:
+            slot = self.read_index % self.size
+            sequence = self.sequences[slot]
+            if sequence < self.read_index:      # Not published yet
+                break
+            if sequence > self.read_index:      # The writers went round the ring: skip to the oldest press left
+                oldest = sequence - self.size + 1
+                self.nb_of_lost += oldest - self.read_index
+                self.read_index = oldest
+                continue
+
+            press = (self.times[slot], self.strings[slot])
+            if self.sequences[slot] != sequence:    # Overwritten while being read
+                self.nb_of_lost += 1
+            else:
+                presses.append(press)
+            self.read_index += 1
+        return presses
+
+
+    # Forgets the presses which were not drained yet
+    def discard(self):
+        self.drain()
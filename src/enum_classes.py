@@ -15,11 +15,15 @@ class SessionRecorderState(Enum):
     PLAYER_SELECTION_START = 7
     PLAYER_SELECTION_END = 8
     PLAYER_ON = 9
+    OVERDUBBING = 10
+    OVERDUB_SAVING = 11
 
 class TabPlayerState(Enum):
     IDLE = 1
     BROWSING_TAB = 2
     PLAYING_TAB = 3
+    SELECTING_BAR = 4
+    LOADING_TAB = 5
 
 
 class ServosPositionState(Enum):
@@ -31,6 +35,7 @@ class StringsRoutineState(Enum):
     IDLE = 1
     BROWSING = 2
     ROUTINE_RUNNING = 3
+    CALIBRATING = 4
 
 
 class PWMEditorState(Enum):
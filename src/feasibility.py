@@ -0,0 +1,193 @@
+import argparse
+import json
+
+import servo_config
+import timeline as tl
+
+
+"""
+Checks that the servos can play a tab.
+
+A servo plucks its string each time it travels between its low and high positions, so it can't strike the
+same string again before 'travel' ms (see servo_config.py). The notes of a string closer than that to the
+previous strike are either:
+    - warn:     played anyway, only reported (the servo may skip or mangle them)
+    - drop:     removed
+    - merge:    moved to the first time the servo can strike again, unless it runs into the next note of the
+                string, then removed: a too fast passage is played at the rate of the servo
+The report gives the shortest interval between two notes of each string, and the too fast notes by bar, with
+what the policy did with them. The tab is playable if none of them is left in the output:
+    python3 feasibility.py ../tabs/FirstSong/Meta.agu song.gp5 --travel 80
+    python3 feasibility.py ../tabs/*.agu --pwm ../pwm_value.txt -o report.json
+"""
+
+
+WARN_POLICY = "warn"
+DROP_POLICY = "drop"
+MERGE_POLICY = "merge"
+POLICIES = (WARN_POLICY, DROP_POLICY, MERGE_POLICY)
+NB_OF_STRINGS = 6
+TOLERANCE = 1e-6        # In s, so that the notes moved by 'merge' are not reported again because of a rounding error
+
+
+class FeasibilityReport:
+
+    def __init__(self, travel_times, policy):
+        self.travel_times = travel_times                # In seconds, by string
+        self.policy = policy
+        self.min_intervals = [None] * NB_OF_STRINGS     # Shortest interval between two notes of each string in the tab, in s
+        self.min_output_intervals = [None] * NB_OF_STRINGS  # Same, once the policy is applied
+        self.conflicts = []                             # (bar, string, time, interval, action) of the too fast notes
+        self.nb_of_notes = 0
+
+
+    def add_interval(self, string, interval):
+        if self.min_intervals[string] == None or interval < self.min_intervals[string]:
+            self.min_intervals[string] = interval
+
+
+    def add_output_interval(self, string, interval):
+        if self.min_output_intervals[string] == None or interval < self.min_output_intervals[string]:
+            self.min_output_intervals[string] = interval
+
+
+    # The conflicts left in the output: the notes played anyway (warn), and the notes 'merge' could not delay
+    # (dropped). The notes dropped on purpose by 'drop', or delayed by 'merge', are not played too fast anymore.
+    def unresolved_conflicts(self):
+        return [conflict for conflict in self.conflicts
+                if conflict[4] == WARN_POLICY or (self.policy == MERGE_POLICY and conflict[4] == DROP_POLICY)]
+
+
+    # Whether the output timeline is played as written, all the conflicts being resolved by the policy
+    def is_playable(self):
+        return not self.unresolved_conflicts()
+
+
+    # Returns {bar: [conflicts]}, the bars starting at 1
+    def by_bar(self):
+        bars = {}
+        for conflict in self.conflicts:
+            bars.setdefault(conflict[0], []).append(conflict)
+        return bars
+
+
+    def to_dict(self):
+        return {
+            "policy": self.policy,
+            "playable": self.is_playable(),
+            "notes": self.nb_of_notes,
+            "travel_ms": [travel * 1000 for travel in self.travel_times],
+            "min_interval_ms": [None if interval == None else interval * 1000 for interval in self.min_intervals],
+            "min_output_interval_ms": [None if interval == None else interval * 1000 for interval in self.min_output_intervals],
+            "conflicts": len(self.conflicts),
+            "unresolved_conflicts": len(self.unresolved_conflicts()),
+            "bars": [{"bar": bar, "notes": [{"string": string + 1, "time": time, "interval_ms": interval * 1000, "action": action}
+                                            for _, string, time, interval, action in conflicts]}
+                     for bar, conflicts in sorted(self.by_bar().items())],
+        }
+
+
+    def summary(self):
+        lines = ["{} notes, {} too fast, {} unresolved ({})".format(self.nb_of_notes, len(self.conflicts), len(self.unresolved_conflicts()), self.policy)]
+        for string, interval in enumerate(self.min_intervals):
+            if interval != None:
+                line = "    String {}: shortest interval {:.0f} ms".format(string + 1, interval * 1000)
+                output_interval = self.min_output_intervals[string]
+                if self.policy != WARN_POLICY and output_interval != None and output_interval != interval:
+                    line += " ({:.0f} ms once {})".format(output_interval * 1000, "merged" if self.policy == MERGE_POLICY else "dropped")
+                lines.append(line + ", travel {:.0f} ms".format(self.travel_times[string] * 1000))
+        for bar, conflicts in sorted(self.by_bar().items()):
+            strings = sorted(set(conflict[1] + 1 for conflict in conflicts))
+            shortest = min(conflict[3] for conflict in conflicts)
+            lines.append("    Bar {}: {} notes too fast on string {} (down to {:.0f} ms)".format(bar, len(conflicts), ", ".join(map(str, strings)), shortest * 1000))
+        return "\n".join(lines)
+
+
+# Applies the policy to a stream of bars (see timeline.TabStream), the conflicts being added to the report.
+# The intervals are measured on the notes of the tab, but a note is also too fast if it comes too close to the
+# previous strike once the policy applied (a note delayed by 'merge' pushes the next ones).
+def limit_bars(bars, travel_times, policy, report):
+    last_source_times = [None] * NB_OF_STRINGS  # Last note of each string in the tab, over the bars
+    last_times = [None] * NB_OF_STRINGS         # Last strike of each string in the output
+    for bar, (bar_time, bar_duration, notes) in enumerate(bars, 1):
+        report.nb_of_notes += len(notes)
+
+        # For each note, the time of the next note of the same string in the bar (or the end of the bar)
+        next_times = [None] * len(notes)
+        following = [bar_time + bar_duration] * NB_OF_STRINGS
+        for i in range(len(notes) - 1, -1, -1):
+            time, string = notes[i]
+            next_times[i] = following[string]
+            following[string] = time
+
+        kept = []
+        for i, (time, string) in enumerate(notes):
+            last_source_time = last_source_times[string]
+            last_time = last_times[string]
+            last_source_times[string] = time
+            if last_source_time != None:
+                interval = time - last_source_time
+                report.add_interval(string, interval)
+                too_fast = interval < travel_times[string] - TOLERANCE
+                if last_time != None and time - last_time < travel_times[string] - TOLERANCE:
+                    too_fast = True
+                if too_fast:
+                    action = policy
+                    if policy == MERGE_POLICY:
+                        time = max(time, last_time + travel_times[string]) if last_time != None else time
+                        action = "delayed" if time < next_times[i] else DROP_POLICY
+                    report.conflicts.append((bar, string, notes[i][0], interval, action))
+                    if action == DROP_POLICY:
+                        continue
+            if last_time != None:
+                report.add_output_interval(string, time - last_time)
+            kept.append((time, string))
+            last_times[string] = time
+
+        yield bar_time, bar_duration, sorted(kept)
+
+
+# Returns the timeline with the policy applied (the same one with 'warn'), and its report
+def check_timeline(timeline, travel_times, policy = WARN_POLICY):
+    if policy not in POLICIES:
+        raise ValueError("Unknown policy {}, must be one of {}".format(policy, ", ".join(POLICIES)))
+    report = FeasibilityReport(travel_times, policy)
+    bars = limit_bars(tl.iter_timeline_bars(timeline), travel_times, policy, report)
+    if policy == WARN_POLICY:
+        for _ in bars:
+            pass
+        return timeline, report
+    return tl.compile_stream(tl.TabStream(timeline.tempo, timeline.beats, bars)), report
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("tabs", nargs="+", help="gpX files, Meta.agu files or .agu v2 files")
+    parser.add_argument("--policy", "-p", default=WARN_POLICY, choices=POLICIES)
+    parser.add_argument("--travel", "-t", type=float, help="Travel time of all the servos, in ms, instead of the pwm file")
+    parser.add_argument("--pwm", default="../pwm_value.txt", help="pwm file giving the travel time of each servo")
+    parser.add_argument("--output", "-o", help="JSON report file")
+    args = parser.parse_args()
+
+    if args.travel != None:
+        travel_times = [args.travel / 1000] * NB_OF_STRINGS
+    else:
+        config = servo_config.ServoConfig(args.pwm)
+        config.load()
+        travel_times = [config.get(string, "travel") / 1000 for string in range(NB_OF_STRINGS)]
+
+    reports = {}
+    for tab in args.tabs:
+        timeline, report = check_timeline(tl.load_timeline(tab), travel_times, args.policy)
+        reports[tab] = report.to_dict()
+        print(tab + ": " + report.summary())
+
+    if args.output:
+        with open(args.output, 'w') as report_file:
+            json.dump(reports, report_file, indent=2)
+    if not all(report["playable"] for report in reports.values()):
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+import os
+import threading
+import time
+
+
+"""
+Hardware abstraction layer.
+
+All the modules get their hardware through this file (PCA9685 servo driver, GPIO buttons and buzzer,
+smbus for the LCD) instead of importing the Raspberry libraries directly. Two backends are available:
+    - 'pi':  the real libraries (Adafruit_PCA9685, RPi.GPIO, gpiozero, smbus), imported only when used
+    - 'sim': simulated devices, which record every write with a time.monotonic_ns() timestamp, so that the
+             whole program can be run, benchmarked and tested on an ordinary computer
+
+The backend is chosen with the AGUITARE_BACKEND environment variable, or by calling set_backend()
+before creating the devices.
+"""
+
+
+PI_BACKEND = "pi"
+SIM_BACKEND = "sim"
+
+backend = os.environ.get("AGUITARE_BACKEND", PI_BACKEND)
+
+
+def set_backend(name):
+    global backend
+    if name not in (PI_BACKEND, SIM_BACKEND):
+        raise ValueError("Unknown hardware backend: {}".format(name))
+    backend = name
+
+
+def is_simulated():
+    return backend == SIM_BACKEND
+
+
+class SimRecorder:  # Stores everything that is sent to the simulated devices
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events = []                # List of (timestamp_ns, device, action, args)
+        self.buttons = {}               # pin -> SimButton, to simulate button presses
+
+
+    def record(self, device, action, args = ()):
+        timestamp_ns = time.monotonic_ns()
+        with self.lock:
+            self.events.append((timestamp_ns, device, action, args))
+
+
+    def clear(self):
+        with self.lock:
+            self.events.clear()
+
+
+    def get_events(self, device = None, action = None):
+        with self.lock:
+            return [event for event in self.events
+                    if (device is None or event[1] == device) and (action is None or event[2] == action)]
+
+
+    def press_button(self, pin):
+        self.buttons[pin].press()
+
+
+recorder = SimRecorder()
+
+
+# PCA9685 ---------------------------------------------------------------------------------------------------
+
+class SimI2CDevice:     # Mimics Adafruit_GPIO.I2C.Device, as used by Adafruit_PCA9685.PCA9685._device
+
+    LED0_ON_L = 0x06
+    LED15_OFF_H = 0x45
+
+    def __init__(self, name):
+        self.name = name
+        self.registers = [0] * 256
+
+
+    def write8(self, register, value):
+        self.registers[register] = value & 0xFF
+        recorder.record(self.name, "write8", (register, value))
+
+
+    def readU8(self, register):
+        return self.registers[register]
+
+
+    def writeList(self, register, data):
+        for i, value in enumerate(data):
+            self.registers[register + i] = value & 0xFF
+
+        # A block write over the LED registers is recorded as one set_pwm per channel, with the same timestamp
+        timestamp_ns = time.monotonic_ns()
+        with recorder.lock:
+            recorder.events.append((timestamp_ns, self.name, "writeList", (register, list(data))))
+            if self.LED0_ON_L <= register <= self.LED15_OFF_H:
+                first_channel = (register - self.LED0_ON_L) // 4
+                for i in range(len(data) // 4):
+                    on = data[4 * i] | data[4 * i + 1] << 8
+                    off = data[4 * i + 2] | data[4 * i + 3] << 8
+                    recorder.events.append((timestamp_ns, self.name, "set_pwm", (first_channel + i, on, off)))
+
+
+class SimPCA9685:
+
+    def __init__(self, address = 0x40):
+        self._device = SimI2CDevice("pca9685")
+        self.frequency = None
+
+
+    def set_pwm_freq(self, freq_hz):
+        self.frequency = freq_hz
+        recorder.record("pca9685", "set_pwm_freq", (freq_hz,))
+
+
+    def set_pwm(self, channel, on, off):
+        register = SimI2CDevice.LED0_ON_L + 4 * channel
+        self._device.registers[register:register + 4] = [on & 0xFF, on >> 8, off & 0xFF, off >> 8]
+        recorder.record("pca9685", "set_pwm", (channel, on, off))
+
+
+    def set_all_pwm(self, on, off):
+        for channel in range(16):
+            self.set_pwm(channel, on, off)
+
+
+# GPIO ------------------------------------------------------------------------------------------------------
+
+class SimPWM:
+
+    def __init__(self, pin, frequency):
+        self.pin = pin
+        self.frequency = frequency
+
+
+    def start(self, duty_cycle):
+        recorder.record("buzzer", "start", (self.pin, self.frequency, duty_cycle))
+
+
+    def stop(self):
+        recorder.record("buzzer", "stop", (self.pin,))
+
+
+    def ChangeFrequency(self, frequency):
+        self.frequency = frequency
+        recorder.record("buzzer", "frequency", (self.pin, frequency))
+
+
+    def ChangeDutyCycle(self, duty_cycle):
+        recorder.record("buzzer", "duty_cycle", (self.pin, duty_cycle))
+
+
+class SimGPIO:  # Mimics the RPi.GPIO module
+
+    BCM = 11
+    BOARD = 10
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+
+    PWM = SimPWM
+
+    @staticmethod
+    def setmode(mode):
+        recorder.record("gpio", "setmode", (mode,))
+
+
+    @staticmethod
+    def setup(pin, mode):
+        recorder.record("gpio", "setup", (pin, mode))
+
+
+    @staticmethod
+    def output(pin, value):
+        recorder.record("gpio", "output", (pin, value))
+
+
+    @staticmethod
+    def cleanup():
+        recorder.record("gpio", "cleanup")
+
+
+class SimButton:    # Mimics gpiozero.Button
+
+    def __init__(self, pin):
+        self.pin = pin
+        self.when_pressed = None
+        self.when_released = None
+        recorder.buttons[pin] = self
+
+
+    def press(self):
+        recorder.record("button", "pressed", (self.pin,))
+        if self.when_pressed != None:
+            self.when_pressed(self)
+
+
+    def release(self):
+        recorder.record("button", "released", (self.pin,))
+        if self.when_released != None:
+            self.when_released(self)
+
+
+# smbus -----------------------------------------------------------------------------------------------------
+
+class SimSMBus:     # Mimics smbus.SMBus, every byte sent to the LCD backpack is recorded
+
+    def __init__(self, port):
+        self.port = port
+
+
+    def write_byte(self, addr, value):
+        recorder.record("smbus", "write_byte", (addr, value))
+
+
+    def write_byte_data(self, addr, cmd, value):
+        recorder.record("smbus", "write_byte_data", (addr, cmd, value))
+
+
+    def write_block_data(self, addr, cmd, data):
+        recorder.record("smbus", "write_block_data", (addr, cmd, list(data)))
+
+
+    def write_i2c_block_data(self, addr, cmd, data):
+        recorder.record("smbus", "write_i2c_block_data", (addr, cmd, list(data)))
+
+
+    def read_byte(self, addr):
+        return 0
+
+
+    def read_byte_data(self, addr, cmd):
+        return 0
+
+
+    def read_block_data(self, addr, cmd):
+        return []
+
+
+# Factories, used by the other modules ----------------------------------------------------------------------
+
+def PCA9685():
+    if is_simulated():
+        return SimPCA9685()
+    import Adafruit_PCA9685
+    return Adafruit_PCA9685.PCA9685()
+
+
+def Button(pin):
+    if is_simulated():
+        return SimButton(pin)
+    from gpiozero import Button
+    return Button(pin)
+
+
+def gpio():
+    if is_simulated():
+        return SimGPIO
+    from RPi import GPIO
+    return GPIO
+
+
+def SMBus(port):
+    if is_simulated():
+        return SimSMBus(port)
+    import smbus
+    return smbus.SMBus(port)
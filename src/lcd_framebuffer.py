@@ -0,0 +1,185 @@
+import threading
+import time
+from contextlib import contextmanager
+
+import I2C_LCD_driver
+
+
+"""
+Shadow framebuffer over I2C_LCD_driver.lcd.
+
+The menu redraws a whole screen for every update: 'lcd_clear', then both lines, one character at a time.
+On the HD44780, each character costs four nibble strobes over I2C, and the clear command stalls the
+controller. FramebufferLcd has the same interface as I2C_LCD_driver.lcd, but only writes into a copy of
+the screen. When the frame is over, this copy is compared with what the LCD currently shows, and only
+the cells which changed are sent, with a cursor move only when they are not contiguous.
+So browsing the menu, or the "Recording N" beat counter, costs a few bytes instead of a full repaint.
+
+    with lcd.frame():
+        lcd.lcd_clear()
+        lcd.lcd_display_string("Recording 3", 1)    # Only the '3' is sent, if "Recording 2" was displayed
+
+Outside of a frame, each call is sent right away.
+
+Once 'start_rendering' has been called, the frames are not sent by the caller anymore, but by a render
+thread. Ending a frame only wakes it up, so a button handler or a metronome tick never waits for the LCD.
+The render thread always sends the latest frame, at most 'max_rate' times per second: a burst of button
+presses or beat ticks produces one repaint instead of a queue of them.
+"""
+
+
+ROW_OFFSETS = [0x00, 0x40, 0x14, 0x54]     # DDRAM address of the first cell of each line
+
+
+class FramebufferLcd:
+
+    def __init__(self, lcd_device, rows = 2, cols = 16):
+        self.lcd_device = lcd_device
+        self.rows = rows
+        self.cols = cols
+        self.screen = self.blank_screen()           # What the LCD displays (it is cleared by its init)
+        self.buffer = self.blank_screen()           # What it should display, once the frame is over
+        self.cursor = None                          # (row, col) of the LCD address counter, None if unknown
+        self.lock = threading.RLock()               # Buttons and metronome callbacks can draw from different threads
+        self.bus_lock = threading.Lock()            # Keeps the byte sequences sent to the LCD whole
+        self.frame_depth = 0
+
+        self.render_thread = None                   # See 'start_rendering'
+        self.render_request = threading.Event()
+        self.render_period = 0
+        self.next_render_time = 0
+        self.message = None                         # (screen, duration) of a temporary message to be rendered
+
+
+    def blank_screen(self):
+        return [[' '] * self.cols for _ in range(self.rows)]
+
+
+    # Sends the frames from a dedicated thread, at most 'max_rate' times per second
+    def start_rendering(self, max_rate = 25):
+        if self.render_thread != None:
+            return
+        self.render_period = 1 / max_rate
+        self.render_thread = threading.Thread(target=self.render_loop, name="lcd", daemon=True)
+        self.render_thread.start()
+
+
+    # Groups the drawing calls, the LCD is only updated once the outermost frame is over
+    @contextmanager
+    def frame(self):
+        with self.lock:
+            self.frame_depth += 1
+            try:
+                yield self
+            finally:
+                self.frame_depth -= 1
+                if self.frame_depth == 0:
+                    if self.render_thread != None:
+                        self.render_request.set()
+                    else:
+                        self.flush()
+
+
+    def lcd_clear(self):
+        with self.frame():
+            for row in self.buffer:
+                row[:] = [' '] * self.cols
+
+
+    def lcd_display_string(self, string, line = 1, pos = 0):
+        with self.frame():
+            self.write_string(self.buffer, string, line, pos)
+
+
+    def write_string(self, screen, string, line, pos):
+        row = screen[line - 1]
+        for col, char in enumerate(string[:max(0, self.cols - pos)], pos):
+            row[col] = char
+
+
+    # Displays some lines for 'duration' seconds, then whatever the frames have drawn in the meantime.
+    # With the render thread, the caller does not wait for the message to be over.
+    def show_message(self, lines, duration):
+        screen = self.blank_screen()
+        for line, string in enumerate(lines, 1):
+            self.write_string(screen, string, line, 0)
+
+        if self.render_thread != None:
+            with self.lock:
+                self.message = (screen, duration)
+            self.render_request.set()
+        else:
+            with self.lock:
+                self.send(self.diff(screen))
+            time.sleep(duration)
+
+
+    # Returns the bytes updating the LCD from 'screen' to 'target', and considers them sent
+    def diff(self, target):
+        data = []
+        for row in range(self.rows):
+            for col in range(self.cols):
+                char = target[row][col]
+                if self.screen[row][col] == char:
+                    continue
+                if self.cursor != (row, col):
+                    data += self.lcd_device.command_bytes(I2C_LCD_driver.LCD_SETDDRAMADDR + ROW_OFFSETS[row] + col)
+                data += self.lcd_device.command_bytes(ord(char), I2C_LCD_driver.Rs)
+                self.screen[row][col] = char
+                self.cursor = (row, col + 1)        # The address counter moves to the right after each character
+        return data
+
+
+    def send(self, data):
+        if data:
+            with self.bus_lock:
+                self.lcd_device.lcd_write_bytes(data)
+
+
+    # Sends the cells which differ from the screen, all at once
+    def flush(self):
+        with self.lock:
+            self.send(self.diff(self.buffer))
+
+
+    def render_loop(self):
+        while True:
+            self.render_request.wait()
+            # The frames ended while waiting are all rendered by the same repaint
+            time.sleep(max(0, self.next_render_time - time.monotonic()))
+
+            with self.lock:
+                self.render_request.clear()
+                message, self.message = self.message, None
+                data = self.diff(message[0] if message != None else self.buffer)
+
+            # Sent outside of the lock, so that the menu can draw the next frame meanwhile
+            try:
+                self.send(data)
+            except Exception as e:
+                print("LCD: render failed {!r}".format(e))
+                self.invalidate()
+
+            hold = 0
+            if message != None:
+                hold = message[1]
+                self.render_request.set()       # The current frame is rendered once the message is over
+            self.next_render_time = time.monotonic() + max(self.render_period, hold)
+
+
+    # Forgets what the LCD displays, so that the whole screen is sent again by the next flush (e.g. after a glitch)
+    def invalidate(self):
+        with self.lock:
+            self.screen = [[None] * self.cols for _ in range(self.rows)]
+            self.cursor = None
+
+
+    def backlight(self, state):
+        with self.bus_lock:
+            self.lcd_device.backlight(state)
+
+
+    def lcd_load_custom_chars(self, fontdata):
+        with self.lock, self.bus_lock:
+            self.lcd_device.lcd_load_custom_chars(fontdata)
+            self.cursor = None      # The address counter now points into the CGRAM
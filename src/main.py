@@ -5,27 +5,52 @@ import metronome as metro       # Manages the metronome
 import servo_manager as sm      # Manages the servo motors
 import tab_manager as tm        # Manages the tabs, creates them, populates them, plays them
 import menu_manager as mm       # Manages the user inputs, browses through the menu, displays info
+import scheduler as sch         # Fires the timed events (notes, end of tab..) from a single thread
 
-import signal
-from RPi import GPIO
+import hardware as hw          # Gives access to the real hardware, or to simulated devices
 
-GPIO.setmode(GPIO.BCM)
+import argparse
+import signal
+import sys
 
 tabs_path = '../tabs'
 pwm_file_path = '../pwm_value.txt'
 
     
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--asyncio", action="store_true", help="Run the menu, metronome and player on a single asyncio event loop")
+    args = parser.parse_args()
+
+    GPIO = hw.gpio()
+    GPIO.setmode(GPIO.BCM)
+
+    runtime = None
+    if args.asyncio:
+        import async_runtime
+        runtime = async_runtime.AsyncRuntime()
+        scheduler = runtime.scheduler
+    else:
+        scheduler = sch.Scheduler()
 
     metronome = metro.Metronome()
     servo_manager = sm.ServoManager(pwm_file_path)
-    tab_manager = tm.TabManager(servo_manager, metronome, tabs_path)
+    tab_manager = tm.TabManager(servo_manager, metronome, scheduler, tabs_path)
 
     menu_manager = mm.MenuManager(metronome, servo_manager, tab_manager)
     
     menu_manager.display_tree()     # Shows the menu tree, useful to debug
-    
-    signal.pause()
+
+    # The service is stopped with SIGTERM, which would kill the process without running the 'finally' below
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    try:
+        if runtime != None:
+            runtime.run(metronome, servo_manager, tab_manager, menu_manager)
+        else:
+            signal.pause()
+    finally:
+        servo_manager.config.flush()    # The servo settings changed in the last seconds are not lost
     
 if __name__ == "__main__":
     main()
@@ -1,12 +1,11 @@
 from anytree import NodeMixin, RenderTree
 import I2C_LCD_driver
+import lcd_framebuffer
 import os
-import threading
-import time
-import guitarpro as pygp
-from threading import Timer
 from enum_classes import PWMEditorState, ServosPositionState, StringsRoutineState, TabCreatorState, SessionRecorderState, TabPlayerState
-from gpiozero import Button
+import hardware as hw
+
+LCD_WIDTH = 16      # Number of characters per line
 
 """
 The menu is based on 'anytree'. The class MenuManager will create the whole menu as a tree,
@@ -76,6 +75,12 @@ class BasicMenuNode(NodeMixin):
         self.lcd_display.lcd_display_string(self.pos_indication, 2)  # LCD line 2
 
 
+    # Updates the display as one frame, for the callbacks which are not triggered by the menu (end of tab, metronome..)
+    def redraw(self):
+        with self.lcd_display.frame():
+            self.update_display()
+
+
     def on_focus(self):
         pass
 
@@ -95,6 +100,16 @@ class TabPlayerNode(BasicMenuNode): # This class will load a tab, (either gp3, g
         self.tab_list = []
         self.tab_manager.set_callback(self.end_tab_callback)
 
+        # The selected tab is compiled once (in the background), and can then be started from any bar without being parsed again.
+        # While it is compiled, it can already be played from the start, streamed bar after bar.
+        self.tab_absolute_path = None
+        self.is_agu_file = False
+        self.timeline = None
+        self.feasibility_report = None
+        self.is_loading = False
+        self.load_id = 0            # Incremented for each tab selected, so that the timeline of a cancelled one is ignored
+        self.start_bar = 1
+
     def next(self):
         if self.state == TabPlayerState.IDLE:
             return super().next()
@@ -102,8 +117,12 @@ class TabPlayerNode(BasicMenuNode): # This class will load a tab, (either gp3, g
             self.tab_index += 1
             if self.tab_index >= len(self.tab_list):
                 self.tab_index = 0
+        elif self.state == TabPlayerState.SELECTING_BAR:
+            self.start_bar += 1
+            if self.start_bar > self.timeline.nb_of_bars:
+                self.start_bar = 1
 
-            return self
+        return self
 
         
     def previous(self):
@@ -113,8 +132,12 @@ class TabPlayerNode(BasicMenuNode): # This class will load a tab, (either gp3, g
             self.tab_index -= 1
             if self.tab_index < 0:
                 self.tab_index = len(self.tab_list) - 1
+        elif self.state == TabPlayerState.SELECTING_BAR:
+            self.start_bar -= 1
+            if self.start_bar < 1:
+                self.start_bar = self.timeline.nb_of_bars
 
-            return self
+        return self
 
 
     def execute(self):
@@ -123,17 +146,28 @@ class TabPlayerNode(BasicMenuNode): # This class will load a tab, (either gp3, g
             if len(self.tab_list) != 0:
                 self.state = TabPlayerState.BROWSING_TAB
             else:
-                self.lcd_display.lcd_clear()
-                self.lcd_display.lcd_display_string("No tabs found!", 1)
-                time.sleep(0.5)
+                self.lcd_display.show_message(["No tabs found!"], 0.5)
 
         elif self.state == TabPlayerState.BROWSING_TAB:
             # Get absolute path, and get if its a gpX or .agu file
-            tab_absolute_path , is_agu_file = self.tab_manager.grab_tab_file_from_node_name(self.tab_list[self.tab_index])
-            if is_agu_file: # If it is, we need to pass some info to the tab manager before playing it (like tempo, beats ..)
-                self.tab_manager.load_tab_info(tab_absolute_path)
-            self.tab_manager.play_tab(tab_absolute_path, is_agu_file)
-            
+            self.tab_absolute_path , self.is_agu_file = self.tab_manager.grab_tab_file_from_node_name(self.tab_list[self.tab_index])
+            if self.is_agu_file: # If it is, we need to pass some info to the tab manager before playing it (like tempo, beats ..)
+                self.tab_manager.load_tab_info(self.tab_absolute_path)
+            self.timeline = None
+            self.is_loading = True
+            self.load_id += 1
+            load_id = self.load_id
+            self.tab_manager.compile_timeline_in_background(self.tab_absolute_path, lambda timeline, report: self.timeline_loaded(load_id, timeline, report))
+            self.state = TabPlayerState.LOADING_TAB
+
+        elif self.state == TabPlayerState.LOADING_TAB: # Not compiled yet: played from the start, streamed
+            self.tab_manager.play_tab(self.tab_absolute_path, self.is_agu_file)
+            self.state = TabPlayerState.PLAYING_TAB
+
+        elif self.state == TabPlayerState.SELECTING_BAR:
+            self.tab_manager.timeline = self.timeline
+            self.tab_manager.feasibility_report = self.feasibility_report
+            self.tab_manager.play_from(self.start_bar, self.is_agu_file)
             self.state = TabPlayerState.PLAYING_TAB
         
         return self
@@ -145,8 +179,14 @@ class TabPlayerNode(BasicMenuNode): # This class will load a tab, (either gp3, g
         elif self.state == TabPlayerState.BROWSING_TAB:
             self.state = TabPlayerState.IDLE
             return self
-        elif self.state == TabPlayerState.PLAYING_TAB:
+        elif self.state in (TabPlayerState.SELECTING_BAR, TabPlayerState.LOADING_TAB):
             self.state = TabPlayerState.BROWSING_TAB
+            self.timeline = None
+            self.is_loading = False
+            self.load_id += 1
+            return self
+        elif self.state == TabPlayerState.PLAYING_TAB:
+            self.state = self.state_after_tab()       # The start bar can be changed, the tab stays loaded
             self.tab_manager.clear_events()
             self.tab_manager.metronome.stop_metronome()
             return self
@@ -158,16 +198,68 @@ class TabPlayerNode(BasicMenuNode): # This class will load a tab, (either gp3, g
             self.lcd_display.lcd_display_string(self.text_to_display, 1)
             self.lcd_display.lcd_display_string(str(self.index + 1) + "/" + str(self.size), 2)
         elif self.state == TabPlayerState.BROWSING_TAB:
-            self.lcd_display.lcd_display_string(str(self.tab_list[self.tab_index]), 1)
-            self.lcd_display.lcd_display_string(str(self.tab_index + 1) + "/" + str(len(self.tab_list)), 2)
+            tab_name = str(self.tab_list[self.tab_index])
+            position = str(self.tab_index + 1) + "/" + str(len(self.tab_list))
+            self.lcd_display.lcd_display_string(tab_name, 1)
+            self.lcd_display.lcd_display_string(position + self.tab_details(tab_name).rjust(LCD_WIDTH - len(position)), 2)
+        elif self.state == TabPlayerState.SELECTING_BAR:
+            position = str(self.start_bar) + "/" + str(self.timeline.nb_of_bars)
+            minutes, seconds = divmod(int(self.timeline.bar_times[self.start_bar - 1]), 60)
+            self.lcd_display.lcd_display_string("Start at bar", 1)
+            self.lcd_display.lcd_display_string(position + "{}:{:02d}".format(minutes, seconds).rjust(LCD_WIDTH - len(position)), 2)
+        elif self.state == TabPlayerState.LOADING_TAB:
+            self.lcd_display.lcd_display_string("Loading tab...", 1)
+            self.lcd_display.lcd_display_string("x: play it", 2)
         elif self.state == TabPlayerState.PLAYING_TAB:
             self.lcd_display.lcd_display_string("Playing tab!", 1)
 
 
+    # Tempo and duration of the tab, e.g. "120bpm 1:53", from the tab library (no file is opened)
+    def tab_details(self, tab_name):
+        info = self.tab_manager.get_tab_info(tab_name)
+        if info == None or info.get("tempo") == None:
+            return ""
+        details = "{:g}bpm".format(info["tempo"])
+        if info.get("duration") != None:
+            minutes, seconds = divmod(int(info["duration"]), 60)
+            details += " {}:{:02d}".format(minutes, seconds)
+        return details
+
+
+    # Called once the selected tab is compiled. A tab being played from the start goes on, and
+    # its start bar can be selected once it is over.
+    def timeline_loaded(self, load_id, timeline, feasibility_report):
+        if load_id != self.load_id:     # Another tab was selected meanwhile
+            return
+        self.is_loading = False
+        if timeline == None or timeline.nb_of_bars == 0:
+            if self.state == TabPlayerState.LOADING_TAB:
+                self.lcd_display.show_message(["Empty tab!" if timeline != None else "Can't load tab!"], 0.5)
+                self.state = TabPlayerState.BROWSING_TAB
+                self.redraw()
+            return
+
+        self.timeline = timeline
+        self.feasibility_report = feasibility_report
+        self.start_bar = 1
+        if self.state == TabPlayerState.LOADING_TAB:
+            self.state = TabPlayerState.SELECTING_BAR
+            self.redraw()
+
+
+    # Once a tab is over: its start bar can be selected if it is compiled
+    def state_after_tab(self):
+        if self.timeline != None:
+            return TabPlayerState.SELECTING_BAR
+        if self.is_loading:
+            return TabPlayerState.LOADING_TAB
+        return TabPlayerState.BROWSING_TAB
+
+
     def end_tab_callback(self):
         print("cqllbqck cqlled")
-        self.state = TabPlayerState.BROWSING_TAB
-        self.update_display()
+        self.state = self.state_after_tab()
+        self.redraw()
 
     
     def on_focus(self):
@@ -184,9 +276,12 @@ class TabPlayerNode(BasicMenuNode): # This class will load a tab, (either gp3, g
 
 
 class StringRoutineNode(BasicMenuNode): # Will trigger back and forth the specified servo, in order for the user to set it easily above the guitar string
+                                        # While the routine runs, 'execute' enters the latency calibration of the string: the servo is triggered
+                                        # along with the metronome click, and next/previous change its latency until both sound together.
     
-    def __init__(self, node_name, index, size, lcd_display, text_to_display, servo_manager, parent = None, children = None):
+    def __init__(self, node_name, index, size, lcd_display, text_to_display, servo_manager, metronome, parent = None, children = None):
         self.servo_manager = servo_manager
+        self.metronome = metronome
         super().__init__(node_name, index, size, lcd_display, text_to_display, parent, children)
         self.is_string_test_running = False
         self.servo_routine_sleep = 0.5
@@ -194,6 +289,9 @@ class StringRoutineNode(BasicMenuNode): # Will trigger back and forth the specif
         self.state = StringsRoutineState.IDLE
         self.string_index = 0
         self.nb_of_strings = 6
+        self.latency_increment = 5      # in ms
+        self.latency = 0
+        self.saved_latency = 0
 
 
     def next(self):
@@ -203,6 +301,8 @@ class StringRoutineNode(BasicMenuNode): # Will trigger back and forth the specif
             self.string_index += 1
             if self.string_index >= self.nb_of_strings:
                 self.string_index = 0
+        elif self.state == StringsRoutineState.CALIBRATING:
+            self.set_latency(self.latency + self.latency_increment)
         return self
 
 
@@ -213,6 +313,8 @@ class StringRoutineNode(BasicMenuNode): # Will trigger back and forth the specif
             self.string_index -= 1
             if self.string_index < 0:
                 self.string_index = self.nb_of_strings- 1
+        elif self.state == StringsRoutineState.CALIBRATING:
+            self.set_latency(max(0, self.latency - self.latency_increment))
         
         return self
 
@@ -223,8 +325,24 @@ class StringRoutineNode(BasicMenuNode): # Will trigger back and forth the specif
         elif self.state == StringsRoutineState.BROWSING:
             self.state = StringsRoutineState.ROUTINE_RUNNING
             self.servo_manager.start_string_routine(self.string_index)
+        elif self.state == StringsRoutineState.ROUTINE_RUNNING:
+            self.state = StringsRoutineState.CALIBRATING
+            self.servo_manager.stop_string_routine()
+            self.saved_latency = self.servo_manager.servos_settings[self.string_index][self.servo_manager.latency_mode]
+            self.latency = self.saved_latency
+            self.servo_manager.start_latency_calibration(self.string_index, self.metronome.beep)
+        elif self.state == StringsRoutineState.CALIBRATING:   # Save the latency in the pwm file
+            self.state = StringsRoutineState.BROWSING
+            self.servo_manager.stop_string_routine()
+            self.servo_manager.update_and_write_pwm_value(self.string_index, self.servo_manager.latency_mode, self.latency)
 
         return self
+
+
+    # The calibration routine reads the latency from the settings, so the change is heard on the next click
+    def set_latency(self, latency):
+        self.latency = latency
+        self.servo_manager.servos_settings[self.string_index][self.servo_manager.latency_mode] = latency
             
 
     def cancel(self):
@@ -235,6 +353,10 @@ class StringRoutineNode(BasicMenuNode): # Will trigger back and forth the specif
         elif self.state == StringsRoutineState.ROUTINE_RUNNING:
             self.servo_manager.stop_string_routine()
             self.state = StringsRoutineState.BROWSING
+        elif self.state == StringsRoutineState.CALIBRATING:  # Leave without saving
+            self.servo_manager.stop_string_routine()
+            self.set_latency(self.saved_latency)
+            self.state = StringsRoutineState.BROWSING
         
         return self
 
@@ -248,6 +370,9 @@ class StringRoutineNode(BasicMenuNode): # Will trigger back and forth the specif
             self.lcd_display.lcd_display_string(str(self.string_index + 1) + "/6", 2)
         elif self.state == StringsRoutineState.ROUTINE_RUNNING:
             self.lcd_display.lcd_display_string("String " + str(self.string_index + 1) + " playing", 1)
+        elif self.state == StringsRoutineState.CALIBRATING:
+            self.lcd_display.lcd_display_string("Latency str. " + str(self.string_index + 1), 1)
+            self.lcd_display.lcd_display_string(str(self.latency) + " ms", 2)
 
 
     def node_type(self):
@@ -302,9 +427,7 @@ class ServosPositionNode(BasicMenuNode): # Set all servos to either, Low, Mid or
             elif self.option_index == 2:
                 self.servo_manager.setAllServosHighPosition()
 
-            self.lcd_display.lcd_clear()
-            self.lcd_display.lcd_display_string("Set !", 1)
-            time.sleep(self.menu_sleeping_time)
+            self.lcd_display.show_message(["Set !"], self.menu_sleeping_time)
        
         return self   
 
@@ -330,11 +453,15 @@ class ServosPositionNode(BasicMenuNode): # Set all servos to either, Low, Mid or
         return "ServosPositionNode"
 
 
-class FreePlayNode(BasicMenuNode): # This node simply provides a metronome
+class FreePlayNode(BasicMenuNode): # This node simply provides a metronome. While it runs, next/previous change its tempo, and
+                                    # execute goes through its patterns (accents, subdivision), back to the plain one at the default tempo
+
+    PATTERNS = (("Plain", [1], 1), ("Eighths", [1], 2), ("Accents 1-3", [1, 3], 1), ("Triplets", [1], 3), ("Sixteenths", [1], 4))
 
     def __init__(self, node_name, index, size, lcd_display, text_to_display, metronome, parent = None, children = None):
         super().__init__(node_name, index, size, lcd_display, text_to_display, parent, children)
         self.metronome = metronome
+        self.pattern_index = 0
         
 
     def next(self):
@@ -357,7 +484,11 @@ class FreePlayNode(BasicMenuNode): # This node simply provides a metronome
         if not self.metronome.is_metronome_active:
             self.metronome.start_metronome()
         else:
-            self.metronome.reset_tempo()
+            self.pattern_index = (self.pattern_index + 1) % len(self.PATTERNS)
+            if self.pattern_index == 0:
+                self.metronome.reset_tempo()
+            _, accents, subdivision = self.PATTERNS[self.pattern_index]
+            self.metronome.set_pattern(accents, subdivision)
         return self
 
 
@@ -373,7 +504,8 @@ class FreePlayNode(BasicMenuNode): # This node simply provides a metronome
         self.lcd_display.lcd_display_string(self.text_to_display, 1)
 
         if self.metronome.is_metronome_active:
-            self.lcd_display.lcd_display_string(str(self.metronome.tempo), 2)
+            tempo = str(self.metronome.tempo)
+            self.lcd_display.lcd_display_string(tempo + self.PATTERNS[self.pattern_index][0].rjust(LCD_WIDTH - len(tempo)), 2)
         else:
             self.lcd_display.lcd_display_string(self.pos_indication, 2)
 
@@ -425,10 +557,7 @@ class TabCreatorNode(BasicMenuNode): # This node creates a tab, asking for a tem
         elif self.state == TabCreatorState.DEFINING_BEATS:
             self.state = TabCreatorState.IDLE
             tab_name = self.tab_manager.create_tab(self.metronome.tempo, self.metronome.beats_per_loop)
-            self.lcd_display.lcd_clear()
-            self.lcd_display.lcd_display_string(tab_name, 1)
-            self.lcd_display.lcd_display_string("Created !", 2)
-            time.sleep(self.menu_sleeping_time)
+            self.lcd_display.show_message([tab_name, "Created !"], self.menu_sleeping_time)
             self.children[0].node_name = str(tab_name)
             self.menu_manager.update_available_tabs()
             return self.children[0]
@@ -598,6 +727,7 @@ class RecorderNode(BasicMenuNode):
             self.state = SessionRecorderState.METRONOME_ON
         elif self.state == SessionRecorderState.METRONOME_ON:
             self.metronome.current_beat = 0 # Reset the beat
+            self.tab_manager.clear_saved_notes()
             self.state = SessionRecorderState.ARMED
         elif self.state == SessionRecorderState.ARMED:
             self.state = SessionRecorderState.IDLE
@@ -642,14 +772,14 @@ class RecorderNode(BasicMenuNode):
         if overflow:
             if self.state == SessionRecorderState.ARMED:
                 self.state = SessionRecorderState.RECORDING
-                self.tab_manager.bar_starting_time = time.time()
+                self.tab_manager.start_recording_bar(self.metronome.beat_time_ns)     # The deadline of the beat, not when this callback runs
             elif self.state == SessionRecorderState.RECORDING:
                 self.tab_manager.process_loop()
                 self.metronome.stop_metronome()
                 self.state = SessionRecorderState.SAVING
         
         if self.state in (SessionRecorderState.ARMED, SessionRecorderState.RECORDING, SessionRecorderState.SAVING):
-            self.update_display()       
+            self.redraw()
     
 
     def update_display(self):
@@ -674,15 +804,7 @@ class RecorderNode(BasicMenuNode):
         tempo, beats, self.nb_of_loops = self.tab_manager.load_tab_info(self.absolute_tab_path)
         self.metronome.tempo = tempo
         self.metronome.beats_per_loop = beats
-        self.servo_manager.set_callback_func(self.servo_callback)
 
-    
-    def servo_callback(self, index):
-        if self.state == SessionRecorderState.ARMED:
-            self.tab_manager.save_note(index, 0)
-        elif self.state == SessionRecorderState.RECORDING:
-            self.tab_manager.save_note(index, 1)
-        
 
     def node_type(self):
         return "SessionRecorderNode"
@@ -732,7 +854,7 @@ class LoopPlayerNode(BasicMenuNode):
         elif self.state == SessionRecorderState.PLAYER_SELECTION_END:
             if self.nb_of_loops != 0: 
                 self.state = SessionRecorderState.PLAYER_ON
-                self.tab_manager.play_tab(self.absolute_tab_path, True,  self.start_at_loop, self.end_after_loop)
+                self.tab_manager.loop_tab(self.absolute_tab_path, True, self.start_at_loop, self.end_after_loop)
         return self
 
 
@@ -757,7 +879,7 @@ class LoopPlayerNode(BasicMenuNode):
 
     def end_tab_callback(self):
         self.state = SessionRecorderState.PLAYER_SELECTION_END
-        self.update_display()
+        self.redraw()
 
 
     def update_display(self):
@@ -772,7 +894,58 @@ class LoopPlayerNode(BasicMenuNode):
             self.lcd_display.lcd_display_string("From:       To:", 1)
             self.lcd_display.lcd_display_string(str(self.start_at_loop) + "    " + str(self.end_after_loop), 2)
         elif self.state == SessionRecorderState.PLAYER_ON:
-            self.lcd_display.lcd_display_string("PLAYING !", 1)
+            self.lcd_display.lcd_display_string("LOOPING !", 1)
+            self.lcd_display.lcd_display_string(str(self.start_at_loop) + " -> " + str(self.end_after_loop), 2)
+
+
+class OverdubNode(LoopPlayerNode): # Plays a section of the tab in loop, and records a new layer over it
+
+    def __init__(self, node_name, index, size, lcd_display, text_to_display, tab_manager, parent=None, children=None):
+        super().__init__(node_name, index, size, lcd_display, text_to_display, tab_manager, parent=parent, children=children)
+        self.nb_of_new_notes = 0
+
+
+    def execute(self):
+        if self.state == SessionRecorderState.PLAYER_SELECTION_START:
+            if self.nb_of_loops != 0:
+                self.state = SessionRecorderState.PLAYER_SELECTION_END
+        elif self.state == SessionRecorderState.PLAYER_SELECTION_END:
+            self.state = SessionRecorderState.OVERDUBBING
+            self.tab_manager.start_overdub(self.absolute_tab_path, self.start_at_loop, self.end_after_loop)
+        elif self.state == SessionRecorderState.OVERDUB_SAVING:
+            self.tab_manager.save_overdub(os.path.dirname(self.absolute_tab_path))
+            self.lcd_display.show_message(["Layer saved", str(self.nb_of_new_notes) + " notes"], 1)
+            self.state = SessionRecorderState.PLAYER_SELECTION_START
+        return self
+
+
+    def cancel(self):
+        if self.state == SessionRecorderState.OVERDUBBING:
+            self.nb_of_new_notes = self.tab_manager.stop_overdub()
+            self.state = SessionRecorderState.OVERDUB_SAVING
+            return self
+        elif self.state == SessionRecorderState.OVERDUB_SAVING:
+            self.tab_manager.save_overdub(os.path.dirname(self.absolute_tab_path), save = False)
+            self.state = SessionRecorderState.PLAYER_SELECTION_START
+            return self
+        return super().cancel()
+
+
+    def update_display(self):
+        if self.state == SessionRecorderState.OVERDUBBING:
+            self.lcd_display.lcd_clear()
+            self.lcd_display.lcd_display_string("OVERDUB", 1)
+            self.lcd_display.lcd_display_string(str(self.start_at_loop) + " -> " + str(self.end_after_loop), 2)
+        elif self.state == SessionRecorderState.OVERDUB_SAVING:
+            self.lcd_display.lcd_clear()
+            self.lcd_display.lcd_display_string("Save layer ?", 1)
+            self.lcd_display.lcd_display_string(str(self.nb_of_new_notes) + " notes", 2)
+        else:
+            super().update_display()
+
+
+    def node_type(self):
+        return "OverdubNode"
 
 
 class SessionNode(BasicMenuNode):
@@ -787,9 +960,9 @@ class SessionNode(BasicMenuNode):
         #define 3 children nodes
         self.recorder_node = RecorderNode("recorder", 0, 3, self.lcd_display, "Recorder", self.metronome, self.servo_manager, self.tab_manager, self)
         self.player_node = LoopPlayerNode("Player", 1, 3, self.lcd_display, "Player", self.tab_manager, self)
-        #self.options_node = TabOptionNode("Option", 2, 3, self.lcd_display, "Options", self.tab_manager, self)
+        self.overdub_node = OverdubNode("Overdub", 2, 3, self.lcd_display, "Overdub", self.tab_manager, self)
 
-        self.node_list = ["Recorder", "Player", "Options"]
+        self.node_list = ["Recorder", "Player", "Overdub"]
         self.cursor = 0
 
 
@@ -871,14 +1044,16 @@ class MenuManager:
         self.servo_manager = servo_manager
         self.tab_manager = tab_manager
 
-        self.lcd_display = I2C_LCD_driver.lcd() 
-        self.menu_sleeping_time = 1.2 # The time needed to display some useful information
+        self.lcd_display = lcd_framebuffer.FramebufferLcd(I2C_LCD_driver.lcd())   # Only sends the characters which changed
+        self.lcd_display.start_rendering()      # The LCD is updated by its own thread, the inputs never wait for it
+        self.menu_sleeping_time = 1.2 # How long some useful information is displayed
+        self.dispatch = None          # Set by the asyncio runtime, to handle the inputs one after the other in the ui executor
 
         self.root_node = BasicMenuNode("Root", 0, 1, self.lcd_display, "Root")    # Root node
 
         self.play_tab_node = TabPlayerNode("play_tab_node", 0, 5, self.lcd_display, "Play Tab", self.tab_manager, self.root_node)
         self.practice_node = BasicMenuNode("practice_node", 1, 5, self.lcd_display, "Practice", self.root_node)
-        self.string_routine_node = StringRoutineNode("string_test_node", 2, 5, self.lcd_display, "String Routine", self.servo_manager, self.root_node)
+        self.string_routine_node = StringRoutineNode("string_test_node", 2, 5, self.lcd_display, "String Routine", self.servo_manager, self.metronome, self.root_node)
         self.servo_pos_node = ServosPositionNode("motor_pos_node", 3, 5, self.lcd_display, "Servo Position", self.servo_manager, self.menu_sleeping_time, self.root_node)
         self.pwm_editor_node = PwmEditorNode("pwm_editor_node", 4, 5, self.lcd_display, "Change PWM value", self.servo_manager, self.root_node)
 
@@ -904,10 +1079,17 @@ class MenuManager:
         btn_execute =27             #
         btn_cancel = 22             #
 
-        Button(btn_next).when_pressed = lambda x: self.next()
-        Button(btn_previous).when_pressed = lambda x: self.previous()
-        Button(btn_execute).when_pressed = lambda x: self.execute()
-        Button(btn_cancel).when_pressed = lambda x: self.cancel()
+        hw.Button(btn_next).when_pressed = lambda x: self.handle_input(self.next)
+        hw.Button(btn_previous).when_pressed = lambda x: self.handle_input(self.previous)
+        hw.Button(btn_execute).when_pressed = lambda x: self.handle_input(self.execute)
+        hw.Button(btn_cancel).when_pressed = lambda x: self.handle_input(self.cancel)
+
+
+    def handle_input(self, action):
+        if self.dispatch != None:
+            self.dispatch(action)
+        else:
+            action()
 
 
     def get_current_node(self):
@@ -964,7 +1146,7 @@ class MenuManager:
     
 
     def update_display(self):
-        self.current_node.update_display()
+        self.current_node.redraw()
 
 
     def display_tree(self):
@@ -1,13 +1,27 @@
-from threading import Timer
-from RPi import GPIO
-from time import sleep
+import hardware as hw
+import scheduler as sch
+
+
+"""
+The metronome ticks on an absolute grid: the beat n is due at origin + n * period, in time.monotonic_ns()
+units, the clock of the schedulers. Each tick schedules the next one at the deadline computed from the
+origin, not from the time it actually ran, so a late tick never delays the following ones and the beats
+do not drift. 'sync_to' moves the origin, e.g. on the start of the tab being played, so that the beats
+stay in phase with its notes.
+
+Each beat can be divided in 'subdivision' ticks, and the beats listed in 'accents' (starting at 1) beep
+higher than the others:
+    metronome.set_pattern(accents = [1, 3], subdivision = 2)    # Eighth notes, accents on 1 and 3
+"""
 
 
 class Metronome():
     SEC_IN_MIN = 60
     DEFAULT_TEMPO = 60
+    DEFAULT_BEATS_PER_LOOP = 4
+    LATE_TICK_TOLERANCE = 0.25      # When syncing, a beat late by less than this part of a period is still played
 
-    def __init__(self):
+    def __init__(self, scheduler = None):
         self.tempo = 60
         self.beats_per_loop = 4
         self.tempo_factor = 5
@@ -15,13 +29,35 @@ class Metronome():
         self.is_metronome_active = False
         self.current_beat = 0
 
+        GPIO = hw.gpio()
         buzzer_pin = 12
         GPIO.setup(buzzer_pin, GPIO.OUT)
-        buzzer_freq = 440
+        self.buzzer_freq = 440
+        self.accent_freq = 880
+        self.subdivision_freq = 330
 
-        self.buzzer_pwm = GPIO.PWM(buzzer_pin, buzzer_freq)
+        self.buzzer_pwm = GPIO.PWM(buzzer_pin, self.buzzer_freq)
         self.buzzer_duration = 0.07
 
+        self.accents = [1]          # Beats of the loop which are accented
+        self.subdivision = 1        # Ticks per beat
+
+        # The ticks have their own scheduler (one thread for all of them), so that clearing a tab does not cancel them.
+        # The asyncio runtime replaces it by a scheduler of its event loop (see async_runtime.py); the beats callbacks
+        # then go through the ui queue, and the beeps to their own executor.
+        self.scheduler = scheduler if scheduler != None else sch.Scheduler()
+        self.dispatch = None
+        self.beep_dispatch = None
+
+        self.func = None
+        self.origin_ns = 0          # Deadline of the beat 0
+        self.period_ns = 0          # Between two beats
+        self.nb_of_beats = None     # The metronome stops by itself after this number of beats, if not None
+        self.generation = 0         # Incremented when stopping or syncing, so that the pending tick is dropped
+        self.tick_time_ns = 0       # Deadline of the last tick
+        self.beat_time_ns = 0       # Deadline of the last beat
+        self.beep_id = 0            # Incremented by each beep, see 'end_beep'
+
 
     @property
     def is_metronome_active(self):
@@ -86,32 +122,102 @@ class Metronome():
         self.beats_per_loop = self.DEFAULT_BEATS_PER_LOOP
 
 
-    def start_metronome(self, func = None):
+    def set_pattern(self, accents = None, subdivision = 1):
+        self.accents = accents if accents != None else [1]
+        self.subdivision = max(1, subdivision)
+
+
+    def beat_period_ns(self):
+        return int(self.SEC_IN_MIN * 1e9 / self.tempo)
+
+
+    # Starts ticking, from 'origin_ns' (in time.monotonic_ns() units) if given, otherwise right now.
+    # 'func(overflow)' is called on each beat. The metronome stops by itself after 'nb_of_beats' beats, if given.
+    def start_metronome(self, func = None, origin_ns = None, nb_of_beats = None):
         if not self.is_metronome_active:
             self.current_beat = 0
+            self.func = func
+            self.nb_of_beats = nb_of_beats
             self.is_metronome_active = True
-            self.metronome_thread(func)
+            self.sync_to(origin_ns if origin_ns != None else self.scheduler.now_ns())
 
 
     def stop_metronome(self):
         self.is_metronome_active = False
+        self.generation += 1
 
 
-    def metronome_thread(self, func = None):
-        if self.is_metronome_active:
-            overflow = False    # overflow is true when it reaches the last beat of the loop, and get back to 1
-            timer = self.SEC_IN_MIN / self.tempo
-            Timer(timer, self.metronome_thread, [func]).start()
-
-            self.current_beat += 1
-            if self.current_beat > self.beats_per_loop:
-                self.current_beat = 1
-                overflow = True
-
-            if func != None:
-                func(overflow)
-
-            self.buzzer_pwm.start(50) # Duty cycle, between 0 and 100
-            sleep(self.buzzer_duration)
+    # Phase-locks the beats on another clock: the beat n is now due at origin_ns + n * period.
+    # The next tick is the first beat of this grid which is not past.
+    def sync_to(self, origin_ns):
+        self.generation += 1
+        self.origin_ns = origin_ns
+        self.period_ns = self.beat_period_ns()
+        if not self.is_metronome_active:
+            return
+
+        late_ns = self.scheduler.now_ns() - origin_ns - int(self.period_ns * self.LATE_TICK_TOLERANCE)
+        beat_index = max(0, -(-late_ns // self.period_ns))
+        self.scheduler.schedule_at(origin_ns + beat_index * self.period_ns, self.tick, [self.generation, beat_index, 0])
+
+
+    # The tick 'sub_index' of the beat 'beat_index', counted from the origin
+    def tick(self, generation, beat_index, sub_index):
+        if generation != self.generation or not self.is_metronome_active:
+            return
+
+        beat_ns = self.origin_ns + beat_index * self.period_ns
+        if sub_index == 0:
+            period_ns = self.beat_period_ns()
+            if period_ns != self.period_ns:     # The tempo changed: the next beats are counted from this one
+                self.origin_ns = beat_ns - beat_index * period_ns
+                self.period_ns = period_ns
+        subdivision = self.subdivision
+        self.tick_time_ns = beat_ns + sub_index * self.period_ns // subdivision
+
+        # The next tick is scheduled first, from the grid, whatever the callbacks below take
+        next_beat, next_sub = (beat_index, sub_index + 1) if sub_index + 1 < subdivision else (beat_index + 1, 0)
+        if self.nb_of_beats == None or next_beat < self.nb_of_beats:
+            next_tick_ns = self.origin_ns + next_beat * self.period_ns + next_sub * self.period_ns // subdivision
+            self.scheduler.schedule_at(next_tick_ns, self.tick, [generation, next_beat, next_sub])
+        else:
+            self.is_metronome_active = False
+
+        if sub_index != 0:
+            self.click(self.subdivision_freq)
+            return
+
+        self.beat_time_ns = beat_ns
+        overflow = False    # overflow is true when it reaches the last beat of the loop, and get back to 1
+        self.current_beat += 1
+        if self.current_beat > self.beats_per_loop:
+            self.current_beat = 1
+            overflow = True
+
+        self.click(self.accent_freq if self.current_beat in self.accents else self.buzzer_freq)
+
+        if self.func != None:
+            if self.dispatch != None:
+                self.dispatch(self.func, overflow)
+            else:
+                self.func(overflow)
+
+
+    def click(self, frequency):
+        if self.beep_dispatch != None:
+            self.beep_dispatch(lambda: self.beep(frequency))
+        else:
+            self.beep(frequency)
+
+
+    # Starts the buzzer, and schedules its stop: the caller (a tick, a beat callback..) never waits for the beep
+    def beep(self, frequency = None):
+        self.beep_id += 1
+        self.buzzer_pwm.ChangeFrequency(frequency if frequency != None else self.buzzer_freq)
+        self.buzzer_pwm.start(50) # Duty cycle, between 0 and 100
+        self.scheduler.schedule(self.buzzer_duration, self.end_beep, [self.beep_id])
+
+
+    def end_beep(self, beep_id):
+        if beep_id == self.beep_id:     # Otherwise, another beep started meanwhile and stops the buzzer itself
             self.buzzer_pwm.stop()
-
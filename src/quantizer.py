@@ -0,0 +1,144 @@
+import argparse
+import os
+import shutil
+
+import numpy as np
+
+import timeline as tl
+
+
+"""
+Quantization of the recorded loops.
+
+The notes are moved towards the closest line of a grid, all at once with numpy, whether it is the notes of
+one bar being recorded or those of a whole tab:
+    - grid:     "1/4", "1/8", "1/16", "1/32", or the triplets "1/8T", "1/16T" (the beat being a quarter note)
+    - strength: 1 puts the notes on the grid, 0.5 halves their distance to it, 0 leaves them as played
+    - swing:    delays every other line of a straight grid, up to a triplet feel at 1
+A note closer to the end of its loop than to the last line of the grid is moved to the start of the loop,
+as the loop is played over and over. Then two notes of a string falling on the same line are merged.
+
+The recorder quantizes each bar when it is recorded (see TabManager.process_loop). A tab recorded before can be
+quantized again, its loop files being kept in a backup directory first:
+    python3 quantizer.py ../tabs/tab_1 --grid 1/16 --strength 0.8 --swing 0.3
+"""
+
+
+GRIDS = {"1/4": 1, "1/8": 1 / 2, "1/16": 1 / 4, "1/32": 1 / 8, "1/8T": 1 / 3, "1/16T": 1 / 6}     # In beats
+TRIPLET_GRIDS = ("1/8T", "1/16T")
+BACKUP_DIR = "unquantized"
+
+
+# Returns the quantized times, 'times' being an array of times in beats, and 'bar_starts' the start of the bar of
+# each note (in beats too), from which the lines are counted for the swing
+def quantize_times(times, grid = "1/16", strength = 1.0, swing = 0.0, bar_starts = 0):
+    if grid not in GRIDS:
+        raise ValueError("Unknown grid {}, must be one of {}".format(grid, ", ".join(GRIDS)))
+    step = GRIDS[grid]
+    times = np.asarray(times, dtype=np.float64)
+
+    # The two lines around each note, the odd ones of the bar being delayed by the swing (up to a third of a step),
+    # so that the swing is the same in every bar, even with an odd number of lines per bar
+    lines = np.floor(times / step) + np.array([[0], [1]])
+    positions = lines * step
+    if swing and grid not in TRIPLET_GRIDS:
+        bar_lines = lines - np.round(np.asarray(bar_starts, dtype=np.float64) / step)
+        positions += (bar_lines % 2 == 1) * (swing * step / 3)
+
+    closest = positions[np.argmin(np.abs(positions - times), axis=0), np.arange(times.size)]
+    return times + strength * (closest - times)
+
+
+# Quantizes the notes of several loops at once. 'bars' gives the loop of each note (starting at 0), and 'positions'
+# its time as a fraction of the loop. Returns the (bars, strings, positions) arrays of the notes left, sorted.
+def quantize_loops(bars, strings, positions, beats, grid = "1/16", strength = 1.0, swing = 0.0):
+    bars = np.asarray(bars, dtype=np.int64)
+    strings = np.asarray(strings, dtype=np.int64)
+    times = (bars + np.asarray(positions, dtype=np.float64)) * beats
+
+    # The notes pushed past the end of their loop are wrapped to its start
+    offsets = np.mod(quantize_times(times, grid, strength, swing, bars * beats) - bars * beats, beats)
+    positions = np.round(offsets / beats, 9)
+    positions[positions >= 1.0] = 0.0       # Rounded up to the end of the loop
+
+    order = np.lexsort((strings, positions, bars))
+    bars, strings, positions = bars[order], strings[order], positions[order]
+    duplicate = np.zeros(bars.size, dtype=bool)
+    duplicate[1:] = (bars[1:] == bars[:-1]) & (strings[1:] == strings[:-1]) & (positions[1:] == positions[:-1])
+    return bars[~duplicate], strings[~duplicate], positions[~duplicate]
+
+
+# Quantizes the (string, time) notes of one bar, time being in seconds. Returns them the same way, sorted by time.
+def quantize_bar(notes, bar_duration, beats, grid = "1/16", strength = 1.0, swing = 0.0):
+    if not notes:
+        return []
+    strings, times = zip(*notes)
+    _, strings, positions = quantize_loops(np.zeros(len(notes)), strings, np.array(times) / bar_duration, beats, grid, strength, swing)
+    return [(int(string), float(position) * bar_duration) for string, position in zip(strings, positions)]
+
+
+def read_loop_file(loop_path):
+    notes = []
+    with open(loop_path) as loop_file:
+        for note in loop_file:
+            if note.strip():
+                string, position = note.split(',')
+                notes.append((int(string), float(position)))
+    return notes
+
+
+def write_loop_file(loop_path, strings, positions):
+    with open(loop_path, 'w') as loop_file:
+        for string, position in zip(strings, positions):
+            loop_file.write(str(int(string)) + "," + str(float(position)) + '\n')
+
+
+# Quantizes every loop of a tab directory (Meta.agu + Loop_X files) in one pass.
+# The original loop files are first copied into 'tab_dir/unquantized', unless they already were.
+# Returns the number of notes before and after the quantization.
+def quantize_tab_dir(tab_dir, grid = "1/16", strength = 1.0, swing = 0.0, dry_run = False):
+    meta_path = os.path.join(tab_dir, tl.META_TAB_FILE)
+    tempo, beats, loop_names = tl.read_agu_meta(meta_path)
+
+    bars, strings, positions = [], [], []
+    for bar, loop_name in enumerate(loop_names):
+        for string, position in read_loop_file(os.path.join(tab_dir, loop_name)):
+            bars.append(bar)
+            strings.append(string)
+            positions.append(position)
+
+    nb_of_notes = len(bars)
+    bars, strings, positions = quantize_loops(bars, strings, positions, beats, grid, strength, swing)
+    if dry_run:
+        return nb_of_notes, bars.size
+
+    backup_dir = os.path.join(tab_dir, BACKUP_DIR)
+    if not os.path.exists(backup_dir):
+        os.makedirs(backup_dir)
+        for loop_name in loop_names:
+            shutil.copy2(os.path.join(tab_dir, loop_name), backup_dir)
+
+    bounds = np.searchsorted(bars, np.arange(len(loop_names) + 1))
+    for bar, loop_name in enumerate(loop_names):
+        first, last = bounds[bar], bounds[bar + 1]
+        write_loop_file(os.path.join(tab_dir, loop_name), strings[first:last], positions[first:last])
+    os.utime(meta_path)     # So that the tab library reads the tab again
+    return nb_of_notes, bars.size
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("tab_dirs", nargs="+", help="Tab directories (Meta.agu + Loop_X files) to quantize")
+    parser.add_argument("--grid", "-g", default="1/16", choices=list(GRIDS))
+    parser.add_argument("--strength", "-s", type=float, default=1.0, help="From 0 (unchanged) to 1 (on the grid)")
+    parser.add_argument("--swing", type=float, default=0.0, help="From 0 (straight) to 1 (triplet feel)")
+    parser.add_argument("--dry-run", "-n", action="store_true", help="Only print what would be done")
+    args = parser.parse_args()
+
+    for tab_dir in args.tab_dirs:
+        nb_of_notes, nb_left = quantize_tab_dir(tab_dir, args.grid, args.strength, args.swing, args.dry_run)
+        print("{}: {} notes quantized to {}, {} merged".format(tab_dir, nb_of_notes, args.grid, nb_of_notes - nb_left))
+
+
+if __name__ == "__main__":
+    main()
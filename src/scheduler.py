@@ -0,0 +1,168 @@
+import heapq
+import itertools
+import threading
+import time
+
+
+class Scheduler:
+    """
+    Runs timed callbacks from one dedicated thread.
+
+    Instead of creating one threading.Timer per note, every event is pushed into a heap sorted by
+    its deadline (in nanoseconds, from time.monotonic_ns()). A single thread sleeps until the
+    earliest deadline, fires the callback, and goes back to sleep. So the number of threads stays
+    the same, no matter how many notes the tab contains.
+
+    A whole tab can also be played from a 'source': an iterator of (time, func, args), roughly sorted
+    by time. The events are pulled from it lazily, only 'lookahead' seconds before they are due, so the
+    first note is played while the next measures are still being produced, and only a small window
+    of events is kept in memory. If the source raises (a broken tab..), it is dropped and its 'on_error'
+    callback is run, so that the player knows the tab is over.
+    """
+
+    def __init__(self, lookahead = 0.5):
+        self.events = []                            # Heap of (deadline_ns, sequence, func, args)
+        self.sequence = itertools.count()           # Keeps events with the same deadline in insertion order
+        self.condition = threading.Condition()
+        self.start_time_ns = 0                      # Reference time of the events scheduled with 'start' or 'play'
+        self.lookahead_ns = int(lookahead * 1e9)
+
+        self.source = None                          # Iterator of (time, func, args), see 'play'
+        self.source_next = None                     # Next event of the source, already pulled but not scheduled yet
+        self.source_error = None                    # Called (without argument) if the source raises
+        self.generation = 0                         # Incremented by 'clear', so that a source being pulled is dropped
+
+        self.thread = threading.Thread(target=self.run, name="scheduler", daemon=True)
+        self.thread.start()
+
+
+    def now_ns(self):
+        return time.monotonic_ns()
+
+
+    # Schedules a list of (time, func, args) tuples, time being in seconds from now.
+    # The list is heapified at once, which is much cheaper than pushing the events one by one.
+    def start(self, events):
+        with self.condition:
+            self.start_time_ns = self.now_ns()
+            for time_s, func, args in events:
+                self.events.append((self.start_time_ns + int(time_s * 1e9), next(self.sequence), func, args))
+            heapq.heapify(self.events)
+            self.condition.notify()
+
+
+    # Plays the events of an iterator of (time, func, args), time being in seconds from now.
+    # The iterator must be sorted by time, give or take the lookahead. 'on_error' is called if it raises.
+    def play(self, source, on_error = None):
+        with self.condition:
+            self.start_time_ns = self.now_ns()
+            self.source = iter(source)
+            self.source_next = None
+            self.source_error = on_error
+            self.generation += 1
+            self.condition.notify()
+
+
+    # Schedules one callback, 'delay' seconds from now
+    def schedule(self, delay, func, args = None):
+        self.schedule_at(self.now_ns() + int(delay * 1e9), func, args)
+
+
+    # Schedules one callback at an absolute deadline, in time.monotonic_ns() units
+    def schedule_at(self, deadline_ns, func, args = None):
+        with self.condition:
+            heapq.heappush(self.events, (deadline_ns, next(self.sequence), func, args or []))
+            self.condition.notify()
+
+
+    # Cancels every pending event, and the source being played. An event already running is not interrupted.
+    def clear(self):
+        with self.condition:
+            self.events.clear()
+            self.source = None
+            self.source_next = None
+            self.source_error = None
+            self.generation += 1
+            self.condition.notify()
+
+
+    def pending_events(self):
+        with self.condition:
+            return len(self.events)
+
+
+    # Moves the events of the source which are due within the lookahead into the heap.
+    # The source is iterated outside of the lock, as producing the events can be slow (parsing a tab..)
+    def pull_source(self):
+        with self.condition:
+            source = self.source
+            pending = self.source_next
+            generation = self.generation
+            start_time_ns = self.start_time_ns
+            on_error = self.source_error
+        if source is None:
+            return
+
+        horizon_ns = self.now_ns() + self.lookahead_ns
+        pulled = []
+        failed = False
+        while True:
+            if pending is None:
+                try:
+                    pending = next(source, None)
+                except Exception as e:      # A broken tab must not stop the scheduler thread
+                    print("Scheduler: source {} raised {!r}".format(source, e))
+                    pending = None
+                    failed = True
+                if pending is None:
+                    break
+            deadline_ns = start_time_ns + int(pending[0] * 1e9)
+            if deadline_ns > horizon_ns:
+                break
+            pulled.append((deadline_ns, pending[1], pending[2]))
+            pending = None
+
+        with self.condition:
+            if generation != self.generation:      # Cleared in the meantime
+                return
+            for deadline_ns, func, args in pulled:
+                heapq.heappush(self.events, (deadline_ns, next(self.sequence), func, args))
+            self.source_next = pending
+            if pending is None:
+                self.source = None
+                self.source_error = None
+
+        if failed and on_error != None:     # Run outside of the lock, as it usually clears the scheduler
+            self.run_event(on_error, [])
+
+
+    def run(self):
+        while True:
+            self.pull_source()
+
+            with self.condition:
+                wait_ns = None
+                if self.events:
+                    wait_ns = self.events[0][0] - self.now_ns()
+                if self.source_next is not None:
+                    pull_in_ns = self.start_time_ns + int(self.source_next[0] * 1e9) - self.lookahead_ns - self.now_ns()
+                    wait_ns = pull_in_ns if wait_ns is None else min(wait_ns, pull_in_ns)
+
+                if wait_ns is None or wait_ns > 0:
+                    if not (self.source is not None and self.source_next is None):    # A new source is waiting to be pulled
+                        self.condition.wait(None if wait_ns is None else wait_ns / 1e9)
+                    continue
+
+                if not self.events or self.events[0][0] > self.now_ns():
+                    continue
+                deadline_ns, _, func, args = heapq.heappop(self.events)
+
+            # The callback is run outside of the lock, so it can itself schedule or clear events
+            self.run_event(func, args)
+
+
+    def run_event(self, func, args):
+        try:
+            func(*args)
+        except Exception as e:
+            print("Scheduler: event {} raised {!r}".format(func, e))
@@ -0,0 +1,125 @@
+import atexit
+import os
+import threading
+
+
+"""
+Settings of the servos, kept in memory and written back to the pwm file (../pwm_value.txt).
+
+The pwm file has one line per string. Its columns are given by a header line, so that new settings can be
+added without breaking the files written before (the missing columns take their default value):
+    # Any comment line, kept as is
+    #fields:low,mid,high,latency,channel,travel
+    -80,280,90,0,0,80
+    ...
+A file without header has the columns low,mid,high,latency, in this order.
+    - low, high:    offsets from the mid position, in PCA9685 ticks
+    - mid:          mid position, in PCA9685 ticks
+    - latency:      time the servo takes to pluck the string, in ms (see ServoManager.get_latency)
+    - channel:      channel of the PCA9685 the servo is plugged on
+    - travel:       shortest time between two strikes of the servo, in ms (see feasibility.py)
+
+Changing a value only changes the memory: the file is written 'write_delay' seconds after the last change,
+so that scrolling through the values does not write the SD card at each step. It is written into a
+temporary file, which then replaces the pwm file, so that a crash during the write can't corrupt it.
+The pending changes are also written when quitting: main.py flushes the config on its way out, SIGTERM included.
+"""
+
+
+FIELDS = ("low", "mid", "high", "latency", "channel", "travel")
+LEGACY_FIELDS = ("low", "mid", "high", "latency")
+DEFAULTS = {"low": -40, "mid": 255, "high": 40, "latency": 0, "travel": 80}     # The channel defaults to the string index
+HEADER_PREFIX = "#fields:"
+
+
+class ServoConfig:
+
+    def __init__(self, path, nb_of_strings = 6, write_delay = 2):
+        self.path = path
+        self.nb_of_strings = nb_of_strings
+        self.write_delay = write_delay
+        self.settings = [self.default_settings(string) for string in range(nb_of_strings)]     # One list of FIELDS per string
+        self.comments = []
+
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()      # The timer and the flush when quitting may write at the same time
+        self.timer = None               # Pending write, see 'set'
+        self.dirty = False
+        atexit.register(self.flush)     # The changes of the last seconds are not lost when quitting
+
+
+    def default_settings(self, string):
+        return [DEFAULTS.get(field, string) for field in FIELDS]
+
+
+    def field_index(self, field):
+        return field if isinstance(field, int) else FIELDS.index(field)
+
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+
+        with open(self.path) as pwm_file:
+            lines = pwm_file.readlines()
+
+        fields = LEGACY_FIELDS
+        comments = []
+        values = []
+        for line in lines:
+            line = line.strip()
+            if line.startswith(HEADER_PREFIX):
+                fields = [field.strip() for field in line[len(HEADER_PREFIX):].split(',')]
+            elif line.startswith('#'):
+                comments.append(line)
+            elif line:
+                values.append(line.split(','))
+
+        with self.lock:
+            self.comments = comments
+            for string, row in enumerate(values[:self.nb_of_strings]):
+                # Whatever the order of the columns in the file, the settings are kept in the order of FIELDS
+                for field, value in zip(fields, row):
+                    if field in FIELDS:
+                        self.settings[string][FIELDS.index(field)] = int(value)
+
+
+    def get(self, string, field):
+        return self.settings[string][self.field_index(field)]
+
+
+    # Changes a value in memory, and (re)starts the timer writing the file
+    def set(self, string, field, value):
+        with self.lock:
+            self.settings[string][self.field_index(field)] = value
+            self.dirty = True
+            if self.timer != None:
+                self.timer.cancel()
+            self.timer = threading.Timer(self.write_delay, self.flush)
+            self.timer.start()
+
+
+    # Writes the settings now, if they changed. The values are copied under 'lock', so that they can still be
+    # changed while the file is written, but 'write_lock' is held from the copy to the replace, so that two writes
+    # never share the temporary file, and an older copy can't replace a newer one.
+    def flush(self):
+        with self.write_lock:
+            with self.lock:
+                if self.timer != None:
+                    self.timer.cancel()
+                    self.timer = None
+                if not self.dirty:
+                    return
+                lines = self.comments + [HEADER_PREFIX + ",".join(FIELDS)]
+                lines += [",".join(str(value) for value in row) for row in self.settings]
+                self.dirty = False
+
+            tmp_path = self.path + ".tmp"
+            try:
+                with open(tmp_path, 'w') as pwm_file:
+                    pwm_file.write("\n".join(lines) + "\n")
+                    pwm_file.flush()
+                    os.fsync(pwm_file.fileno())
+                os.replace(tmp_path, self.path)
+            except OSError as e:
+                print("Could not write the servo settings: {}".format(e))
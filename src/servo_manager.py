@@ -1,10 +1,17 @@
-import Adafruit_PCA9685
-from gpiozero import Button
-import os
+import capture
+import hardware as hw
+import servo_config
 import threading
 import time
 
 
+# PCA9685 registers, used to write several channels in a single I2C transaction
+MODE1 = 0x00
+AUTO_INCREMENT = 0x20       # MODE1 bit: the register address is incremented after each byte
+LED0_ON_L = 0x06            # Each channel has 4 registers: ON_L, ON_H, OFF_L, OFF_H
+REGISTERS_PER_CHANNEL = 4
+
+
 class ServoManager():
 
     def __init__(self, pwm_file_path):
@@ -12,24 +19,27 @@ class ServoManager():
         self.servo_low_position=[True, True, True, True, True, True]     # Keeps track of the 6 servos positions, LOW or HIGH
 
         self.callback = None    # Function to call when one servo is triggered (used when recording)
+        self.capture = capture.CaptureRing()    # Timestamps of the buttons presses, drained by the recorder
         
-        self.pwm_16_channel_module = Adafruit_PCA9685.PCA9685()          # Instance which controls the 16-channels PWM module
+        self.pwm_16_channel_module = hw.PCA9685()          # Instance which controls the 16-channels PWM module
         self.pwm_16_channel_module.set_pwm_freq(50)                      # Set to 50Hz
+        self.enable_auto_increment()
+        self.bus_lock = threading.Lock()                                 # Servos are triggered from both the buttons and the scheduler threads
 
         # Those are some default values, but will be overwritten when loading the pwm_file
 	    # For the S90 ones, the min value is ~70, and the max is ~505, so a good mid value is ~290
         # For the AZ-delivery MG995, min is 500, max is 2500
-        self.servos_settings = [[-40, 255, 40],
-                                [-40, 255, 40],
-                                [-40, 255, 40],
-                                [-40, 255, 40],
-                                [-40, 255, 40],
-                                [-40, 255, 40]]
-        
-        # Number of comment lines in the pwm file
-        self.pwm_comment_lines = 0
+        # Each line is [low, mid, high, latency, channel, travel] (see servo_config.py). The latency is the time (in ms) it takes
+        # the servo to travel from low to high and pluck the string. Notes are sent that much earlier to the servo,
+        # so that they sound on time. The settings are kept in memory, and written back to the file by the config.
+        self.config = servo_config.ServoConfig(pwm_file_path)
+        self.servos_settings = self.config.settings
+        self.latency_mode = servo_config.FIELDS.index("latency")      # Index of the latency, in each line of servos_settings
+        self.channel_mode = servo_config.FIELDS.index("channel")
+        self.travel_mode = servo_config.FIELDS.index("travel")
 
         self.load_pwm_value_from_file()
+        self.channel_ticks = [None] * 16    # Last 'off' tick written on each channel of the PCA9685
     
         btn_servo_1 = 21            #
         btn_servo_2 = 20            #
@@ -38,95 +48,197 @@ class ServoManager():
         btn_servo_5 = 19            #
         btn_servo_6 = 13            #
 
-        Button(btn_servo_1).when_pressed = lambda x: self.trigger_servo(0, self.callback)
-        Button(btn_servo_2).when_pressed = lambda x: self.trigger_servo(1, self.callback)
-        Button(btn_servo_3).when_pressed = lambda x: self.trigger_servo(2, self.callback)
-        Button(btn_servo_4).when_pressed = lambda x: self.trigger_servo(3, self.callback)
-        Button(btn_servo_5).when_pressed = lambda x: self.trigger_servo(4, self.callback)
-        Button(btn_servo_6).when_pressed = lambda x: self.trigger_servo(5, self.callback)
+        hw.Button(btn_servo_1).when_pressed = lambda x: self.press(0)
+        hw.Button(btn_servo_2).when_pressed = lambda x: self.press(1)
+        hw.Button(btn_servo_3).when_pressed = lambda x: self.press(2)
+        hw.Button(btn_servo_4).when_pressed = lambda x: self.press(3)
+        hw.Button(btn_servo_5).when_pressed = lambda x: self.press(4)
+        hw.Button(btn_servo_6).when_pressed = lambda x: self.press(5)
 
         self.string_routine_running = False
+        self.string_routine_stop = None
+        self.scheduler = None       # Set by the asyncio runtime: the routines are then scheduled on the event loop, without a thread
 
 
     def load_pwm_value_from_file(self):
-        if os.path.exists(self.pwm_file_path):
-            with open(self.pwm_file_path) as pwm_file:
-                lines = pwm_file.readlines()[self.pwm_comment_lines:]
+        self.config.load()
+        self.update_ticks()
+
+
+    # Precomputes the 'off' tick of the low and high positions, so that triggering a servo is only a lookup
+    def update_ticks(self):
+        self.low_ticks = [settings[1] + settings[0] for settings in self.servos_settings]
+        self.high_ticks = [settings[1] + settings[2] for settings in self.servos_settings]
+
+
+    def enable_auto_increment(self):
+        device = self.pwm_16_channel_module._device
+        device.write8(MODE1, device.readU8(MODE1) | AUTO_INCREMENT)
+
+
+    # Writes the 'off' tick of several servos at once, given by string. All the channels between the lowest and the
+    # highest one are sent in a single auto-increment block write, the untouched ones being rewritten with their current value.
+    def write_channels(self, ticks_by_string):
+        with self.bus_lock:
+            self.write_channels_locked(ticks_by_string)
 
-            for i, line in enumerate(lines):
-                line = line.split(',')
-                for j, value in enumerate(line):
-                    self.servos_settings[i][j] = int(value)
 
+    # Same as 'write_channels', the caller holding 'bus_lock'
+    def write_channels_locked(self, ticks_by_string):
+        ticks_by_channel = {self.servos_settings[string][self.channel_mode]: ticks for string, ticks in ticks_by_string.items()}
+        first_channel = min(ticks_by_channel)
+        last_channel = max(ticks_by_channel)
 
+        data = []
+        for channel in range(first_channel, last_channel + 1):
+            ticks = ticks_by_channel.get(channel, self.channel_ticks[channel])
+            if ticks is None:   # Never written yet, so we don't know what to rewrite: fall back to one write per channel
+                for channel, ticks in ticks_by_channel.items():
+                    self.pwm_16_channel_module.set_pwm(channel, 0, ticks)
+                    self.channel_ticks[channel] = ticks
+                return
+            data += [0, 0, ticks & 0xFF, ticks >> 8]
+
+        self.pwm_16_channel_module._device.writeList(LED0_ON_L + REGISTERS_PER_CHANNEL * first_channel, data)
+        for channel, ticks in ticks_by_channel.items():
+            self.channel_ticks[channel] = ticks
+
+
+    # Only the memory is updated, the file is written by the config once the values stop changing
     def update_and_write_pwm_value(self, string, mode, value):
-        #update the array
-        self.servos_settings[string][mode] = value
-        
-        #Rewrite the file
-        lines = []
-        with open(self.pwm_file_path) as pwm_file:
-            lines = pwm_file.readlines()
-            new_line = lines[string + self.pwm_comment_lines].split(',')
-            new_line[mode] = str(value)
-            if '\n' not in new_line[2]:
-                new_line[2] = new_line[2] + '\n'
-            new_line = ','.join(new_line)
-            lines[string] = new_line
+        self.config.set(string, mode, value)
+        self.update_ticks()
+
 
-        with open(self.pwm_file_path, 'w') as pwm_file:
-            pwm_file.writelines(lines)
+    # Returns the latency of the servo, in seconds
+    def get_latency(self, string):
+        return self.servos_settings[string][self.latency_mode] / 1000
+
+
+    # Returns the shortest time between two strikes of the servo, in seconds
+    def get_travel_time(self, string):
+        return self.servos_settings[string][self.travel_mode] / 1000
 
 
     def set_callback_func(self, func):
         self.callback = func
 
 
+    # A string button was pressed: it is timestamped first, before the servo is moved over I2C
+    def press(self, index):
+        self.capture.push(index)
+        self.trigger_servo(index, self.callback)
+
+
     def trigger_servo(self, index, func = None):
-        if self.servo_low_position[index]:
-            self.pwm_16_channel_module.set_pwm(index, 0, self.servos_settings[index][1] + self.servos_settings[index][2])
-            self.servo_low_position[index] = False
-        else:
-            self.pwm_16_channel_module.set_pwm(index, 0, self.servos_settings[index][1] + self.servos_settings[index][0])
-            self.servo_low_position[index] = True
+        self.trigger_servos([index], func)
+
+
+    # Triggers several servos at once (a chord), so that all the strings are plucked in the same I2C transaction.
+    # The buttons and the scheduler both trigger servos: the positions are flipped under the bus lock, along with
+    # the write, so that two triggers of a servo can't both send it the same way.
+    def trigger_servos(self, indices, func = None):
+        with self.bus_lock:
+            ticks_by_string = {}
+            for index in indices:
+                if self.servo_low_position[index]:
+                    ticks_by_string[index] = self.high_ticks[index]
+                else:
+                    ticks_by_string[index] = self.low_ticks[index]
+                self.servo_low_position[index] = not self.servo_low_position[index]
+
+            self.write_channels_locked(ticks_by_string)
 
         if func != None:
-            func(index)
+            for index in indices:
+                func(index)
 
 
     def start_string_routine(self, string):
-        self.string_routine_thread = threading.Thread(target=self.string_routine, args=[string])
+        self.string_routine_stop = threading.Event()    # A new event for each routine, so that a stopping one can't be restarted
         self.string_routine_running = True
+        if self.scheduler != None:
+            self.string_routine_step(string, self.string_routine_stop)
+            return
+        self.string_routine_thread = threading.Thread(target=self.string_routine, args=[string, self.string_routine_stop])
         self.string_routine_thread.start()
 
 
-    def string_routine(self, string):
-        while self.string_routine_running:
+    def string_routine_step(self, string, stop):
+        if not stop.is_set():
             self.trigger_servo(string)
-            time.sleep(0.2)
+            self.scheduler.schedule(0.2, self.string_routine_step, [string, stop])
+
+
+    def string_routine(self, string, stop):
+        while not stop.is_set():
+            self.trigger_servo(string)
+            stop.wait(0.2)
+
+
+    # The servo is triggered in time with a click, 'latency' earlier. The user changes the latency until the string
+    # and the click sound together.
+    def start_latency_calibration(self, string, click, period = 1):
+        self.string_routine_stop = threading.Event()
+        self.string_routine_running = True
+        if self.scheduler != None:
+            self.latency_calibration_step(string, click, period, self.string_routine_stop, time.monotonic_ns() + int(period * 1e9))
+            return
+        self.string_routine_thread = threading.Thread(target=self.latency_calibration_routine, args=[string, click, period, self.string_routine_stop])
+        self.string_routine_thread.start()
+
+
+    def latency_calibration_step(self, string, click, period, stop, next_click_ns):
+        if stop.is_set():
+            return
+        trigger_ns = next_click_ns - int(self.get_latency(string) * 1e9)
+        self.scheduler.schedule_at(trigger_ns, lambda: stop.is_set() or self.trigger_servo(string))
+        self.scheduler.schedule_at(next_click_ns, lambda: stop.is_set() or click())
+        self.scheduler.schedule_at(next_click_ns, self.latency_calibration_step, [string, click, period, stop, next_click_ns + int(period * 1e9)])
+
+
+    def latency_calibration_routine(self, string, click, period, stop):
+        next_click = time.monotonic() + period
+        while not stop.wait(max(0, next_click - self.get_latency(string) - time.monotonic())):
+            self.trigger_servo(string)
+            if stop.wait(max(0, next_click - time.monotonic())):
+                break
+            click()
+            next_click += period
 
 
     def stop_string_routine(self):
         self.string_routine_running = False
+        if self.string_routine_stop != None:
+            self.string_routine_stop.set()
 
 
     def setAllServosLowPosition(self):
-        for i in range (0, 6):
-            self.servo_low_position[i] = True
-            self.pwm_16_channel_module.set_pwm(i, 0, self.servos_settings[i][1] + self.servos_settings[i][0])
+        with self.bus_lock:
+            for i in range (0, 6):
+                self.servo_low_position[i] = True
+            self.write_channels_locked({i: self.low_ticks[i] for i in range(0, 6)})
 
 
     def setAllServosMidPosition(self):
-        for i in range (0, 6):
-            self.pwm_16_channel_module.set_pwm(i, 0, self.servos_settings[i][1])
+        self.write_channels({i: self.servos_settings[i][1] for i in range(0, 6)})
 
 
     def setAllServosHighPosition(self):
-        for i in range (0, 6):
-            self.servo_low_position[i] = False
-            self.pwm_16_channel_module.set_pwm(i, 0, self.servos_settings[i][1] + self.servos_settings[i][2])
+        with self.bus_lock:
+            for i in range (0, 6):
+                self.servo_low_position[i] = False
+            self.write_channels_locked({i: self.high_ticks[i] for i in range(0, 6)})
+
+
+    # Sets each servo to its high (True) or low (False) position, e.g. to start a tab in the middle
+    def set_positions(self, high_positions):
+        with self.bus_lock:
+            for i in range (0, 6):
+                self.servo_low_position[i] = not high_positions[i]
+            self.write_channels_locked({i: self.high_ticks[i] if high_positions[i] else self.low_ticks[i] for i in range(0, 6)})
 
 
     #string [0-5], value is between 0-4096
     def set_servo_pwm(self, string, value):
-        self.pwm_16_channel_module.set_pwm(string, 0, value)
+        self.write_channels({string: value})
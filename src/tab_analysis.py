@@ -0,0 +1,150 @@
+import argparse
+import json
+import time
+
+import numpy as np
+
+import tab_library
+import timeline as tl
+
+
+"""
+Statistics of tabs, to know how dense they are before loading them on the Aguitare.
+
+The tabs are read with the same code as the player: timeline.load_timeline streams the measures of the gpX
+or .agu file into a compiled timeline (flat arrays of note times and strings, cached next to the tab), and the
+statistics are computed from these arrays with numpy, without building an object per note:
+    - duration, tempo, number of bars and notes
+    - notes per second of each string: average, and peak over a sliding window (1 s by default)
+    - shortest interval between two notes of each string (see feasibility.py)
+    - chord sizes: how many notes are played together
+    - busiest bars, in notes per second
+
+    python3 tab_analysis.py ../tabs/FirstSong/Meta.agu song.gp5
+    python3 tab_analysis.py --library ../tabs -o analysis.json      # Every tab of the library
+"""
+
+
+NB_OF_STRINGS = 6
+CHORD_WINDOW = 0.001        # Notes closer than this (in s) are a chord, as for the player (see TabManager.chord_window)
+
+
+# Highest number of 'times' (sorted) within any window of 'window' seconds, per second
+def peak_rate(times, window):
+    if times.size == 0:
+        return 0.0
+    counts = np.searchsorted(times, times + window, side='left') - np.arange(times.size)
+    return float(counts.max()) / window
+
+
+def analyse_timeline(timeline, window = 1.0, nb_of_busiest_bars = 5):
+    times = np.asarray(timeline.times, dtype=np.float64)
+    strings = np.asarray(timeline.strings, dtype=np.uint8)
+    bar_times = np.asarray(timeline.bar_times, dtype=np.float64)
+    bar_offsets = np.asarray(timeline.bar_offsets, dtype=np.int64)
+    duration = float(bar_times[-1]) if bar_times.size else 0.0
+
+    per_string = []
+    for string in range(NB_OF_STRINGS):
+        string_times = times[strings == string]     # Still sorted
+        intervals = np.diff(string_times)
+        per_string.append({
+            "string": string + 1,
+            "notes": int(string_times.size),
+            "average_notes_per_s": string_times.size / duration if duration else 0.0,
+            "peak_notes_per_s": peak_rate(string_times, window),
+            "min_interval_ms": float(intervals.min()) * 1000 if intervals.size else None,
+        })
+
+    # A new chord starts at each note further than the chord window from the previous one
+    if times.size:
+        chord_ids = np.concatenate(([0], np.cumsum(np.diff(times) > CHORD_WINDOW)))
+        chord_sizes = np.bincount(chord_ids)
+        size_counts = np.bincount(chord_sizes)
+        chords = {str(size): int(count) for size, count in enumerate(size_counts) if count and size}
+        max_chord = int(chord_sizes.max())
+    else:
+        chords = {}
+        max_chord = 0
+
+    notes_per_bar = np.diff(bar_offsets)
+    bar_durations = np.diff(bar_times)
+    bar_rates = np.divide(notes_per_bar, bar_durations, out=np.zeros(bar_durations.size), where=bar_durations > 0)
+    busiest = np.argsort(-bar_rates, kind='stable')[:nb_of_busiest_bars]
+
+    return {
+        "tempo": timeline.tempo,
+        "beats": timeline.beats,
+        "bars": timeline.nb_of_bars,
+        "notes": int(times.size),
+        "duration_s": duration,
+        "average_notes_per_s": times.size / duration if duration else 0.0,
+        "peak_notes_per_s": peak_rate(times, window),
+        "window_s": window,
+        "strings": per_string,
+        "chord_sizes": chords,
+        "max_chord_size": max_chord,
+        "busiest_bars": [{"bar": int(bar) + 1, "notes": int(notes_per_bar[bar]), "notes_per_s": float(bar_rates[bar])} for bar in busiest],
+    }
+
+
+def analyse_tab(tab_path, window = 1.0, nb_of_busiest_bars = 5):
+    return analyse_timeline(tl.load_timeline(tab_path), window, nb_of_busiest_bars)
+
+
+# Returns the paths of the tabs of a tabs directory, as listed by the tab library
+def library_tabs(tabs_path):
+    library = tab_library.TabLibrary(tabs_path, read_info = False)     # The tabs are read below anyway
+    return [library.tab_file(tab_name, library.get_info(tab_name)["format"]) for tab_name in library.get_tabs()]
+
+
+def print_analysis(tab_path, analysis):
+    print("{}: {:.0f}s, {} bars, {} notes, {:g} bpm".format(tab_path, analysis["duration_s"], analysis["bars"], analysis["notes"], analysis["tempo"]))
+    print("    {:.1f} notes/s on average, {:.1f} at peak ({:g}s window), chords up to {} notes".format(
+        analysis["average_notes_per_s"], analysis["peak_notes_per_s"], analysis["window_s"], analysis["max_chord_size"]))
+    for string in analysis["strings"]:
+        if string["notes"]:
+            min_interval = "{:.0f} ms".format(string["min_interval_ms"]) if string["min_interval_ms"] != None else "-"
+            print("    String {}: {} notes, {:.1f} notes/s, peak {:.1f}, shortest interval {}".format(
+                string["string"], string["notes"], string["average_notes_per_s"], string["peak_notes_per_s"], min_interval))
+    print("    Busiest bars: " + ", ".join("{} ({:.1f} notes/s)".format(bar["bar"], bar["notes_per_s"]) for bar in analysis["busiest_bars"]))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("tabs", nargs="*", help="gpX files, Meta.agu files or .agu v2 files")
+    parser.add_argument("--library", "-l", help="Analyse every tab of this tabs directory")
+    parser.add_argument("--window", "-w", type=float, default=1.0, help="Sliding window of the peak rates, in s")
+    parser.add_argument("--bars", "-b", type=int, default=5, help="Number of busiest bars to list")
+    parser.add_argument("--output", "-o", help="JSON file, otherwise the statistics are printed")
+    args = parser.parse_args()
+
+    tab_paths = list(args.tabs)
+    if args.library != None:
+        tab_paths += library_tabs(args.library)
+    if not tab_paths:
+        print("You must give a tab, or a tabs directory with --library !")
+        exit(1)
+
+    start = time.perf_counter()
+    analyses = {}
+    for tab_path in tab_paths:
+        try:
+            analyses[tab_path] = analyse_tab(tab_path, args.window, args.bars)
+        except Exception as e:     # e.g. guitarpro not installed, or a broken file: the other tabs are still analysed
+            analyses[tab_path] = {"error": repr(e)}
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(analyses, output_file, indent=2)
+    else:
+        for tab_path, analysis in analyses.items():
+            if "error" in analysis:
+                print("{}: {}".format(tab_path, analysis["error"]))
+            else:
+                print_analysis(tab_path, analysis)
+    print("{} tabs analysed in {:.2f}s".format(len(analyses), time.perf_counter() - start))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,85 +1,201 @@
 import argparse
-from posixpath import join
-import guitarpro as pygp
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import timeline as tl
 
-parser = argparse.ArgumentParser()
-parser.add_argument("--path", "-p")
-parser.add_argument("--output", "-o", default=".")
-args = parser.parse_args()
 
-print("This programs convert gpX files into loop file")
-print("It is possible to have a gpX file with multiple bars, it will creat as much loop files")
+"""
+Converts gpX files into .agu tabs: a single .agu v2 file by default, or a Meta.agu and one Loop_X file
+per bar with --legacy. It is possible to have a gpX file with multiple bars, it will create as much loops.
 
-if args.path == None:
-    print("You must give a path to a tab !")
-    exit()
+    python3 tab_converter.py -p path/to/tab.gp3 -o path/to/output           # One tab
+    python3 tab_converter.py --batch path/to/songs -o path/to/output       # A whole directory tree
+    python3 tab_converter.py --migrate path/to/tab_dir                     # Tab directory -> .agu v2 file
 
+In batch mode, the tabs are converted by a pool of processes, and the tabs whose output is newer than the
+gpX file are skipped. The functions can also be used from python, e.g. convert_tree(songs_dir, output_dir).
+"""
 
-output_path = args.output
-if not os.path.exists(output_path):
-    os.mkdir(output_path)
 
-tab_path = args.path
-allowed_format = ("gp3", "gp4", "gp5")
-if tab_path[-3:] not in allowed_format:
-    print("Tab format must be either gp3, gp4 or gp5")
-    exit()
+ALLOWED_FORMATS = ("gp3", "gp4", "gp5")
+DEFAULT_LOOP_NAME = "Loop_"
+META_FILE_NAME = tl.META_TAB_FILE
 
-default_loop_name = "Loop_"
-loop_id = 1
-meta_file_name = "Meta.agu"
 
+# Returns (tempo, beats per bar, bars), each bar being a list of (string, time), time being a fraction of the bar.
+# The notes are timed through the tempo map of the song (see timeline.TempoMap), but a legacy tab has a single
+# tempo and time signature: the notes of each bar are placed relatively to its real duration.
+# The beats of a legacy tab are quarter notes (a bar lasts beats * 60 / tempo), so a 6/8 song has 3 beats, and a
+# time signature which is not a whole number of quarter notes (7/8..) can't be written: use a .agu v2 file instead.
+def read_gp_tab(tab_path):
+    if tab_path[-3:] not in ALLOWED_FORMATS:
+        raise ValueError("Tab format must be either gp3, gp4 or gp5")
 
-string_dict = {1:5, 2:4, 3:3, 4:2, 5:1, 6:0}
+    stream = tl.open_gp_stream(tab_path)
+    quarter_beats = stream.beats * 4 / stream.beat_value
+    if quarter_beats != int(quarter_beats):
+        raise ValueError("{}/{} can't be written as a legacy tab, whose beats are quarter notes".format(stream.beats, stream.beat_value))
 
-# Associate a time signature denominator (1: full, 2: half, 4: quarter, 8: 8th)
-# to a value of 'pulses per quarter note'. Each note duration is given of this ppqn term,
-# so, in order to get the real time value, we need to divide each note by this reference which represents
-# the duration of 1 beat
-allowed_denominator = (1, 2, 4, 8)
-signature_to_ppqn = {1 : 3840, 2: 1920, 4:960, 8: 1440}
+    bars = []
+    for bar_time, bar_duration, notes in stream.bars:
+        bars.append([(string, (time - bar_time) / bar_duration) for time, string in notes])
+    return stream.tempo, int(quarter_beats), bars
 
 
-song = pygp.parse(tab_path)
-time_sig_denominator = song.tracks[0].measures[0].header.timeSignature.denominator.value
+# Writes the Meta.agu and Loop_X files in 'output_path'. If 'append', the loops are appended to an existing tab
+# (the header being only written if there is no Meta.agu yet), otherwise the tab is written from scratch, and
+# the Loop_X files left by a previous conversion are removed.
+def write_legacy_tab(output_path, tempo, beats_per_bar, bars, append = True):
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
 
-if time_sig_denominator not in allowed_denominator:
-    print("Tab time signature not supported, must be either 1, 2, 4, or 8")
-    exit()
+    meta_path = os.path.join(output_path, META_FILE_NAME)
+    if not append:
+        for file_name in os.listdir(output_path):
+            if file_name.startswith(DEFAULT_LOOP_NAME) and file_name[len(DEFAULT_LOOP_NAME):].isdigit():
+                os.remove(os.path.join(output_path, file_name))
 
-ppqn_per_beat = signature_to_ppqn[time_sig_denominator]
-SECS_IN_MIN = 60
+    loop_id = 1
+    if not append or not os.path.exists(meta_path) or os.path.getsize(meta_path) == 0:
+        with open(meta_path, 'w') as saved_tab_file:
+            saved_tab_file.write("tempo," + str(tempo) + '\n' + "beats," + str(beats_per_bar) + '\n')
 
+    for note_array in bars:
+        while append and os.path.exists(os.path.join(output_path, DEFAULT_LOOP_NAME + str(loop_id))):
+            loop_id += 1
 
-tempo = song.tempo
-print("Tempo = ", song.tempo)
-print("Number of tracks = ", len(song.tracks))
-print("Number of measures = ", len(song.tracks[0].measures))
-print("Denominator = ", song.tracks[0].measures[0].header.timeSignature.denominator.value)
-measure_number = 0
-beats_per_bar = song.measureHeaders[0].timeSignature.numerator
+        with open(meta_path, 'a') as saved_tab_file:
+            saved_tab_file.write(DEFAULT_LOOP_NAME + str(loop_id) + '\n')
 
-with open(os.path.join(output_path, meta_file_name), 'a') as saved_tab_file:
-    saved_tab_file.write("tempo," + str(tempo) + '\n' + "beats," + str(beats_per_bar) + '\n')
-
-
-for measure in song.tracks[0].measures:
-    note_array = []
-    for voice in measure.voices:
-        beat_time = 0
-        for beat in voice.beats:
-            if beat.notes:
-                for note in beat.notes:
-                    note_array.append((string_dict[note.string], beat_time / (beats_per_bar * (SECS_IN_MIN/tempo))))
-            beat_time = beat_time + (beat.duration.time / ppqn_per_beat) * (SECS_IN_MIN / song.tempo)
-
-    while os.path.exists(os.path.join(output_path, default_loop_name + str(loop_id))):
+        with open(os.path.join(output_path, DEFAULT_LOOP_NAME + str(loop_id)), 'w') as loop_file:
+            for string, time in note_array:
+                loop_file.write(str(string) + "," + str(time) + '\n')
         loop_id += 1
 
-    with open(os.path.join(output_path, meta_file_name), 'a') as saved_tab_file:
-        saved_tab_file.write(default_loop_name + str(loop_id) + '\n')
 
-    with open(os.path.join(output_path, default_loop_name + str(loop_id)), 'w') as loop_file:
-        for string, time in note_array:
-            loop_file.write(str(string) + "," + str(time) + '\n')
\ No newline at end of file
+# The .agu v2 file, or the directory of the Meta.agu file with --legacy
+def output_for(tab_path, output_path, legacy):
+    tab_name = os.path.splitext(os.path.basename(tab_path))[0]
+    if legacy:
+        return os.path.join(output_path, tab_name)
+    return os.path.join(output_path, tab_name + tl.AGU2_EXTENSION)
+
+
+def convert_tab(tab_path, output, legacy = False, append = True):
+    if legacy:
+        tempo, beats_per_bar, bars = read_gp_tab(tab_path)
+        write_legacy_tab(output, tempo, beats_per_bar, bars, append)
+        return tempo, beats_per_bar, len(bars)
+
+    if tab_path[-3:] not in ALLOWED_FORMATS:
+        raise ValueError("Tab format must be either gp3, gp4 or gp5")
+    if os.path.dirname(output) and not os.path.exists(os.path.dirname(output)):
+        os.makedirs(os.path.dirname(output))
+    timeline = tl.compile_gp(tab_path)     # Exact times, through the tempo map of the song
+    tl.write_agu2(output, timeline)
+    return timeline.tempo, timeline.beats, timeline.nb_of_bars
+
+
+def is_up_to_date(tab_path, output, legacy):
+    output_file = os.path.join(output, META_FILE_NAME) if legacy else output
+    return os.path.exists(output_file) and os.path.getmtime(output_file) >= os.path.getmtime(tab_path)
+
+
+# Converts one tab of a batch, and returns its report. Run in a worker process, so it never raises.
+def convert_job(tab_path, output, legacy, force):
+    report = {"tab": tab_path, "output": output, "status": "converted", "seconds": 0, "error": None}
+    start = time.perf_counter()
+    try:
+        if not force and is_up_to_date(tab_path, output, legacy):
+            report["status"] = "skipped"
+        else:
+            convert_tab(tab_path, output, legacy, append = False)
+    except Exception as e:
+        report["status"] = "failed"
+        report["error"] = repr(e)
+    report["seconds"] = time.perf_counter() - start
+    return report
+
+
+# Returns the gpX files of a directory tree
+def find_gp_tabs(input_dir):
+    tab_paths = []
+    for dir_path, dir_names, file_names in os.walk(input_dir):
+        dir_names.sort()
+        for file_name in sorted(file_names):
+            if file_name[-3:] in ALLOWED_FORMATS:
+                tab_paths.append(os.path.join(dir_path, file_name))
+    return tab_paths
+
+
+# Converts all the gpX files of 'input_dir' into 'output_dir', keeping the same tree.
+# Returns the list of the reports of each tab (status: converted, skipped or failed, seconds, error).
+def convert_tree(input_dir, output_dir, legacy = False, force = False, workers = None):
+    jobs = []
+    for tab_path in find_gp_tabs(input_dir):
+        output_path = os.path.join(output_dir, os.path.relpath(os.path.dirname(tab_path), input_dir))
+        jobs.append((tab_path, output_for(tab_path, output_path, legacy), legacy, force))
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(convert_job, *job) for job in jobs]
+        return [future.result() for future in futures]
+
+
+def print_reports(reports, elapsed):
+    for report in reports:
+        line = "{:>9}  {:7.2f}s  {}".format(report["status"], report["seconds"], report["tab"])
+        if report["error"] != None:
+            line += "  " + report["error"]
+        print(line)
+
+    counts = {status: sum(1 for report in reports if report["status"] == status) for status in ("converted", "skipped", "failed")}
+    print("{} tabs: {converted} converted, {skipped} up to date, {failed} failed, in {:.1f}s".format(len(reports), elapsed, **counts))
+
+
+# Converts a tab directory (Meta.agu + Loop_X files) into a .agu v2 file, next to it by default
+def migrate_tab_dir(tab_dir, output_dir = None):
+    tab_dir = os.path.normpath(tab_dir)
+    if output_dir == None:
+        output_dir = os.path.dirname(tab_dir)
+    output_file = os.path.join(output_dir, os.path.basename(tab_dir) + tl.AGU2_EXTENSION)
+    timeline = tl.migrate_agu(os.path.join(tab_dir, tl.META_TAB_FILE), output_file)
+    return output_file, timeline
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--path", "-p", help="gpX file to convert")
+    parser.add_argument("--batch", "-b", help="Directory tree of gpX files to convert")
+    parser.add_argument("--output", "-o", default=".")
+    parser.add_argument("--legacy", action="store_true", help="Write a Meta.agu and one Loop_X file per bar, instead of a single .agu v2 file")
+    parser.add_argument("--migrate", "-m", help="Convert a tab directory (Meta.agu + Loop_X files) into a .agu v2 file, without loss")
+    parser.add_argument("--force", "-f", action="store_true", help="In batch mode, also convert the tabs which are up to date")
+    parser.add_argument("--jobs", "-j", type=int, help="Number of processes in batch mode, one per CPU by default")
+    args = parser.parse_args()
+
+    if args.migrate != None:
+        output_file, timeline = migrate_tab_dir(args.migrate, args.output if args.output != "." else None)
+        print("{} -> {}: {} bars, {} notes, identical timeline".format(args.migrate, output_file, timeline.nb_of_bars, timeline.nb_of_notes))
+
+    elif args.batch != None:
+        start = time.perf_counter()
+        reports = convert_tree(args.batch, args.output, args.legacy, args.force, args.jobs)
+        print_reports(reports, time.perf_counter() - start)
+        if any(report["status"] == "failed" for report in reports):
+            exit(1)
+
+    elif args.path != None:
+        output = output_for(args.path, args.output, False) if not args.legacy else args.output
+        tempo, beats_per_bar, nb_of_bars = convert_tab(args.path, output, args.legacy)
+        print("Tempo = ", tempo)
+        print("Beats per bar = ", beats_per_bar)
+        print("Number of measures = ", nb_of_bars)
+        print("Written", output)
+
+    else:
+        print("You must give a path to a tab !")
+
+
+if __name__ == "__main__":
+    main()
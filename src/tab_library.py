@@ -0,0 +1,212 @@
+import json
+import os
+import queue
+import threading
+
+import timeline as tl
+
+
+"""
+Index of the tabs found in the tabs directory, kept in memory and on disk (tabs/.library.json).
+
+Listing the tabs used to mean listing the tabs directory, then every sub directory to find the .agu tabs,
+each time the menu was refreshed. The index only lists the tabs directory again when its mtime changed
+(a tab was added, removed or renamed), and only reads a tab again when its own mtime changed:
+    - tab_name.gpX:             the mtime and size of the file
+    - tab_name.agu (v2):        the mtime and size of the file
+    - tab_name/Meta.agu:        the mtimes of the directory (a loop was added) and of Meta.agu
+The tabs are only checked when the tabs directory changed, or one by one when they are opened or recorded
+into ('refresh_tab'). For each tab, the index keeps its format, tempo, beats, number of loops (or bars for
+a gpX file), duration and number of notes, so the menu can display them without opening any file. Reading
+them means compiling the tab, which takes seconds for a big gpX file on a Pi: it is done by a background
+thread, the menu showing the tab without its info meanwhile.
+"""
+
+
+INDEX_FILE = ".library.json"
+INDEX_VERSION = 1
+GP_EXTENSIONS = ("gp3", "gp4", "gp5")
+AGU_FORMAT = "agu"              # Directory with a Meta.agu and its Loop_X files
+AGU2_FORMAT = "agu2"            # Single file .agu v2
+
+
+class TabLibrary:
+
+    def __init__(self, tabs_path, read_info = True):
+        self.tabs_path = tabs_path
+        self.index_path = os.path.join(tabs_path, INDEX_FILE)
+        self.read_info = read_info      # If False, the tabs are only listed, e.g. by the command line tools
+        self.dir_mtime = None           # mtime of the tabs directory, when it was last listed
+        self.tabs = {}                  # tab name -> dict of its info, see 'read_tab_info'
+        self.lock = threading.Lock()    # The tabs are read by the background thread, and listed by the menu
+        self.pending = queue.Queue()    # Names of the tabs to read
+        self.reader = None              # Background thread reading the tabs, started when needed
+        self.load()
+
+
+    def load(self):
+        try:
+            with open(self.index_path) as index_file:
+                index = json.load(index_file)
+        except (OSError, ValueError):
+            return
+        if index.get("version") == INDEX_VERSION:
+            self.dir_mtime = index["dir_mtime"]
+            self.tabs = index["tabs"]
+
+
+    # Writes the index into a temporary file, which then replaces it, so that a crash can't leave a truncated index.
+    # This changes the mtime of the tabs directory: it is read again after the write, unless the directory had
+    # already changed before (then it must be listed again).
+    def save(self):
+        with self.lock:
+            tmp_path = self.index_path + ".tmp"
+            try:
+                dir_mtime = os.stat(self.tabs_path).st_mtime_ns
+                with open(tmp_path, 'w') as index_file:
+                    json.dump({"version": INDEX_VERSION, "dir_mtime": self.dir_mtime, "tabs": self.tabs}, index_file)
+                    index_file.flush()
+                    os.fsync(index_file.fileno())
+                os.replace(tmp_path, self.index_path)
+                if dir_mtime == self.dir_mtime:
+                    self.dir_mtime = os.stat(self.tabs_path).st_mtime_ns
+            except OSError as e:
+                print("Could not write the tab library index: {}".format(e))
+
+
+    def tab_format(self, file_name):
+        if file_name.startswith(INDEX_FILE):
+            return None
+        absolute_path = os.path.join(self.tabs_path, file_name)
+        if os.path.isfile(absolute_path):
+            if file_name[-3:] in GP_EXTENSIONS:
+                return file_name[-3:]
+            if tl.is_agu2_file(absolute_path):
+                return AGU2_FORMAT
+        elif os.path.isfile(os.path.join(absolute_path, tl.META_TAB_FILE)):
+            return AGU_FORMAT
+        return None
+
+
+    def tab_file(self, tab_name, tab_format):
+        if tab_format == AGU_FORMAT:
+            return os.path.join(self.tabs_path, tab_name, tl.META_TAB_FILE)
+        return os.path.join(self.tabs_path, tab_name)
+
+
+    # Changes whenever the tab has to be read again
+    def tab_key(self, tab_name, tab_format):
+        tab_file = self.tab_file(tab_name, tab_format)
+        if tab_format == AGU_FORMAT:
+            return [os.stat(os.path.dirname(tab_file)).st_mtime_ns, os.stat(tab_file).st_mtime_ns]
+        stat = os.stat(tab_file)
+        return [stat.st_mtime_ns, stat.st_size]
+
+
+    def read_tab_info(self, tab_name, tab_format):
+        info = {"format": tab_format, "tempo": None, "beats": None, "loops": None, "duration": None, "notes": None}
+        tab_file = self.tab_file(tab_name, tab_format)
+        try:
+            if tab_format == AGU_FORMAT:
+                info["tempo"], info["beats"], loop_names = tl.read_agu_meta(tab_file)
+                info["loops"] = len(loop_names)
+            timeline = tl.load_timeline(tab_file)
+        except Exception as e:     # e.g. guitarpro not installed, or a broken file: the tab is still listed
+            print("Could not read the tab {}: {!r}".format(tab_name, e))
+            return info
+
+        info["tempo"] = timeline.tempo
+        info["beats"] = timeline.beats
+        info["loops"] = timeline.nb_of_bars
+        info["duration"] = timeline.duration
+        info["notes"] = timeline.nb_of_notes
+        return info
+
+
+    # Lists the tabs directory again if its mtime changed, and then checks each tab. Only the names are listed
+    # here, the tabs which changed are read by the background thread.
+    def refresh(self):
+        dir_mtime = os.stat(self.tabs_path).st_mtime_ns
+        if dir_mtime == self.dir_mtime:
+            return
+
+        tabs = {}
+        for file_name in os.listdir(self.tabs_path):
+            tab_format = self.tab_format(file_name)
+            if tab_format != None:
+                tabs[file_name] = self.tabs.get(file_name, {"format": tab_format})
+        with self.lock:
+            self.tabs = tabs
+            self.dir_mtime = dir_mtime
+        for tab_name in tabs:
+            self.refresh_tab(tab_name, save = False)
+        self.save()
+
+
+    # Checks one tab (e.g. when it is opened, or a loop was recorded into it), and reads it again in the background
+    # if it changed. Returns its info, as indexed so far.
+    def refresh_tab(self, tab_name, save = True):
+        with self.lock:
+            info = self.tabs.get(tab_name)
+        if info == None:
+            return None
+        try:
+            key = self.tab_key(tab_name, info["format"])
+        except OSError:     # Removed in the meantime
+            with self.lock:
+                self.tabs.pop(tab_name, None)
+            if save:
+                self.save()
+            return None
+
+        if info.get("key") != key and self.read_info:
+            self.start_reader()
+            self.pending.put(tab_name)
+        return info
+
+
+    def start_reader(self):
+        if self.reader == None:
+            self.reader = threading.Thread(target=self.read_pending_tabs, name="tab_library", daemon=True)
+            self.reader.start()
+
+
+    # Background thread: reads the tabs queued by 'refresh_tab', and saves the index once the queue is empty
+    def read_pending_tabs(self):
+        changed = False
+        while True:
+            try:
+                tab_name = self.pending.get(timeout = None if not changed else 0)
+            except queue.Empty:
+                self.save()
+                changed = False
+                continue
+
+            with self.lock:
+                info = self.tabs.get(tab_name)
+            if info == None:
+                continue
+            try:
+                key = self.tab_key(tab_name, info["format"])
+                if info.get("key") == key:      # Queued twice, or read already
+                    continue
+                info = self.read_tab_info(tab_name, info["format"])
+                info["key"] = self.tab_key(tab_name, info["format"])    # Reading the tab may have written its timeline cache
+            except OSError:
+                continue
+            with self.lock:
+                if tab_name in self.tabs:
+                    self.tabs[tab_name] = info
+                    changed = True
+
+
+    # Returns the sorted names of the tabs, in 'formats' if given
+    def get_tabs(self, formats = None):
+        self.refresh()
+        with self.lock:
+            return sorted(tab_name for tab_name, info in self.tabs.items() if formats == None or info["format"] in formats)
+
+
+    def get_info(self, tab_name):
+        with self.lock:
+            return self.tabs.get(tab_name)
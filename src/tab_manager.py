@@ -1,15 +1,21 @@
-import guitarpro as pygp
-from threading import Timer
+import bisect
+import feasibility
+import itertools
 import os
+import tab_library
+import threading
+import time
+import timeline as tl
 from enum_classes import SessionRecorderState
 from time import sleep
 
 
 class TabManager:
 
-    def __init__(self, servo_manager, metronome, tabs_path):
+    def __init__(self, servo_manager, metronome, scheduler, tabs_path):
         self.servo_manager = servo_manager
         self.metronome = metronome
+        self.scheduler = scheduler          # Single thread firing all the notes of a tab, see scheduler.py
         self.tabs_path = tabs_path
 
         self.extensions_list = ("agu", "gp3", "gp4", "gp5")
@@ -21,23 +27,44 @@ class TabManager:
         self.header_tempo = "Tempo,"
         self.header_beats = "Beats,"
 
-        self.events = []                    # When playing a tab, each note will create a Threading Timer object, stored in this variable
         self.repeat_loop_X_time = 4
         self.repeat_newly_saved_loop_X_time = 4
         self.end_of_tab_event_offset = 0.2
-        self.bar_starting_time = 0
-        self.saved_notes_list = [[] for i in range(6)]
+        self.chord_window = 0.001           # Notes closer than this (in s) are sent to the servos as a single chord
+        self.bar_starting_time = 0          # Start of the recorded bar, in time.perf_counter_ns() like the captured presses
 
         # Sometimes when pressing the button on the first beat, we may press it few milli seconds before the beginning of the loop.
-        # This 'pre_record' variable is made to handle this. If it is true, then we will create a note on the very first beat.
-        self.pre_record_list = [False, False, False, False, False, False]
+        # The presses made less than 'pre_record_window' seconds before the bar are recorded on its very first beat.
+        self.pre_record_window = 0.1
+
+        # The recorded bars are quantized (see quantizer.py), unless 'quantize_grid' is None
+        self.quantize_grid = "1/16"
+        self.quantize_strength = 1.0
+        self.quantize_swing = 0.0
+
+        # Overdub, see 'start_overdub'
+        self.overdub_layer = None           # (time in the section, string) of the notes captured, None if not overdubbing
+        self.overdub_lock = threading.Lock()    # The layer is filled from the overdub thread, and when stopping
+        self.overdub_origin_ns = None       # Start of the first pass of the section, in time.perf_counter_ns()
+        self.overdub_section_duration = 0
+        self.overdub_section_beats = 0
+        self.overdub_section_notes = []     # Notes of the section, which the layer must not double
+        self.overdub_latencies = None
+        self.overdub_chords = (0, [], [])   # (version, times, chords) of the section with the layer, see 'merge_overdub'
+        self.overdub_wakeup = threading.Event()     # Set at the end of each pass, to merge the presses
+        self.overdub_refresh_period = 0.25  # Longest time (in s) between two chords of the section, see 'loop_section'
         self.sorted_notes_list = []
         self.is_tab_playing = False
         self.callback = None
-        self.gp_to_agu_mapping = {6:0, 5:1, 4:2, 3:3, 2:4, 1:5}
+        self.dispatch = None                # Set by the asyncio runtime, to run the callback in the ui executor
+        self.timeline = None                # Compiled timeline of the tab loaded with 'load_timeline', see 'play_from'
 
         self.play_metronome_before_song = False
 
+        # What to do with the notes of a string too close for its servo to strike them all (see feasibility.py)
+        self.feasibility_policy = feasibility.WARN_POLICY
+        self.feasibility_report = None
+
 
     @property
     def tabs_path(self):
@@ -47,6 +74,7 @@ class TabManager:
     @tabs_path.setter
     def tabs_path(self, path):
         self._tab_path = path
+        self.library = tab_library.TabLibrary(path)     # Index of the tabs, see tab_library.py
 
 
     def create_tab(self, tempo, beats):
@@ -69,33 +97,21 @@ class TabManager:
         return self.default_tab_dir_name + str(i)
 
 
-    # Returns a list of all available tabs in the tab folder
+    # Returns a list of all available tabs in the tab folder, from the tab library index
     # Two modes:
     #       1: Return both (gp3,gp4, gp5) and .agu format
     #       2: Return only .agu format
     def get_available_tabs(self, check_mode):
-        consistent_tabs = []
-
         if check_mode == 1:
-            for file_name in sorted(os.listdir(self.tabs_path)):                                # Check all files in tab_path, both files (.gpX) and dirs (agu format)
-                if os.path.isfile(os.path.join(self.tabs_path, str(file_name))):                # If it is a file, check that the extension is in (gp3,4,5)
-                    if str(file_name)[-3:] in self.gp_extensions:
-                        consistent_tabs.append(file_name)
-                elif os.path.isdir(os.path.join(self.tabs_path, str(file_name))):               # If its a dir, check that it contains a Meta.agu file
-                    for sub_file_name in sorted(os.listdir(os.path.join(self.tabs_path , str(file_name)))):
-                        if str(sub_file_name)[-3:] in self.agu_extension:
-                            consistent_tabs.append(file_name)
-                            break
-
+            return self.library.get_tabs()
         elif check_mode == 2:
-            for file_name in sorted(os.listdir(self.tabs_path)):                # Check all dirs in tab_path
-                if os.path.isdir(os.path.join(self.tabs_path, str(file_name))):              # If its a dir, check that it contains a Meta.agu file
-                    for sub_file_name in sorted(os.listdir(os.path.join(self.tabs_path, str(file_name)))):
-                        if str(sub_file_name)[-3:] in self.agu_extension:
-                            consistent_tabs.append(file_name)
-                            break
+            return self.library.get_tabs(formats = (self.agu_extension,))
+        return []
+
 
-        return consistent_tabs
+    # Returns the info of a tab (format, tempo, beats, loops, duration, notes), as indexed by the tab library
+    def get_tab_info(self, tab_name):
+        return self.library.get_info(tab_name)
 
 
     # For gpX, the name of the tab corresponds directly to the name of the saved_file (tab_name.gpX), but for .agu format,
@@ -104,11 +120,14 @@ class TabManager:
     #       - /default/tab/dir/tab_name.gpX
     #   or from a .agu tab:
     #       - /default/tab/dir/tab_name/Meta.agu
-    # Return 0 if gpX format, 1 if Meta.agu file
+    #   or from a single file .agu v2 tab:
+    #       - /default/tab/dir/tab_name.agu
+    # Return 0 if gpX format, 1 if .agu (Meta.agu or v2 file)
     def grab_tab_file_from_node_name(self, tab_name):
+        self.library.refresh_tab(tab_name)      # The tab is opened: its info is read again if it changed
         tab_name_absolute_path = os.path.join(self.tabs_path, tab_name)
         if os.path.isfile(tab_name_absolute_path):
-            return (tab_name_absolute_path, 0)
+            return (tab_name_absolute_path, 1 if tl.is_agu2_file(tab_name_absolute_path) else 0)
         elif os.path.isdir(tab_name_absolute_path):
             return (os.path.join(tab_name_absolute_path, self.meta_tab_file), 1)
 
@@ -118,6 +137,12 @@ class TabManager:
         # tab_path points directly to either a tab.gpX format, or directly to a Meta.agu format, thanks to the
         # grab_tab_file_from_name function
 
+        if from_loop != None:       # A section: played from the compiled timeline
+            self.load_timeline(absolute_tab_path)
+            repeat = self.repeat_loop_X_time if to_loop != None else 1
+            self.play_from(from_loop, is_agu_file, to_loop, repeat)
+            return
+
         if not self.is_tab_playing:
             self.is_tab_playing = True
 
@@ -125,118 +150,348 @@ class TabManager:
             self.servo_manager.setAllServosLowPosition()
             sleep(1)
 
-            if is_agu_file:
-                with open(absolute_tab_path) as tab_file:
-                    lines = tab_file.readlines()
-
-                # The first two lines contain the meta info
-                tempo = int(lines[0].split(',')[1].rstrip('\n'))
-                beats_per_loop = int(lines[1].split(',')[1].rstrip('\n'))
-
-                end_of_tab_event_timer = 0      # This timer will be added after the very last note, to send a signal that the tab is over.
-                
-                start_at_loop = 1
-                end_after_loop = len(lines) - 2
-
-                pre_event_array = []            # Will store all the notes of the considered loops. Then, will will duplicate X time, in order
-                                                # to play the selection in loop
-
-                if from_loop != None:
-                    start_at_loop = from_loop
-                if to_loop != None:
-                    end_after_loop = to_loop
-                nb_of_loops = end_after_loop - start_at_loop + 1
-
-                # Retrieve dir path from tab path
-                absolute_tab_dir = absolute_tab_path.split('/')
-                absolute_tab_dir.pop()
-                absolute_tab_dir = '/'.join(absolute_tab_dir)
-
-                
-                for i, line in enumerate(lines[2 + start_at_loop - 1 : 2 + end_after_loop]):
-                    with open(os.path.join(absolute_tab_dir, line.rstrip('\n'))) as loop_file:
-                        loop_notes = loop_file.readlines()
-                    for note in loop_notes:
-                        note_time = float(note.split(',')[1].rstrip('\n'))
-                        note_string = int(note.split(',')[0])
-                        pre_event_array.append(((note_time + i )* beats_per_loop * 60 / tempo, note_string))
-                        
-
-                # If we play the song as a whole, we do not loop it.
-                # Otherwise, if its a small portion, we do it.
-                repeat = 1
-                if from_loop != None and to_loop != None:
-                    repeat = self.repeat_loop_X_time
-
-                first_note = True
-                self.metronome.tempo = tempo
-                self.events.append(Timer(0, self.metronome.start_metronome))
-
-                for i in range (repeat):
-                    for time, string in pre_event_array:
-                        metronome_offset =  self.beats * 60/self.current_tempo
-                        self.events.append(Timer(time + i * self.beats * 60/self.current_tempo * nb_of_loops + metronome_offset, self.servo_manager.trigger_servo, [string]))
-                        if first_note:
-                            first_note = False
-                            self.events.append(Timer(time + i * self.beats * 60/self.current_tempo * nb_of_loops + metronome_offset, self.metronome.stop_metronome))
-                        print(time + i * self.beats * 60/self.current_tempo * nb_of_loops + metronome_offset)
-                end_of_tab_event_timer = (repeat - 1) * self.beats * (60/self.current_tempo) * (nb_of_loops + 1) + pre_event_array[-1][0]\
-                    + self.end_of_tab_event_offset
-                
-                print("pre-array = {}".format(pre_event_array[-1][0]))
-                print("end_of_t = {}".format(end_of_tab_event_timer))
-                # Add a timer that will trigger an end_of_tab callback
-                self.events.append(Timer(end_of_tab_event_timer, self.end_of_tab_callback))
-
-
-            else :
-                end_of_tab_event_timer = 0
-                song = pygp.parse(absolute_tab_path)
-
-                if self.play_metronome_before_song:
-                    measure_number = 1
-                    self.events.append(Timer(0, self.metronome.start_metronome))
-                    first_note = True
-                else:
-                    measure_number = 0
-
-                
-                beats_per_bar = song.measureHeaders[0].timeSignature.numerator
-                self.metronome.tempo = song.tempo
-                
-                for measure in song.tracks[0].measures:
-                    measure_time = (measure_number) * 60 * beats_per_bar / song.tempo
-                    for voice in measure.voices:
-                        beat_time = 0
-                        for beat in voice.beats:
-                            note_time = measure_time + beat_time
-                            #print(beat.duration.time)
-                            beat_time = beat_time + (beat.duration.time/960)* (60/song.tempo)
-                            if beat.notes:
-                                end_of_tab_event_timer = note_time
-                                for note in beat.notes:
-                                    self.events.append(Timer(note_time, self.servo_manager.trigger_servo, [self.gp_to_agu_mapping[note.string]]))
-                                    if self.play_metronome_before_song:
-                                        if first_note:
-                                            first_note = False
-                                            self.events.append(Timer(note_time, self.metronome.stop_metronome))
-
-                    measure_number = measure_number + 1
-
-                self.events.append(Timer(end_of_tab_event_timer + 0.2, self.end_of_tab_callback))
-            
-            print("This tab has {0} notes and thus, will try to create {0} threads.".format(len(self.events)))
-            
-            
+            # The tab is read from its compiled cache if it didn't change, otherwise parsed bar after bar.
+            # The events are then produced lazily, while the scheduler plays them.
             try:
-                for event in self.events:
-                    event.start()
+                stream = tl.open_stream(absolute_tab_path)
+            except Exception:
+                self.is_tab_playing = False     # So that another tab can be played
+                raise
+            self.feasibility_report = feasibility.FeasibilityReport(self.get_servo_travel_times(), self.feasibility_policy)
+            stream.bars = feasibility.limit_bars(stream.bars, self.feasibility_report.travel_times, self.feasibility_policy, self.feasibility_report)
+            self.scheduler.play(self.tab_events(stream, is_agu_file), self.end_of_tab_callback)     # A broken tab ends too
+
+
+    # Plays the bars 'from_bar' to 'to_bar' (included) in loop, until 'clear_events' is called
+    def loop_tab(self, absolute_tab_path, is_agu_file, from_bar, to_bar):
+        self.load_timeline(absolute_tab_path)
+        self.play_from(from_bar, is_agu_file, to_bar, repeat = None)
+
+
+    # Compiles the tab (or reads its cache), so that it can be played from any bar with 'play_from'
+    def load_timeline(self, absolute_tab_path):
+        self.timeline, self.feasibility_report = self.compile_timeline(absolute_tab_path)
+        return self.timeline
+
+
+    # Returns the (timeline, feasibility report) of the tab, without making it the loaded timeline
+    def compile_timeline(self, absolute_tab_path):
+        timeline = tl.load_timeline(absolute_tab_path)
+        timeline, report = feasibility.check_timeline(timeline, self.get_servo_travel_times(), self.feasibility_policy)
+        if not report.is_playable():
+            print(os.path.basename(absolute_tab_path) + ": " + report.summary())
+        return timeline, report
 
-            except RuntimeError as e:
-                print("If an error occurs below, complaining about not being able to create more threads, then \
-                you will have to lower the size allocated to ")
-                print(e)
 
+    # Compiles the tab in its own thread, so that the menu is not blocked by a long tab. 'on_loaded' is then
+    # called (in the ui executor, if any) with the timeline and its feasibility report, or None, None if it failed.
+    def compile_timeline_in_background(self, absolute_tab_path, on_loaded):
+        def compile_tab():
+            try:
+                timeline, report = self.compile_timeline(absolute_tab_path)
+            except Exception as e:
+                print("Could not load {}: {!r}".format(os.path.basename(absolute_tab_path), e))
+                timeline, report = None, None
+            if self.dispatch != None:
+                self.dispatch(on_loaded, timeline, report)
+            else:
+                on_loaded(timeline, report)
+
+        threading.Thread(target=compile_tab, name="tab_compiler", daemon=True).start()
+
+
+    # Plays the loaded timeline from the bar 'from_bar' (starting at 1) to 'to_bar' (included, or until the end).
+    # The first note is found by binary search, and the servos are set where they would be, had the tab been
+    # played from the start. If 'repeat' is None, the section is played in loop, until 'clear_events' is called.
+    def play_from(self, from_bar, is_agu_file, to_bar = None, repeat = 1):
+        if self.is_tab_playing or self.timeline == None:
+            return
+        self.is_tab_playing = True
+
+        timeline = self.timeline
+        first_bar, first_note = timeline.seek(timeline.bar_times[from_bar - 1])
+        self.servo_manager.set_positions(timeline.servo_positions(first_note))
+        sleep(1)
+
+        nb_of_bars = to_bar - from_bar + 1 if to_bar != None else None
+        self.scheduler.play(self.tab_events(tl.timeline_stream(timeline, first_bar), is_agu_file, nb_of_bars, repeat), self.end_of_tab_callback)
+
+
+    # Event pipeline: bars -> notes -> repeat expansion -> chords -> latency compensation -> (time, func, args)
+    # Plays 'nb_of_bars' bars of the stream (or all of them), 'repeat' times, or forever if 'repeat' is None
+    def tab_events(self, stream, is_agu_file, nb_of_bars = None, repeat = 1):
+        bars = itertools.islice(stream.bars, nb_of_bars)
+
+        # The count in lasts as long as the first bar played, which gives the tempo at this bar, whatever the time
+        # signature (6/8..) and the tempo changes before it. Its beats are spread over it.
+        first_bar = next(bars, None)
+        if first_bar != None:
+            bars = itertools.chain([first_bar], bars)
+            bar_duration = first_bar[1]
+        else:
+            bar_duration = stream.beats * 60 / stream.tempo
+
+        # Each note is sent earlier to the servo by the latency of its string, so that it sounds on time
+        latencies = self.get_servo_latencies()
+
+        # .agu tabs always start with one bar of metronome, gpX tabs only if asked for
+        count_in = is_agu_file or self.play_metronome_before_song
+        metronome_offset = bar_duration if count_in else max(latencies)
+
+        # One bar of beats on the grid of the tab, or the running metronome phase-locked on it (this runs once the
+        # scheduler started playing the tab)
+        tempo = round(stream.beats * 60 / bar_duration, 3)
+        self.metronome.tempo = int(tempo) if tempo.is_integer() else tempo     # Shown by the metronome menu
+        first_beat_time = 0 if count_in else metronome_offset
+        yield (0, self.sync_metronome, [self.scheduler.start_time_ns + int(first_beat_time * 1e9), stream.beats if count_in else None])
+
+        if repeat == None:
+            chords = self.loop_section(bars, latencies, metronome_offset)
+        else:
+            notes = self.repeat_section(bars, repeat)
+            chords = self.compensate_latencies(self.group_chords(notes), latencies)
+
+        end_of_tab_event_timer = metronome_offset       # This timer will be added after the very last note, to send a signal that the tab is over.
+        for time, strings in chords:
+            end_of_tab_event_timer = time + metronome_offset
+            if strings:
+                yield (end_of_tab_event_timer, self.servo_manager.trigger_servos, [strings])
+            else:       # Empty chord of an overdub (see 'loop_section'), only there for the chords to be pulled again
+                yield (end_of_tab_event_timer, self.overdub_refresh_point, [])
+
+        # Add a timer that will trigger an end_of_tab callback
+        yield (end_of_tab_event_timer + self.end_of_tab_event_offset, self.end_of_tab_callback, [])
+
+
+    # A metronome already running (free play..) is phase-locked on the tab, its beat 0 being due at 'origin_ns'.
+    # Otherwise it counts 'nb_of_beats' beats in, if given.
+    def sync_metronome(self, origin_ns, nb_of_beats = None):
+        if self.metronome.is_metronome_active:
+            self.metronome.sync_to(origin_ns)
+        elif nb_of_beats != None:
+            self.metronome.start_metronome(None, origin_ns, nb_of_beats)
+
+
+    # Yields the (time, string) notes of the bars, from the start of the first bar, 'repeat' times.
+    # Only the notes of the section are kept in memory to be repeated, not the repeated events.
+    def repeat_section(self, bars, repeat):
+        section_start_time = None
+        section_duration = 0
+        section_notes = []
+        for bar_time, bar_duration, notes in bars:
+            if section_start_time == None:
+                section_start_time = bar_time
+            section_duration += bar_duration
+            for time, string in notes:
+                yield time - section_start_time, string
+                if repeat > 1:
+                    section_notes.append((time - section_start_time, string))
+
+        for i in range(1, repeat):
+            for time, string in section_notes:
+                yield time + i * section_duration, string
+
+
+    # Yields the chords of the bars forever, from the start of the first bar. The chords are built once, then the
+    # same list is wrapped around: the pass 'i' is shifted by i times the section duration (taken from the bar times,
+    # not accumulated), so the loop stays aligned on the bars, and its cost does not depend on how long it runs.
+    # When overdubbing, the first pass being played at 'start_time', the presses are merged into the chords by the
+    # overdub thread at the end of each pass (see 'merge_overdub'). This runs on the scheduler thread, so it only
+    # picks up the chord list already prepared, from the chord it had reached.
+    def loop_section(self, bars, latencies, start_time = 0):
+        section_start_time = None
+        section_end_time = 0
+        notes = []
+        for bar_time, bar_duration, bar_notes in bars:
+            if section_start_time == None:
+                section_start_time = bar_time
+            section_end_time = bar_time + bar_duration
+            notes += [(time - section_start_time, string) for time, string in bar_notes]
+
+        overdub = self.overdub_layer != None
+        chords = sorted(self.compensate_latencies(self.group_chords(notes), latencies))
+        if (not chords and not overdub) or section_start_time == None or section_end_time <= section_start_time:
+            return      # Nothing to loop on: the tab ends
+
+        section_duration = section_end_time - section_start_time
+        prepared = (0, [chord_time for chord_time, _ in chords], chords)
+        if overdub:
+            with self.overdub_lock:
+                self.overdub_section_notes = notes
+                self.overdub_latencies = latencies
+                self.overdub_section_duration = section_duration
+                self.overdub_section_beats = round(section_duration * self.timeline.tempo / 60)
+                self.overdub_chords = prepared
+                first_pass_ns = self.scheduler.start_time_ns + int(start_time * 1e9)
+                self.overdub_origin_ns = first_pass_ns + time.perf_counter_ns() - time.monotonic_ns()
+            self.scheduler.schedule_at(first_pass_ns + int(section_duration * 1e9), self.end_of_overdub_pass, [self.overdub_wakeup, first_pass_ns, 1])
+
+        for i in itertools.count():
+            offset = i * section_duration
+            last_time = None
+            refresh_time = 0
+            index = 0
+            while True:
+                if overdub and self.overdub_chords[0] != prepared[0]:     # New notes: played along from the next chord on
+                    prepared = self.overdub_chords
+                    index = 0 if last_time == None else bisect.bisect_right(prepared[1], last_time)
+                chords = prepared[2]
+
+                # The scheduler pulls the next chord as soon as the previous one is due within its lookahead, so a long
+                # gap between two chords would hide the notes merged meanwhile: empty chords are yielded in between.
+                if overdub and refresh_time < section_duration and (index >= len(chords) or refresh_time < chords[index][0]):
+                    last_time = refresh_time
+                    refresh_time += self.overdub_refresh_period
+                    yield last_time + offset, []
+                    continue
+
+                if index >= len(chords):
+                    break
+                chord_time, strings = chords[index]
+                index += 1
+                last_time = chord_time
+                yield chord_time + offset, strings
+
+
+    # Plays the bars 'from_bar' to 'to_bar' of a tab directory in loop, and records the presses into a new layer
+    # over them, on the same clock, as many passes as wanted. The layer is played along with the section as it
+    # grows, until 'stop_overdub' is called, then written into the loops with 'save_overdub'.
+    def start_overdub(self, absolute_tab_path, from_bar, to_bar):
+        if self.is_tab_playing:
+            return
+        if self.quantize_grid != None:
+            self.load_quantizer()       # Now, rather than on the first merge: importing numpy takes a while
+        self.servo_manager.capture.discard()
+        with self.overdub_lock:
+            self.overdub_layer = []
+            self.overdub_origin_ns = None
+            self.overdub_section_notes = []
+        self.overdub_from_bar = from_bar
+        self.overdub_wakeup = threading.Event()
+        threading.Thread(target=self.overdub_thread, args=[self.overdub_wakeup], name="overdub", daemon=True).start()
+        self.loop_tab(absolute_tab_path, True, from_bar, to_bar)
+
+
+    def overdub_refresh_point(self):
+        pass
+
+
+    # Scheduled at the end of each pass: wakes the overdub thread up, and schedules the end of the next pass
+    def end_of_overdub_pass(self, wakeup, first_pass_ns, nb_of_passes):
+        if wakeup is not self.overdub_wakeup or not self.is_tab_playing:     # Stopped, or another overdub started since
+            return
+        wakeup.set()
+        next_pass_end_ns = first_pass_ns + int((nb_of_passes + 1) * self.overdub_section_duration * 1e9)
+        self.scheduler.schedule_at(next_pass_end_ns, self.end_of_overdub_pass, [wakeup, first_pass_ns, nb_of_passes + 1])
+
+
+    def overdub_thread(self, wakeup):
+        while True:
+            wakeup.wait()
+            wakeup.clear()
+            if self.overdub_layer == None:      # Saved or dropped
+                return
+            self.merge_overdub()
+
+
+    # Drains the captured presses into the layer, quantized, and prepares the chords of the section with the layer,
+    # for 'loop_section'. Returns the number of notes of the layer.
+    def merge_overdub(self):
+        with self.overdub_lock:
+            presses = self.servo_manager.capture.drain()
+            if self.overdub_layer == None or self.overdub_origin_ns == None:
+                return 0
+
+            pre_record_ns = int(self.pre_record_window * 1e9)
+            new_notes = []
+            for time_ns, string in presses:
+                if time_ns - self.overdub_origin_ns >= -pre_record_ns:     # Not during the count in
+                    note_time = max(0, time_ns - self.overdub_origin_ns) / 1e9 % self.overdub_section_duration
+                    new_notes.append((string, note_time))
+            if not new_notes:
+                return len(self.overdub_layer)
+
+            if self.quantize_grid != None:
+                new_notes = self.quantize_notes(new_notes, self.overdub_section_duration, self.overdub_section_beats)
+
+            # A note already in the section (or in the layer) is not added twice
+            string_times = [[] for string in range(6)]
+            for note_time, string in self.overdub_section_notes + self.overdub_layer:
+                string_times[string].append(note_time)
+            for times in string_times:
+                times.sort()
+            for string, note_time in new_notes:
+                times = string_times[string]
+                i = bisect.bisect_left(times, note_time - self.chord_window)
+                if i == len(times) or times[i] > note_time + self.chord_window:
+                    self.overdub_layer.append((note_time, string))
+                    times.insert(i, note_time)
+
+            notes = sorted(self.overdub_section_notes + self.overdub_layer)
+            chords = sorted(self.compensate_latencies(self.group_chords(notes), self.overdub_latencies))
+            self.overdub_chords = (self.overdub_chords[0] + 1, [chord_time for chord_time, _ in chords], chords)
+            return len(self.overdub_layer)
+
+
+    # Stops the section, and returns the number of notes of the layer, the presses of the last pass included
+    def stop_overdub(self):
+        self.clear_events()
+        return self.merge_overdub()
+
+
+    # Adds the notes of the layer to the loops they were played over, or drops them if 'save' is False
+    def save_overdub(self, absolute_tab_dir, save = True):
+        with self.overdub_lock:
+            layer, self.overdub_layer = self.overdub_layer, None
+            self.overdub_origin_ns = None
+        self.overdub_wakeup.set()      # The overdub thread ends
+        if not save or not layer:
+            return
+
+        meta_path = os.path.join(absolute_tab_dir, self.meta_tab_file)
+        tempo, beats, loop_names = tl.read_agu_meta(meta_path)
+        bar_duration = beats * 60 / tempo
+        nb_of_bars = round(self.overdub_section_duration / bar_duration)
+        # A note at the very end of the section is written at the start of its first bar
+        for note_time, string in sorted((note_time % self.overdub_section_duration, string) for note_time, string in layer):
+            bar = self.overdub_from_bar - 1 + min(int(note_time // bar_duration), nb_of_bars - 1)
+            with open(os.path.join(absolute_tab_dir, loop_names[bar]), 'a') as loop_file:
+                loop_file.write(str(string) + "," + str(note_time % bar_duration / bar_duration) + '\n')
+        os.utime(meta_path)     # So that the tab library reads the tab again
+        self.library.refresh_tab(os.path.basename(absolute_tab_dir))
+
+
+    # Splits the chords by latency, each part being sent that much earlier. The output is not strictly sorted anymore,
+    # but the disorder is smaller than the biggest latency, which is much smaller than the scheduler lookahead.
+    def compensate_latencies(self, chords, latencies):
+        for time, strings in chords:
+            for latency in sorted(set(latencies[string] for string in strings), reverse=True):
+                yield time - latency, [string for string in strings if latencies[string] == latency]
+
+
+    def get_servo_latencies(self):
+        return [self.servo_manager.get_latency(string) for string in range(6)]
+
+
+    def get_servo_travel_times(self):
+        return [self.servo_manager.get_travel_time(string) for string in range(6)]
+
+
+    # Takes time-sorted (time, string) notes, and yields (time, [strings]) chords, all the notes of a chord
+    # being triggered by one single event
+    def group_chords(self, notes):
+        chord_time = None
+        chord = []
+        for time, string in notes:
+            if chord and time - chord_time > self.chord_window:
+                yield chord_time, chord
+                chord = []
+            if not chord:
+                chord_time = time
+            if string not in chord:     # A string can only be plucked once per chord
+                chord.append(string)
+        if chord:
+            yield chord_time, chord
 
 
     def end_of_tab_callback(self): # Sends a signal when the tab is over
@@ -244,50 +499,71 @@ class TabManager:
         self.clear_events()
         
         if self.callback != None:
-            self.callback()
+            if self.dispatch != None:
+                self.dispatch(self.callback)
+            else:
+                self.callback()
 
 
     def set_callback(self, callback):
         self.callback = callback
 
 
-    def save_note(self, index, mode):
-        if mode == 0:
-            self.pre_record_list[index] = True
-        elif mode == 1:
-            note_start_time = time.time() - self.bar_starting_time
-            self.saved_notes_list[index].append(note_start_time)
+    # The recorded bar starts at 'bar_start_ns', in time.monotonic_ns() (the deadline of a metronome tick)
+    def start_recording_bar(self, bar_start_ns):
+        self.bar_starting_time = bar_start_ns + time.perf_counter_ns() - time.monotonic_ns()
 
 
     def process_loop(self): # No matter whether the loop is saved or note, some process is done
-        self.sorted_notes_list = []
+        bar_duration_ns = int(self.beats * 60 / self.current_tempo * 1e9)
+        pre_record_ns = int(self.pre_record_window * 1e9)
 
-        # List all notes, sorted by time, in order to print them.
-        for i in range(0, 6):
-            if self.pre_record_list[i]:
-                self.sorted_notes_list.append((i,0))
-            for j in range(0, len(self.saved_notes_list[i])):
-                self.sorted_notes_list.append((i,self.saved_notes_list[i][j]))
-
-        self.sorted_notes_list = sorted(self.sorted_notes_list, key = lambda tup: tup[1])
+        # Drains the presses captured by the servo manager, and keeps those of the bar, sorted by time
+        self.sorted_notes_list = []
+        for time_ns, string in self.servo_manager.capture.drain():
+            note_time_ns = time_ns - self.bar_starting_time
+            if -pre_record_ns <= note_time_ns < bar_duration_ns:
+                self.sorted_notes_list.append((string, max(0, note_time_ns) / 1e9))
+        self.sorted_notes_list.sort(key = lambda tup: tup[1])
+
+        if self.quantize_grid != None:
+            self.sorted_notes_list = self.quantize_notes(self.sorted_notes_list)
         
         self.print_saved_notes()
 
-        # Reset List of notes
-        self.pre_record_list = [False, False, False, False, False, False]
-        self.saved_notes_list = [[] for i in range(6)]
         self.bar_starting_time = 0
 
         self.replay_loop()
     
 
-    def replay_loop(self):
-        for i in range(0, self.repeat_newly_saved_loop_X_time):
-            for string, time in self.sorted_notes_list:
-                self.events.append(Timer(time + (i * self.beats * 60/self.current_tempo), self.servo_manager.trigger_servo, [string]))
+    # Returns the quantizer module, or None if numpy is missing
+    def load_quantizer(self):
+        try:
+            import quantizer     # Only needed to quantize, so that the recorder works without numpy
+        except ImportError as e:
+            print("The loop can't be quantized: {!r}".format(e))
+            return None
+        return quantizer
+
+
+    # Puts the (string, time) notes of the recorded bar (or of a longer section) on the grid
+    def quantize_notes(self, notes, duration = None, beats = None):
+        quantizer = self.load_quantizer()
+        if quantizer == None:
+            return notes
+        if duration == None:
+            duration = self.beats * 60 / self.current_tempo
+            beats = self.beats
+        return quantizer.quantize_bar(notes, duration, beats, self.quantize_grid, self.quantize_strength, self.quantize_swing)
 
-        for event in self.events:
-            event.start()
+
+    def replay_loop(self):
+        latencies = self.get_servo_latencies()
+        lead_time = max(latencies)
+        bar = (0, self.beats * 60/self.current_tempo, [(time, string) for string, time in self.sorted_notes_list])
+        notes = self.repeat_section([bar], self.repeat_newly_saved_loop_X_time)
+        chords = self.compensate_latencies(self.group_chords(notes), latencies)
+        self.scheduler.play((time + lead_time, self.servo_manager.trigger_servos, [strings]) for time, strings in chords)
 
 
     def print_saved_notes(self):
@@ -316,9 +592,16 @@ class TabManager:
 
         with open(os.path.join(absolute_tab_dir, self.meta_tab_file), 'a') as tab_file:
             tab_file.write(self.default_loop_name+ str(i) + '\n')
+        self.library.refresh_tab(os.path.basename(absolute_tab_dir))
 
 
     def load_tab_info(self, absolute_tab_path):
+        if tl.is_agu2_file(absolute_tab_path):     # Single file .agu v2, the info is in its header
+            timeline = tl.read_agu2(absolute_tab_path)
+            self.current_tempo = timeline.tempo
+            self.beats = timeline.beats
+            return self.current_tempo, self.beats, timeline.nb_of_bars
+
         with open(absolute_tab_path) as file:
             lines = file.readlines()
             self.current_tempo = int(lines[0].split(',')[1])
@@ -329,13 +612,11 @@ class TabManager:
 
 
     def clear_events(self):
-        for event in self.events:
-            event.cancel()   
-        self.events.clear()
+        self.scheduler.clear()
+        self.metronome.stop_metronome()     # The count in has its own scheduler
         self.is_tab_playing = False
 
 
     def clear_saved_notes(self):
-        self.saved_notes_list = [[] for i in range(6)]  
-        self.pre_record_list = [False, False, False, False, False, False]
+        self.servo_manager.capture.discard()
         self.sorted_notes_list = []
@@ -0,0 +1,524 @@
+from array import array
+import bisect
+import hashlib
+import mmap
+import os
+import struct
+import threading
+
+
+"""
+A tab (gp3, gp4, gp5 or .agu) is 'compiled' once into a Timeline: a compact, time-sorted list of
+(time, string) events, stored in two flat arrays, plus the tempo and the starting time of each bar.
+
+Parsing a gpX file or reading all the Loop_X files of a .agu tab is slow on a raspberry, so the
+compiled timeline is cached next to the tab:
+    - /default/tab/dir/.tab_name.gpX.timeline   for a gpX file
+    - /default/tab/dir/tab_name/Timeline.cache   for a .agu tab
+The cache is invalidated when the source files change (size and mtime first, then content hash).
+
+A tab can also be opened as a TabStream, which yields its notes bar after bar, so that playing it can
+start before the whole tab has been read.
+
+A tab can also be stored as a single binary file, 'tab_name.agu' (.agu v2), instead of a directory with a
+Meta.agu and a Loop_X file per bar. It is a compiled timeline, and is loaded with mmap, the arrays of the
+Timeline being views on the mapped file (no parsing, no copy). All the values are little endian:
+    header          magic 'AGU2', version, typecode of the note times ('f' or 'd'), tempo, beats,
+                    nb of bars, nb of notes, padded to 32 bytes
+    bar times       float64 * (nb of bars + 1), starting time of each bar, plus the end of the last bar
+    note times      float32 or float64 * nb of notes, float32 only if it does not change any time
+    bar offsets     uint32 * (nb of bars + 1), index of the first note of each bar, plus the nb of notes
+    note strings    uint8 * nb of notes
+The arrays are in this order so that each of them is aligned on the size of its items.
+"""
+
+
+SECS_IN_MIN = 60
+QUARTER_TIME = 960                                  # Number of ticks in a quarter note, in gpX files
+GP_TO_AGU_MAPPING = {6:0, 5:1, 4:2, 3:3, 2:4, 1:5}  # gpX strings go from 1 (high E) to 6 (low E)
+
+META_TAB_FILE = "Meta.agu"
+AGU_CACHE_FILE = "Timeline.cache"
+GP_CACHE_SUFFIX = ".timeline"
+
+CACHE_MAGIC = b"AGUTL"
+CACHE_VERSION = 2                                   # 2: gpX tabs compiled through their tempo map
+# magic, version, tempo, beats, nb of notes, nb of bars, stat key, content hash
+CACHE_HEADER = struct.Struct("<5sBdIII20s20s")
+
+AGU2_EXTENSION = ".agu"
+AGU2_MAGIC = b"AGU2"
+AGU2_VERSION = 2
+# magic, version, typecode of the note times, tempo, beats, nb of bars, nb of notes
+AGU2_HEADER = struct.Struct("<4sBcdIII6x")
+
+
+class Timeline:
+
+    def __init__(self, tempo, beats, times, strings, bar_times, bar_offsets):
+        self.tempo = tempo
+        self.beats = beats                  # Beats per bar
+        self.times = times                  # array('d'), time of each note in seconds, sorted
+        self.strings = strings              # array('B'), string [0-5] of each note
+        self.bar_times = bar_times          # array('d'), starting time of each bar, plus the end time of the last bar
+        self.bar_offsets = bar_offsets      # array('I'), index of the first note of each bar, plus the total nb of notes
+        self.bar_positions_table = None     # See 'bar_positions'
+
+
+    @property
+    def nb_of_notes(self):
+        return len(self.times)
+
+
+    @property
+    def nb_of_bars(self):
+        return len(self.bar_times) - 1
+
+
+    @property
+    def duration(self):
+        return self.bar_times[-1]
+
+
+    # Duration of a bar, from the bar times: the time signature and the tempo may change along the tab
+    def bar_duration(self, bar = 0):
+        if bar >= self.nb_of_bars:
+            return self.beats * SECS_IN_MIN / self.tempo
+        return self.bar_times[bar + 1] - self.bar_times[bar]
+
+
+    # Returns (bar, index of the first note) at 'time', by binary search
+    def seek(self, time):
+        bar = min(max(0, bisect.bisect_right(self.bar_times, time) - 1), max(0, self.nb_of_bars - 1))
+        return bar, bisect.bisect_left(self.times, time)
+
+
+    # Positions of the servos at the start of each bar, plus at the end of the tab, as a bit mask (bit s set: the
+    # servo of string s is high). Each note toggles the servo of its string, the servos being low at the start.
+    # Computed once, the first time it is needed.
+    def bar_positions(self):
+        if self.bar_positions_table is None:
+            positions = array('B')
+            mask = 0
+            last_times = [None] * 6
+            for bar in range(self.nb_of_bars):
+                positions.append(mask)
+                for n in range(self.bar_offsets[bar], self.bar_offsets[bar + 1]):
+                    string = self.strings[n]
+                    if last_times[string] != self.times[n]:     # A doubled note is only played once
+                        mask ^= 1 << string
+                    last_times[string] = self.times[n]
+            positions.append(mask)
+            self.bar_positions_table = positions
+        return self.bar_positions_table
+
+
+    # Returns the position of each servo (True if high) just before the note 'note_index' is played
+    def servo_positions(self, note_index):
+        bar = min(max(0, bisect.bisect_right(self.bar_offsets, note_index) - 1), self.nb_of_bars)
+        mask = self.bar_positions()[bar]
+        last_times = [None] * 6
+        for n in range(self.bar_offsets[bar], note_index):     # Notes of the bar played before it
+            string = self.strings[n]
+            if last_times[string] != self.times[n]:
+                mask ^= 1 << string
+            last_times[string] = self.times[n]
+        return [bool(mask & (1 << string)) for string in range(6)]
+
+
+class TimelineBuilder:  # Collects the notes bar after bar, and outputs a Timeline
+
+    def __init__(self):
+        self.times = array('d')
+        self.strings = array('B')
+        self.bar_times = array('d')
+        self.bar_offsets = array('I')
+
+
+    def add_bar(self, bar_time, notes):
+        self.bar_times.append(bar_time)
+        self.bar_offsets.append(len(self.times))
+        for time, string in notes:
+            self.times.append(time)
+            self.strings.append(string)
+
+
+    def build(self, tempo, beats, end_time):
+        self.bar_times.append(end_time)
+        self.bar_offsets.append(len(self.times))
+        return Timeline(tempo, beats, self.times, self.strings, self.bar_times, self.bar_offsets)
+
+
+class TabStream:
+    """
+    A tab being read bar after bar. 'bars' is an iterator of (bar_time, bar_duration, notes), notes being
+    the time-sorted list of (time, string) of the bar. So a tab can be played while its next bars are still
+    being read, without holding all of its notes in memory.
+    'beats' is the numerator of the first time signature, and 'beat_value' its denominator (4 for quarter notes,
+    8 for eighth notes..): a bar lasts beats * 4 / beat_value quarter notes, at 'tempo' quarter notes per minute.
+    """
+
+    def __init__(self, tempo, beats, bars, beat_value = 4):
+        self.tempo = tempo
+        self.beats = beats
+        self.bars = bars
+        self.beat_value = beat_value
+
+
+class TempoMap:
+    """
+    Converts the ticks of a gpX file (QUARTER_TIME ticks per quarter note) into seconds, through the tempo
+    changes of the song. The time at which each tempo starts is computed once, so the time of a tick is the
+    time of its tempo segment, plus the ticks elapsed since, at this tempo. The notes being converted in
+    order, the current segment is a pointer which only moves forward: no note is converted from the start.
+    """
+
+    def __init__(self, start_tick, tempo, changes):
+        self.ticks = [start_tick]           # First tick of each tempo segment
+        self.tempos = [tempo]               # Tempo (quarter notes per minute) of each segment
+        self.seconds = [0.0]                # Time of the first tick of each segment
+        for tick, new_tempo in sorted(changes):
+            tick = max(tick, start_tick)
+            if tick == self.ticks[-1]:      # Several changes on the same tick, the last one wins
+                self.tempos[-1] = new_tempo
+            elif new_tempo != self.tempos[-1]:
+                self.seconds.append(self.seconds[-1] + (tick - self.ticks[-1]) * self.seconds_per_tick(-1))
+                self.ticks.append(tick)
+                self.tempos.append(new_tempo)
+        self.segment = 0
+
+
+    def seconds_per_tick(self, segment):
+        return SECS_IN_MIN / (self.tempos[segment] * QUARTER_TIME)
+
+
+    def to_seconds(self, tick):
+        if tick < self.ticks[self.segment]:     # Going backwards, which the tab readers avoid
+            self.segment = max(0, bisect.bisect_right(self.ticks, tick) - 1)
+        while self.segment + 1 < len(self.ticks) and self.ticks[self.segment + 1] <= tick:
+            self.segment += 1
+        return self.seconds[self.segment] + (tick - self.ticks[self.segment]) * self.seconds_per_tick(self.segment)
+
+
+# Yields the (tick, tempo) of the mix table changes of the song, whatever the track they are written in
+def gp_tempo_changes(song):
+    for track in song.tracks:
+        for measure in track.measures:
+            for voice in measure.voices:
+                tick = measure.header.start
+                for beat in voice.beats:
+                    mix_table_change = beat.effect.mixTableChange
+                    if mix_table_change != None and mix_table_change.tempo != None and mix_table_change.tempo.value > 0:
+                        yield tick, mix_table_change.tempo.value
+                    tick += beat.duration.time
+
+
+# The bars come from the measure headers, so each bar has its own time signature (header.length ticks)
+def iter_gp_bars(song, tempo_map):
+    for measure in song.tracks[0].measures:
+        header = measure.header
+        bar_time = tempo_map.to_seconds(header.start)
+        ticks = []
+        for voice in measure.voices:
+            tick = header.start
+            for beat in voice.beats:
+                for note in beat.notes:
+                    ticks.append((tick, GP_TO_AGU_MAPPING[note.string]))
+                tick += beat.duration.time
+        # Notes of different voices are not ordered in time, so sort them within the bar, by tick,
+        # which also keeps the tempo map pointer moving forward
+        notes = [(tempo_map.to_seconds(tick), string) for tick, string in sorted(ticks)]
+        bar_end = tempo_map.to_seconds(header.start + header.length)
+        yield bar_time, bar_end - bar_time, notes
+
+
+def open_gp_stream(absolute_tab_path):
+    import guitarpro as pygp     # Only needed for gpX files, so that .agu tabs can be played without it
+    song = pygp.parse(absolute_tab_path)
+    first_header = song.measureHeaders[0]
+    tempo_map = TempoMap(first_header.start, song.tempo, gp_tempo_changes(song))
+    time_signature = first_header.timeSignature
+    return TabStream(song.tempo, time_signature.numerator, iter_gp_bars(song, tempo_map), time_signature.denominator.value)
+
+
+def read_agu_meta(absolute_tab_path):
+    with open(absolute_tab_path) as tab_file:
+        lines = tab_file.readlines()
+
+    # The first two lines contain the meta info, then each line is the name of a loop file
+    tempo = int(lines[0].split(',')[1].rstrip('\n'))
+    beats = int(lines[1].split(',')[1].rstrip('\n'))
+    loop_names = [line.rstrip('\n') for line in lines[2:] if line.strip()]
+    return tempo, beats, loop_names
+
+
+def iter_agu_bars(absolute_tab_dir, loop_names, bar_duration):
+    for i, loop_name in enumerate(loop_names):
+        notes = []
+        with open(os.path.join(absolute_tab_dir, loop_name)) as loop_file:
+            for note in loop_file:
+                if note.strip():
+                    string, note_time = note.split(',')
+                    notes.append(((float(note_time) + i) * bar_duration, int(string)))
+        yield i * bar_duration, bar_duration, sorted(notes)
+
+
+def open_agu_stream(absolute_tab_path):
+    tempo, beats, loop_names = read_agu_meta(absolute_tab_path)
+    bar_duration = beats * SECS_IN_MIN / tempo
+    return TabStream(tempo, beats, iter_agu_bars(os.path.dirname(absolute_tab_path), loop_names, bar_duration))
+
+
+def iter_timeline_bars(timeline, first_bar = 0):
+    times = timeline.times
+    strings = timeline.strings
+    for bar in range(first_bar, timeline.nb_of_bars):
+        first_note, last_note = timeline.bar_offsets[bar], timeline.bar_offsets[bar + 1]
+        bar_time = timeline.bar_times[bar]
+        notes = [(times[n], strings[n]) for n in range(first_note, last_note)]
+        yield bar_time, timeline.bar_times[bar + 1] - bar_time, notes
+
+
+def timeline_stream(timeline, first_bar = 0):
+    return TabStream(timeline.tempo, timeline.beats, iter_timeline_bars(timeline, first_bar))
+
+
+def compile_stream(stream):
+    builder = TimelineBuilder()
+    end_time = 0
+    for bar_time, bar_duration, notes in stream.bars:
+        builder.add_bar(bar_time, notes)
+        end_time = bar_time + bar_duration
+    return builder.build(stream.tempo, stream.beats, end_time)
+
+
+def compile_gp(absolute_tab_path):
+    return compile_stream(open_gp_stream(absolute_tab_path))
+
+
+def compile_agu(absolute_tab_path):
+    return compile_stream(open_agu_stream(absolute_tab_path))
+
+
+def is_agu_meta_file(absolute_tab_path):
+    return os.path.basename(absolute_tab_path) == META_TAB_FILE
+
+
+# A single file .agu v2 tab, as opposed to the Meta.agu file of a tab directory
+def is_agu2_file(absolute_tab_path):
+    return absolute_tab_path.endswith(AGU2_EXTENSION) and not is_agu_meta_file(absolute_tab_path)
+
+
+def write_agu2(path, timeline):
+    times = array('f', timeline.times)
+    if times.tolist() != list(timeline.times):     # float32 would round some times
+        times = array('d', timeline.times)
+
+    header = AGU2_HEADER.pack(AGU2_MAGIC, AGU2_VERSION, times.typecode.encode(), timeline.tempo, timeline.beats,
+                              timeline.nb_of_bars, timeline.nb_of_notes)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as tab_file:
+        tab_file.write(header)
+        for values in (array('d', timeline.bar_times), times, array('I', timeline.bar_offsets), array('B', timeline.strings)):
+            values.tofile(tab_file)
+    os.replace(tmp_path, path)
+
+
+# Returns the Timeline of a .agu v2 file. Its arrays are memoryviews on the mapped file.
+def read_agu2(path):
+    with open(path, 'rb') as tab_file:
+        try:
+            data = mmap.mmap(tab_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:      # Empty file
+            raise ValueError("{} is not an .agu v2 file".format(path))
+
+    try:
+        magic, version, time_typecode, tempo, beats, nb_of_bars, nb_of_notes = AGU2_HEADER.unpack_from(data)
+    except struct.error:
+        raise ValueError("{} is not an .agu v2 file".format(path))
+    time_typecode = time_typecode.decode()
+    if magic != AGU2_MAGIC or time_typecode not in ('f', 'd'):
+        raise ValueError("{} is not an .agu v2 file".format(path))
+    if version != AGU2_VERSION:
+        raise ValueError("{}: unsupported .agu version {}".format(path, version))
+
+    view = memoryview(data)
+    offset = AGU2_HEADER.size
+    arrays = []
+    for typecode, length in (('d', nb_of_bars + 1), (time_typecode, nb_of_notes), ('I', nb_of_bars + 1), ('B', nb_of_notes)):
+        size = length * struct.calcsize(typecode)
+        if offset + size > len(data):
+            raise ValueError("{} is truncated".format(path))
+        arrays.append(view[offset:offset + size].cast(typecode))
+        offset += size
+
+    bar_times, times, bar_offsets, strings = arrays
+    return Timeline(tempo, beats, times, strings, bar_times, bar_offsets)
+
+
+# Returns the list of files the timeline is compiled from
+def source_files(absolute_tab_path):
+    if is_agu_meta_file(absolute_tab_path):
+        absolute_tab_dir = os.path.dirname(absolute_tab_path)
+        loop_names = read_agu_meta(absolute_tab_path)[2]
+        return [absolute_tab_path] + [os.path.join(absolute_tab_dir, loop_name) for loop_name in loop_names]
+    return [absolute_tab_path]
+
+
+def cache_path(absolute_tab_path):
+    if is_agu_meta_file(absolute_tab_path):
+        return os.path.join(os.path.dirname(absolute_tab_path), AGU_CACHE_FILE)
+    tab_dir, tab_name = os.path.split(absolute_tab_path)
+    return os.path.join(tab_dir, '.' + tab_name + GP_CACHE_SUFFIX)
+
+
+def stat_key(files):
+    key = hashlib.sha1()
+    for file_name in files:
+        stat = os.stat(file_name)
+        key.update("{},{},{};".format(file_name, stat.st_size, stat.st_mtime_ns).encode())
+    return key.digest()
+
+
+def content_hash(files):
+    key = hashlib.sha1()
+    for file_name in files:
+        with open(file_name, 'rb') as source_file:
+            key.update(source_file.read())
+    return key.digest()
+
+
+def write_cache(path, timeline, source_stat_key, source_hash):
+    header = CACHE_HEADER.pack(CACHE_MAGIC, CACHE_VERSION, timeline.tempo, timeline.beats,
+                               timeline.nb_of_notes, timeline.nb_of_bars, source_stat_key, source_hash)
+    tmp_path = "{}.{}.tmp".format(path, threading.get_ident())     # A tab can be compiled while it is streamed
+    with open(tmp_path, 'wb') as cache_file:
+        cache_file.write(header)
+        for values in (timeline.times, timeline.strings, timeline.bar_times, timeline.bar_offsets):
+            values.tofile(cache_file)
+    os.replace(tmp_path, path)      # Never leave a half written cache behind
+
+
+# Returns (timeline, stat key, content hash) or None if the cache can't be read
+def read_cache(path):
+    try:
+        with open(path, 'rb') as cache_file:
+            data = cache_file.read()
+        magic, version, tempo, beats, nb_of_notes, nb_of_bars, cached_stat_key, cached_hash = \
+            CACHE_HEADER.unpack_from(data)
+    except (OSError, struct.error):
+        return None
+
+    if magic != CACHE_MAGIC or version != CACHE_VERSION:
+        return None
+
+    offset = CACHE_HEADER.size
+    arrays = []
+    for typecode, length in (('d', nb_of_notes), ('B', nb_of_notes), ('d', nb_of_bars + 1), ('I', nb_of_bars + 1)):
+        values = array(typecode)
+        size = length * values.itemsize
+        values.frombytes(data[offset:offset + size])
+        if len(values) != length:
+            return None
+        arrays.append(values)
+        offset += size
+
+    return Timeline(tempo, beats, *arrays), cached_stat_key, cached_hash
+
+
+def same_timeline(timeline, other):
+    return (timeline.tempo == other.tempo and timeline.beats == other.beats
+            and list(timeline.times) == list(other.times) and list(timeline.strings) == list(other.strings)
+            and list(timeline.bar_times) == list(other.bar_times) and list(timeline.bar_offsets) == list(other.bar_offsets))
+
+
+# Converts a tab directory (Meta.agu + Loop_X files) into a .agu v2 file, which is read back and
+# compared with the tab directory: the file is removed, and ValueError raised, if anything differs.
+def migrate_agu(absolute_tab_path, output_path):
+    timeline = compile_agu(absolute_tab_path)
+    write_agu2(output_path, timeline)
+    if not same_timeline(timeline, read_agu2(output_path)):
+        os.remove(output_path)
+        raise ValueError("{} could not be converted without loss".format(absolute_tab_path))
+    return timeline
+
+
+def open_source_stream(absolute_tab_path):
+    if is_agu_meta_file(absolute_tab_path):
+        return open_agu_stream(absolute_tab_path)
+    if is_agu2_file(absolute_tab_path):
+        return timeline_stream(read_agu2(absolute_tab_path))
+    return open_gp_stream(absolute_tab_path)
+
+
+def compile_tab(absolute_tab_path):
+    return compile_stream(open_source_stream(absolute_tab_path))
+
+
+# Returns (cached timeline or None, stat key, content hash) of the tab
+def check_cache(absolute_tab_path):
+    files = source_files(absolute_tab_path)
+    source_stat_key = stat_key(files)
+    path = cache_path(absolute_tab_path)
+
+    cached = read_cache(path)
+    if cached is not None:
+        timeline, cached_stat_key, cached_hash = cached
+        if cached_stat_key == source_stat_key:
+            return timeline, source_stat_key, cached_hash
+        # The files have been touched, but maybe not modified (copied on the SD card for instance)
+        source_hash = content_hash(files)
+        if cached_hash == source_hash:
+            save_cache(path, timeline, source_stat_key, source_hash)
+            return timeline, source_stat_key, source_hash
+    else:
+        source_hash = content_hash(files)
+
+    return None, source_stat_key, source_hash
+
+
+def save_cache(path, timeline, source_stat_key, source_hash):
+    try:
+        write_cache(path, timeline, source_stat_key, source_hash)
+    except OSError as e:
+        print("Could not write the timeline cache: {}".format(e))
+
+
+# Passes the bars through, while compiling them. The cache is written once the last bar has been read.
+def caching_bars(stream, bars, path, source_stat_key, source_hash):
+    builder = TimelineBuilder()
+    end_time = 0
+    for bar_time, bar_duration, notes in bars:
+        builder.add_bar(bar_time, notes)
+        end_time = bar_time + bar_duration
+        yield bar_time, bar_duration, notes
+    save_cache(path, builder.build(stream.tempo, stream.beats, end_time), source_stat_key, source_hash)
+
+
+# Returns the compiled timeline of a tab, from the cache if it is still valid
+def load_timeline(absolute_tab_path, use_cache = True):
+    if is_agu2_file(absolute_tab_path):     # Already compiled
+        return read_agu2(absolute_tab_path)
+    if not use_cache:
+        return compile_tab(absolute_tab_path)
+
+    timeline, source_stat_key, source_hash = check_cache(absolute_tab_path)
+    if timeline is None:
+        timeline = compile_tab(absolute_tab_path)
+        save_cache(cache_path(absolute_tab_path), timeline, source_stat_key, source_hash)
+    return timeline
+
+
+# Returns a TabStream of the tab, read from the cache if it is still valid, otherwise from the tab itself,
+# the cache being written as a side effect if the whole tab is read.
+def open_stream(absolute_tab_path, use_cache = True):
+    if not use_cache or is_agu2_file(absolute_tab_path):
+        return open_source_stream(absolute_tab_path)
+
+    timeline, source_stat_key, source_hash = check_cache(absolute_tab_path)
+    if timeline is not None:
+        return timeline_stream(timeline)
+
+    stream = open_source_stream(absolute_tab_path)
+    stream.bars = caching_bars(stream, stream.bars, cache_path(absolute_tab_path), source_stat_key, source_hash)
+    return stream